@@ -0,0 +1,144 @@
+"""
+Burengraaf van de PC4-gebieden: welke gebieden een grens delen.
+
+De graaf is een symmetrische sparse matrix (scipy CSR): rij i bevat de buren van gebied i,
+met als waarde de lengte van de gedeelde grens (in graden). Met de topologie (topology.py)
+volgen de buren direct uit de gedeelde arcs. Omdat de gebieden bij het inlezen elk apart
+vereenvoudigd zijn, vallen naburige grenzen niet overal precies samen (kleine kieren en
+overlap); zulke buren delen geen arc. Die worden gevonden door de grenzen via een STRtree
+met een tolerantie te vergelijken. De graaf wordt per dataset in de snapshotmap bewaard
+(pc4_data.load_adjacency).
+
+Daarop gebouwd: een marktaandeel over elk gebied samen met zijn buren (minder ruis bij
+gebieden met weinig sterfgevallen) en aaneengesloten regio's per cluster.
+"""
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+
+# Afstand (in graden, ca. 10 meter, de tolerantie van het vereenvoudigen) waarbinnen een
+# grens als gedeeld telt, en de minimale lengte van de gedeelde grens (ca. 50 meter):
+# gebieden die elkaar alleen in een hoekpunt raken zijn geen buren
+BORDER_TOLERANCE = 0.0001
+MIN_SHARED_BORDER = 0.0005
+
+# Groepering voor aaneengesloten regio's (eerste kolom die in de data voorkomt)
+REGION_GROUP_COLUMNS = ['cluster', 'gemeente']
+
+# Marktaandelen over meerdere gebieden (in procenten), alleen op PC4-niveau
+NEIGHBOURHOOD_METRICS = ['marktaandeel_buren', 'marktaandeel_regio']
+
+
+def _neighbours_from_geometries(geometries, tolerance=BORDER_TOLERANCE, min_shared=MIN_SHARED_BORDER):
+    """
+    Paren (i, j), i < j, waarvan de grenzen over minstens min_shared binnen tolerance van
+    elkaar liggen (ook bij overlap of een kier), met de lengte van dat stuk grens.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    tree = shapely.STRtree(geometries)
+    left, right = tree.query(geometries, predicate='dwithin', distance=tolerance)
+    keep = left < right
+    left, right = left[keep], right[keep]
+    # Het deel van de grens van i dat binnen de tolerantie van j ligt
+    zones = shapely.buffer(geometries, tolerance)
+    shared = shapely.length(shapely.intersection(shapely.boundary(geometries[left]), zones[right]))
+    keep = shared >= min_shared
+    return left[keep], right[keep], shared[keep]
+
+
+def build_adjacency(geometries=None, topology=None):
+    """
+    Symmetrische CSR matrix (n x n) met de lengte van de gedeelde grens per burenpaar. Met
+    topologie en geometrieën: de gedeelde arcs, aangevuld met de buren waarvan de grenzen
+    niet precies samenvallen.
+    """
+    if topology is not None:
+        size = len(topology.objects)
+        left, right, shared = topology.neighbours()
+        if geometries is not None:
+            extra_left, extra_right, extra_shared = _neighbours_from_geometries(geometries)
+            extra = ~np.isin(extra_left * size + extra_right, left * size + right)
+            left = np.concatenate([left, extra_left[extra]])
+            right = np.concatenate([right, extra_right[extra]])
+            shared = np.concatenate([shared, extra_shared[extra]])
+    else:
+        size = len(geometries)
+        left, right, shared = _neighbours_from_geometries(geometries)
+    rows = np.concatenate([left, right])
+    cols = np.concatenate([right, left])
+    return sparse.csr_matrix((np.concatenate([shared, shared]), (rows, cols)), shape=(size, size))
+
+
+def neighbourhood_weights(adjacency):
+    """Binaire buurmatrix plus de diagonaal: een gebied telt mee in zijn eigen buurt."""
+    weights = adjacency.copy()
+    weights.data = np.ones_like(weights.data)
+    return (weights + sparse.identity(adjacency.shape[0], format='csr', dtype=weights.dtype)).tocsr()
+
+
+def smoothed_ratio(adjacency, numerator, denominator, scale=100.0):
+    """
+    Verhouding over elk gebied samen met zijn buren, in één sparse matrix-product voor
+    teller en noemer tegelijk. NaN als de noemer in de hele buurt 0 is.
+    """
+    values = np.column_stack([np.nan_to_num(np.asarray(numerator, dtype=float)),
+                              np.nan_to_num(np.asarray(denominator, dtype=float))])
+    sums = neighbourhood_weights(adjacency) @ values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(sums[:, 1] > 0, sums[:, 0] / sums[:, 1] * scale, np.nan)
+
+
+def contiguous_regions(adjacency, groups):
+    """
+    Aaneengesloten regio's: gebieden van dezelfde groep (bijv. cluster) die via gedeelde
+    grenzen met elkaar verbonden zijn. Geeft per gebied een regionummer.
+    """
+    codes = pd.factorize(pd.Series(groups), use_na_sentinel=True)[0]
+    edges = adjacency.tocoo()
+    same = (codes[edges.row] == codes[edges.col]) & (codes[edges.row] >= 0)
+    within = sparse.csr_matrix(
+        (np.ones(same.sum()), (edges.row[same], edges.col[same])), shape=adjacency.shape
+    )
+    return connected_components(within, directed=False)[1]
+
+
+def add_neighbourhood_metrics(data, adjacency, group_column=None):
+    """
+    Voeg de buurmetrieken toe (ondiepe kopie): marktaandeel_buren, aaneengesloten_regio
+    en marktaandeel_regio (marktaandeel over de hele aaneengesloten regio).
+    """
+    if 'uitvaarten_2023' not in data.columns or 'sterfte_2023' not in data.columns:
+        return data
+    data = data.copy(deep=False)
+    uitvaarten = data['uitvaarten_2023'].to_numpy(dtype=float)
+    sterfte = data['sterfte_2023'].to_numpy(dtype=float)
+    data['marktaandeel_buren'] = smoothed_ratio(adjacency, uitvaarten, sterfte)
+
+    group_column = group_column or next((col for col in REGION_GROUP_COLUMNS if col in data.columns), None)
+    if group_column is None:
+        return data
+    groups = data[group_column]
+    regions = contiguous_regions(adjacency, groups)
+    # Regiosommen met bincount, terug naar de gebieden via het regionummer
+    region_uitvaarten = np.bincount(regions, weights=np.nan_to_num(uitvaarten))
+    region_sterfte = np.bincount(regions, weights=np.nan_to_num(sterfte))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        region_share = np.where(region_sterfte > 0, region_uitvaarten / region_sterfte * 100, np.nan)
+    data['marktaandeel_regio'] = region_share[regions]
+    data['aaneengesloten_regio'] = _region_labels(groups, regions)
+    return data
+
+
+def _region_labels(groups, regions):
+    """Naam per regio: de groep, met een volgnummer (1 = grootste deel) als die uit meerdere delen bestaat."""
+    frame = pd.DataFrame({'group': pd.Series(groups).astype(str).to_numpy(), 'region': regions})
+    sizes = frame.groupby(['group', 'region']).size().rename('size').reset_index()
+    sizes = sizes.sort_values(['group', 'size', 'region'], ascending=[True, False, True])
+    sizes['rank'] = sizes.groupby('group').cumcount() + 1
+    parts = sizes.groupby('group')['region'].transform('size')
+    sizes['label'] = np.where(parts > 1, sizes['group'] + ' ' + sizes['rank'].astype(str), sizes['group'])
+    labels = pd.Series(sizes['label'].to_numpy(), index=sizes['region'].to_numpy())
+    return pd.Categorical(labels.reindex(regions).to_numpy())
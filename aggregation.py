@@ -0,0 +1,375 @@
+"""
+Afgeleide metrieken en aggregatie van PC4-niveau naar gemeenteniveau.
+"""
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from profiling import span
+
+logger = logging.getLogger(__name__)
+
+LEVEL_PC4 = 'pc4'
+LEVEL_GEMEENTE = 'gemeente'
+
+# Numerieke kolommen die per gemeente worden opgeteld (reistijd wordt gemiddeld)
+GEMEENTE_NUMERIC_COLUMNS = [
+    'inwoners', 'sterfte_2023', 'uitvaarten_2023',
+    'uitvaarten_2024', 'uitvaarten_2025', 'aantal_verzekerden',
+    'reistijd_min'
+]
+
+# Dimensies van de rollup-kubus: alle sidebar-filters behalve PC4 zelf
+CUBE_DIMENSIONS = [
+    'provincie', 'gemeente', 'woonplaats', 'cluster',
+    'voorstel_onderneming', 'voorstel_benaming_uvb'
+]
+
+# Optelbare kolommen in de kubus (reistijd als som plus aantal, voor het gemiddelde)
+CUBE_SUM_COLUMNS = [
+    'inwoners', 'sterfte_2023', 'uitvaarten_2023',
+    'uitvaarten_2024', 'uitvaarten_2025', 'aantal_verzekerden'
+]
+
+
+# Functies voor het berekenen van afgeleide metrieken
+def calculate_derived_metrics(data):
+    # Ondiepe kopie: nieuwe kolommen komen niet in het origineel, de geometrie wordt gedeeld
+    data = data.copy(deep=False)
+
+    # Marktaandeel 2023 berekenen
+    if 'uitvaarten_2023' in data.columns and 'sterfte_2023' in data.columns:
+        # Voorkom delen door nul
+        data['berekend_marktaandeel_2023'] = np.where(
+            data['sterfte_2023'] > 0,
+            data['uitvaarten_2023'] / data['sterfte_2023'] * 100,
+            0
+        )
+
+    # Percentage verzekerden berekenen
+    if 'aantal_verzekerden' in data.columns and 'inwoners' in data.columns:
+        data['percentage_verzekerden'] = np.where(
+            data['inwoners'] > 0,
+            data['aantal_verzekerden'] / data['inwoners'] * 100,
+            0
+        )
+
+    return data
+
+
+def build_gemeente_geometry(data, topology=None):
+    """
+    Voeg de PC4-geometrieën eenmalig samen tot gemeentegrenzen.
+
+    De grenzen hangen alleen af van de PC4-vormen, niet van de filters, dus dit hoeft maar
+    één keer per dataset te gebeuren. Met een topologie (topology.py) worden alleen de
+    buitenste arcs per gemeente gebruikt; anders via dissolve.
+    Geeft een GeoDataFrame met 'gemeente' als index.
+    """
+    if topology is not None:
+        merged = topology.merge(data['gemeente'])
+        if merged.notna().all():
+            merged.index.name = 'gemeente'
+            return gpd.GeoDataFrame(geometry=list(merged.values), index=merged.index, crs=data.crs)
+        logger.warning(f"{merged.isna().sum()} gemeenten konden niet uit de topologie worden opgebouwd, terugvallen op dissolve.")
+
+    shapes = gpd.GeoDataFrame(data[['gemeente']], geometry=data.geometry, crs=data.crs)
+
+    try:
+        dissolved = shapes.dissolve(by='gemeente')
+    except Exception as e:
+        # Ongeldige PC4-vormen (bijv. zelfdoorsnijdingen) eerst repareren
+        logger.warning(f"Samenvoegen gemeentegrenzen mislukt ({type(e).__name__}), geometrieën worden gerepareerd.")
+        try:
+            shapes['geometry'] = shapes.geometry.make_valid()
+            dissolved = shapes.dissolve(by='gemeente')
+        except Exception as e2:
+            # Als laatste redmiddel: het gemiddelde van de PC4-centroïden als punt
+            logger.warning(f"Samenvoegen na reparatie mislukt ({type(e2).__name__}), gemeenten worden als punten getoond.")
+            centroids = shapes.geometry.centroid
+            coords = pd.DataFrame({'gemeente': shapes['gemeente'], 'x': centroids.x, 'y': centroids.y})
+            means = coords.groupby('gemeente').mean()
+            return gpd.GeoDataFrame(
+                geometry=gpd.points_from_xy(means['x'], means['y']), index=means.index, crs=data.crs
+            )
+
+    # Vereenvoudigen voor de kaart gebeurt in de detailpiramide (map_layers.py)
+    return dissolved[['geometry']]
+
+
+def aggregate_to_gemeente(data, gemeente_geometry=None):
+    """
+    Aggregeert data van PC4-niveau naar gemeenteniveau met één groupby.
+    De vooraf berekende gemeentegrenzen (build_gemeente_geometry) worden er aan gekoppeld;
+    zonder grenzen wordt een gewoon DataFrame teruggegeven.
+    """
+    if 'gemeente' not in data.columns:
+        return data
+
+    # Selecteer alleen bestaande kolommen
+    numeric_columns = [col for col in GEMEENTE_NUMERIC_COLUMNS if col in data.columns]
+    gemeente_aggs = {col: 'sum' for col in numeric_columns}
+    if 'reistijd_min' in gemeente_aggs:
+        gemeente_aggs['reistijd_min'] = 'mean'  # Gemiddelde reistijd
+
+    # Aggregeer op gemeente (zonder de geometrie mee te nemen)
+    gemeente_data = pd.DataFrame(data[['gemeente'] + numeric_columns]).groupby('gemeente', observed=True).agg(gemeente_aggs)
+
+    # Bereken de afgeleide metrics opnieuw
+    gemeente_data = calculate_derived_metrics(gemeente_data)
+    return attach_gemeente_geometry(gemeente_data, gemeente_geometry)
+
+
+def attach_gemeente_geometry(gemeente_data, gemeente_geometry=None):
+    """
+    Koppel de vooraf berekende gemeentegrenzen aan totalen per gemeente (gemeente als
+    index). Gemeenten zonder grens vallen weg; zonder grenzen een gewoon DataFrame.
+    """
+    if gemeente_geometry is None:
+        return gemeente_data.reset_index()
+
+    gemeente_data = gemeente_data.join(gemeente_geometry[['geometry']], how='inner')
+    return gpd.GeoDataFrame(gemeente_data.reset_index(), geometry='geometry', crs=gemeente_geometry.crs)
+
+
+def top_bottom_positions(values, k):
+    """
+    Posities van de k hoogste (aflopend) en k laagste (oplopend) waarden, zonder volledige
+    sortering: argpartition selecteert in O(n), alleen de k kandidaten worden gesorteerd.
+    NaN telt niet mee.
+    """
+    values = np.asarray(values, dtype=float)
+    candidates = np.flatnonzero(~np.isnan(values))
+    k = min(k, len(candidates))
+    if k == 0:
+        empty = np.empty(0, dtype=np.intp)
+        return empty, empty
+    candidate_values = values[candidates]
+    if k < len(candidates):
+        top = candidates[np.argpartition(-candidate_values, k - 1)[:k]]
+        bottom = candidates[np.argpartition(candidate_values, k - 1)[:k]]
+    else:
+        top = bottom = candidates
+    # Alleen de k kandidaten sorteren (stabiel, dus bij gelijke waarden op volgorde van de data)
+    top = top[np.lexsort((top, -values[top]))]
+    bottom = bottom[np.lexsort((bottom, values[bottom]))]
+    return top, bottom
+
+
+def grouped_top_bottom_positions(values, groups, k):
+    """
+    Top en laagste k per groep (bijv. per provincie) als dict groep -> (top, bottom).
+    De rijen worden één keer op groepscode verdeeld; binnen elke groep argpartition.
+    """
+    codes, uniques = pd.factorize(pd.Series(groups), sort=True)
+    values = np.asarray(values, dtype=float)
+    order = np.argsort(codes, kind='stable')
+    boundaries = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+    result = {}
+    for i, group in enumerate(uniques):
+        members = order[boundaries[i]:boundaries[i + 1]]
+        top, bottom = top_bottom_positions(values[members], k)
+        result[group] = (members[top], members[bottom])
+    return result
+
+
+def build_summary(count, totals, reistijd_mean):
+    """Samenvatting (zoals in het statistiekenpaneel) uit een aantal en kolomtotalen."""
+    total_sterfte = totals.get('sterfte_2023', 0)
+    total_uitvaarten = totals.get('uitvaarten_2023', 0)
+    total_inwoners = totals.get('inwoners', 0)
+    total_verzekerden = totals.get('aantal_verzekerden', 0)
+    return {
+        'aantal': count,
+        'sterfte_2023': total_sterfte,
+        'uitvaarten_2023': total_uitvaarten,
+        'uitvaarten_2024': totals.get('uitvaarten_2024', 0),
+        'uitvaarten_2025': totals.get('uitvaarten_2025', 0),
+        'inwoners': total_inwoners,
+        'aantal_verzekerden': total_verzekerden,
+        'marktaandeel': (total_uitvaarten / total_sterfte) * 100 if total_sterfte > 0 else 0,
+        'percentage_verzekerden': (total_verzekerden / total_inwoners) * 100 if total_inwoners > 0 else 0,
+        'gem_reistijd': reistijd_mean,
+    }
+
+
+def summary_table(summary, area_name):
+    """Samenvatting als tabel (Kenmerk, Waarde), zoals in de statistieken-export."""
+    return pd.DataFrame({
+        'Kenmerk': [
+            'Gebied', 'Aantal PC4-gebieden', 'Marktaandeel 2023 (%)',
+            'Totaal inwoners', 'Sterfte 2023',
+            'Uitvaarten 2023', 'Uitvaarten 2024', 'Uitvaarten 2025',
+            'Aantal verzekerden', 'Percentage verzekerden (%)', 'Gemiddelde reistijd (min)'
+        ],
+        'Waarde': [
+            area_name, summary['aantal'], round(summary['marktaandeel'], 2),
+            int(summary['inwoners']), int(summary['sterfte_2023']),
+            int(summary['uitvaarten_2023']), int(summary['uitvaarten_2024']), int(summary['uitvaarten_2025']),
+            int(summary['aantal_verzekerden']), round(summary['percentage_verzekerden'], 2), round(summary['gem_reistijd'], 1)
+        ]
+    })
+
+
+class RollupCube:
+    """
+    Vooraf opgetelde totalen per combinatie van provincie, gemeente, woonplaats, cluster en
+    organisatie (alleen combinaties die voorkomen). Een filterstand zonder PC4- en
+    bereikfilter is dan een optelling over een paar cellen in plaats van over alle PC4-rijen.
+
+    De codes komen uit de FilterEngine, zodat selecties hier hetzelfde betekenen als in de
+    sidebar (ontbrekende waarden als 'Onbekend').
+    """
+
+    def __init__(self, data, filter_engine, value_column='berekend_marktaandeel_2023'):
+        self.dimensions = [dim for dim in CUBE_DIMENSIONS if dim in filter_engine]
+        self._categories = {dim: filter_engine.categoricals[dim].categories for dim in self.dimensions}
+
+        keys = pd.DataFrame({dim: filter_engine.categoricals[dim].codes for dim in self.dimensions})
+        # Rijen zonder waarde vallen bij een bereikfilter altijd weg, dus apart bijhouden
+        keys['_has_value'] = data[value_column].notna().to_numpy() if value_column in data.columns else True
+        group_columns = list(keys.columns)
+
+        self.sum_columns = [col for col in CUBE_SUM_COLUMNS if col in data.columns]
+        for col in self.sum_columns:
+            keys[col] = data[col].to_numpy()
+        self.has_reistijd = 'reistijd_min' in data.columns
+        if self.has_reistijd:
+            keys['_reistijd_sum'] = data['reistijd_min'].fillna(0).to_numpy()
+            keys['_reistijd_count'] = data['reistijd_min'].notna().to_numpy().astype(np.int64)
+        keys['_count'] = 1
+
+        cells = keys.groupby(group_columns, sort=False).sum()
+        self.cell_codes = {dim: cells.index.get_level_values(dim).to_numpy() for dim in self.dimensions}
+        self.cell_has_value = cells.index.get_level_values('_has_value').to_numpy(dtype=bool)
+        self.cells = {col: cells[col].to_numpy() for col in cells.columns}
+
+    def __len__(self):
+        return len(self.cell_has_value)
+
+    def can_answer(self, selections):
+        """Alleen selecties op de dimensies van de kubus (dus niet op PC4)."""
+        return all(not values or column in self.dimensions for column, values in selections.items())
+
+    def summary(self, selections, require_value=False):
+        """
+        Samenvatting op PC4-niveau voor de selecties (dict kolom -> waarden). Met
+        require_value tellen alleen gebieden met een marktaandeel mee, zoals bij een
+        bereikfilter dat het hele bereik omvat.
+        """
+        cells = np.ones(len(self), dtype=bool)
+        for column, values in selections.items():
+            if not values:
+                continue
+            lookup = np.zeros(len(self._categories[column]), dtype=bool)
+            codes = self._categories[column].get_indexer([str(value) for value in values])
+            lookup[codes[codes >= 0]] = True
+            cells &= lookup[self.cell_codes[column]]
+        if require_value:
+            cells &= self.cell_has_value
+
+        totals = {col: self.cells[col][cells].sum() for col in self.sum_columns}
+        reistijd_mean = 0
+        if self.has_reistijd:
+            reistijd_count = self.cells['_reistijd_count'][cells].sum()
+            reistijd_mean = self.cells['_reistijd_sum'][cells].sum() / reistijd_count if reistijd_count else np.nan
+        return build_summary(int(self.cells['_count'][cells].sum()), totals, reistijd_mean)
+
+
+class AggregationViews:
+    """
+    Alle frames en totalen voor één filterstand. Kaart, statistieken en ruwe data lezen
+    hieruit, zodat elke aggregatie per filterstand maar één keer wordt uitgevoerd.
+    De frames zijn gedeeld en mogen niet worden aangepast.
+
+    rollup is een optionele functie die de samenvatting op PC4-niveau uit de rollup-kubus
+    haalt (None als de filterstand daar niet uit af te leiden is).
+    """
+
+    def __init__(self, pc4_data, gemeente_geometry=None, rollup=None):
+        self.pc4 = pc4_data
+        self._gemeente_geometry = gemeente_geometry
+        self._rollup = rollup
+        self._gemeente = None
+        self._summaries = {}
+        self._rankings = {}
+        self._lock = threading.Lock()
+
+    @property
+    def gemeente(self):
+        with self._lock:
+            if self._gemeente is None:
+                with span("aggregate_to_gemeente"):
+                    self._gemeente = aggregate_to_gemeente(self.pc4, self._gemeente_geometry)
+            return self._gemeente
+
+    def frame(self, level):
+        return self.gemeente if level == LEVEL_GEMEENTE else self.pc4
+
+    def summary(self, level=LEVEL_PC4):
+        """Totalen en afgeleide percentages voor het gekozen niveau."""
+        with self._lock:
+            if level in self._summaries:
+                return self._summaries[level]
+        if level == LEVEL_PC4 and self._rollup is not None:
+            summary = self._rollup()
+        else:
+            data = self.frame(level)
+            totals = {col: data[col].sum() for col in CUBE_SUM_COLUMNS if col in data.columns}
+            reistijd_mean = data['reistijd_min'].mean() if 'reistijd_min' in data.columns else 0
+            summary = build_summary(len(data), totals, reistijd_mean)
+        with self._lock:
+            self._summaries[level] = summary
+        return summary
+
+    def _ranking_candidates(self, level, metric):
+        """Posities van gebieden met ten minste 1 sterfgeval en hun waarden voor de metriek."""
+        data = self.frame(level)
+        valid = np.flatnonzero(data['sterfte_2023'].to_numpy(dtype=float) > 0)
+        return valid, data[metric].to_numpy(dtype=float)[valid]
+
+    def _rows(self, level, positions):
+        """Alleen de gevraagde rijen, zonder geometrie."""
+        data = self.frame(level)
+        columns = [col for col in data.columns if col != 'geometry']
+        return pd.DataFrame(data.iloc[positions][columns])
+
+    def ranking(self, level, n=5, metric='berekend_marktaandeel_2023'):
+        """Hoogste en laagste n gebieden op de metriek (alleen gebieden met sterfte)."""
+        key = (level, n, metric)
+        with self._lock:
+            if key in self._rankings:
+                return self._rankings[key]
+        valid, values = self._ranking_candidates(level, metric)
+        top, bottom = top_bottom_positions(values, n)
+        result = (self._rows(level, valid[top]), self._rows(level, valid[bottom]))
+        with self._lock:
+            self._rankings[key] = result
+        return result
+
+    def ranking_by_group(self, level, group_column, n=3, metric='berekend_marktaandeel_2023'):
+        """
+        Hoogste en laagste n gebieden per groep (bijv. per provincie of cluster) als twee
+        DataFrames met de groep als eerste kolom.
+        """
+        key = (level, n, metric, group_column)
+        with self._lock:
+            if key in self._rankings:
+                return self._rankings[key]
+        data = self.frame(level)
+        valid, values = self._ranking_candidates(level, metric)
+        groups = data[group_column].iloc[valid].astype(object).fillna('Onbekend').astype(str)
+        per_group = grouped_top_bottom_positions(values, groups.to_numpy(), n)
+
+        tops = [valid[top] for top, _ in per_group.values()]
+        bottoms = [valid[bottom] for _, bottom in per_group.values()]
+        empty = np.empty(0, dtype=np.intp)
+        top_rows = self._rows(level, np.concatenate(tops) if tops else empty)
+        bottom_rows = self._rows(level, np.concatenate(bottoms) if bottoms else empty)
+        result = (top_rows, bottom_rows)
+        with self._lock:
+            self._rankings[key] = result
+        return result
@@ -1,19 +1,15 @@
 import streamlit as st
-import pandas as pd
-import geopandas as gpd
-import plotly.express as px
-import numpy as np
+import logging
 import os
-import tempfile
-from pathlib import Path
-import io
-
-# Aangepaste kleurenschalen
-# Rood naar groen via grijs voor numerieke data
-rood_grijs_groen_palette = ["#ff0000", "#ff4d4d", "#ff9999", "#ffcccc", "#e0e0e0", "#ccffcc", "#99ff99", "#4dff4d", "#00ff00"]
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+import profiling
+from upload_cache import (
+    upload_cache, content_key, digest_upload, local_shapefile_digests
+)
 
-# Behoud de originele Monuta palette voor categorische data
-monuta_palette = ["#3f582d", "#74975d", "#6e0038", "#d87f7e", "#d763a9", "#66b3c9"]
+# Aantal bewaarde metingen per sessie voor het debugpaneel
+PROFILE_HISTORY_RUNS = 50
 
 # Configuratie van de pagina
 st.set_page_config(
@@ -22,6 +18,39 @@ st.set_page_config(
     layout="wide"
 )
 
+# Meldingen van de modules (logging) naar de console en naar de meting van de rerun
+profiling.configure_logging()
+logger = logging.getLogger(__name__)
+
+def remember_profile(record):
+    """Bewaar een meting in de sessie (voor het debugpaneel en de export)."""
+    history = st.session_state.setdefault('profiling_runs', [])
+    history.append(record)
+    del history[:-PROFILE_HISTORY_RUNS]
+    return history
+
+def profiled_fragment(name):
+    """
+    st.fragment met meting: bij een rerun van alleen het paneel is er geen meting van de
+    hele pagina, dan wordt het paneel apart gemeten (label 'fragment: <naam>').
+    """
+    def decorator(function):
+        @wraps(function)
+        def run_fragment(*args, **kwargs):
+            if profiling.current() is not None:
+                return function(*args, **kwargs)
+            profiling.start_run(f"fragment: {name}")
+            try:
+                return function(*args, **kwargs)
+            finally:
+                remember_profile(profiling.finish_run())
+        return st.fragment(run_fragment)
+    return decorator
+
+# Tijd- en geheugenmeting van deze rerun (zie profiling.py)
+profiling.start_run()
+profiling.checkpoint("opstarten")
+
 # Titel en intro
 st.title("🗺️ Postcode 4 Dashboard Nederland")
 st.markdown("Dashboard voor visualisatie van gegevens op PC4-niveau in Nederland.")
@@ -35,6 +64,7 @@ has_local_shapefile = os.path.exists(shapefile_path)
 
 # Alleen Excel bestand is nodig voor upload (andere bestanden zijn in repository)
 uploaded_excel = st.sidebar.file_uploader("Upload het Excel bestand (PC4 verrijkt)", type=['xlsx'])
+uploaded_shapefile = uploaded_shx = uploaded_dbf = uploaded_prj = None
 
 if has_local_shapefile:
     st.sidebar.success("✅ Shapefile bestanden zijn geladen vanuit de repository")
@@ -46,363 +76,43 @@ else:
     uploaded_dbf = st.sidebar.file_uploader("Upload het DBF bestand (.dbf)", type=['dbf'])
     uploaded_prj = st.sidebar.file_uploader("Upload het PRJ bestand (.prj)", type=['prj'], accept_multiple_files=False)
 
-# Functie om tijdelijke bestanden aan te maken van uploads
+# Titel en uploadvelden staan nu in de browser
+profiling.first_paint()
+
+# Functie om uploads op te slaan onder een map die naar de inhoud is vernoemd.
+# Hierdoor blijven paden en cache-sleutel gelijk zolang dezelfde bestanden zijn geüpload.
 def save_uploaded_files():
-    temp_dir = tempfile.mkdtemp()
-    excel_path = None
-    shapefile_path = None
+    files = {}
+    shapefile_digests = {}
     
-    # Sla Excel bestand op
+    # Excel bestand
     if uploaded_excel is not None:
-        excel_path = os.path.join(temp_dir, "pc4_verrijkt.xlsx")
-        with open(excel_path, "wb") as f:
-            f.write(uploaded_excel.getbuffer())
+        files["pc4_verrijkt.xlsx"] = uploaded_excel
+    excel_digest = digest_upload(uploaded_excel) if uploaded_excel is not None else ""
     
     # Als de shapefile lokaal beschikbaar is, gebruik die
     if has_local_shapefile:
-        shapefile_path = "data/PC4.shp"
+        shapefile_digests = local_shapefile_digests(shapefile_path)
     # Anders gebruik de uploads
-    elif 'uploaded_shapefile' in locals() and uploaded_shapefile is not None:
-        shapefile_path = os.path.join(temp_dir, "PC4.shp")
-        with open(shapefile_path, "wb") as f:
-            f.write(uploaded_shapefile.getbuffer())
-            
-        # SHX bestand
-        if 'uploaded_shx' in locals() and uploaded_shx is not None:
-            shx_path = os.path.join(temp_dir, "PC4.shx")
-            with open(shx_path, "wb") as f:
-                f.write(uploaded_shx.getbuffer())
-        
-        # DBF bestand
-        if 'uploaded_dbf' in locals() and uploaded_dbf is not None:
-            dbf_path = os.path.join(temp_dir, "PC4.dbf")
-            with open(dbf_path, "wb") as f:
-                f.write(uploaded_dbf.getbuffer())
-        
-        # PRJ bestand
-        if 'uploaded_prj' in locals() and uploaded_prj is not None:
-            prj_path = os.path.join(temp_dir, "PC4.prj")
-            with open(prj_path, "wb") as f:
-                f.write(uploaded_prj.getbuffer())
-    
-    return temp_dir, excel_path, shapefile_path
-
-# Functie om data in te laden
-@st.cache_data
-def load_data(excel_path, shapefile_path):
-    try:
-        # Controleer of bestanden bestaan
-        if not os.path.exists(excel_path):
-            st.error(f"Excel bestand niet gevonden: {excel_path}")
-            return pd.DataFrame(), gpd.GeoDataFrame(), gpd.GeoDataFrame()
-            
-        if not os.path.exists(shapefile_path):
-            st.error(f"Shapefile niet gevonden: {shapefile_path}")
-            return pd.DataFrame(), gpd.GeoDataFrame(), gpd.GeoDataFrame()
-        
-        # Check of de benodigde shape-bestanden bestaan
-        shapefile_dir = os.path.dirname(shapefile_path)
-        shapefile_name = os.path.splitext(os.path.basename(shapefile_path))[0]
-        
-        # Controleer of .shx bestand bestaat
-        shx_path = os.path.join(shapefile_dir, f"{shapefile_name}.shx")
-        if not os.path.exists(shx_path):
-            shx_path_upper = os.path.join(shapefile_dir, f"{shapefile_name}.SHX")
-            if not os.path.exists(shx_path_upper):
-                st.warning(f".shx bestand ontbreekt voor shapefile. Probeer het shapefile opnieuw te uploaden met alle bijbehorende bestanden.")
-                
-        # Data inladen
-        df = pd.read_excel(excel_path)
-        
-        # Zorg dat postcode kolom PC4 heet in het excel bestand
-        if 'PC4' not in df.columns and 'pc4' in df.columns:
-            df = df.rename(columns={'pc4': 'PC4'})  # Hernoem 'pc4' naar 'PC4' indien nodig
-        
-        # Log de eerste paar rijen en kolomnamen om te helpen bij debugging
-        print("Excel kolommen:", df.columns.tolist())
-        print("Eerste 3 rijen van Excel:")
-        print(df.head(3))
-        
-        # Controleer of de PC4 kolom bestaat
-        if 'PC4' not in df.columns:
-            st.error("Kolom 'PC4' niet gevonden in Excel bestand. Beschikbare kolommen: " + ", ".join(df.columns.tolist()))
-            return pd.DataFrame(), gpd.GeoDataFrame(), gpd.GeoDataFrame()
-        
-        # Probeer expliciete configuratie voor het herstellen van het .shx bestand
-        os.environ['SHAPE_RESTORE_SHX'] = 'YES'
-        
-        # Shapefile inladen met foutafvang
-        try:
-            netherlands = gpd.read_file(shapefile_path)
-        except Exception as e:
-            st.error(f"Fout bij het laden van het shapefile: {e}. Controleer of alle benodigde bestanden (.shp, .shx, .dbf) zijn geüpload.")
-            return df, gpd.GeoDataFrame(), gpd.GeoDataFrame()
-        
-        # Log de eerste paar rijen en kolomnamen van de shapefile
-        print("Shapefile kolommen:", netherlands.columns.tolist())
-        print("Eerste 3 rijen van Shapefile:")
-        print(netherlands.head(3))
-        
-        # Controleer of de PC4 kolom bestaat in de shapefile
-        if 'PC4' not in netherlands.columns:
-            # Probeer andere mogelijke namen voor postcode kolom
-            potential_pc4_columns = [col for col in netherlands.columns if 'pc' in col.lower() or 'post' in col.lower()]
-            if potential_pc4_columns:
-                netherlands = netherlands.rename(columns={potential_pc4_columns[0]: 'PC4'})
-                print(f"Hernoemd shapefile kolom '{potential_pc4_columns[0]}' naar 'PC4'")
-            else:
-                st.error("Kolom 'PC4' niet gevonden in Shapefile. Beschikbare kolommen: " + ", ".join(netherlands.columns.tolist()))
-                return pd.DataFrame(), gpd.GeoDataFrame(), gpd.GeoDataFrame()
-        
-        # Vereenvoudig de geometrieën voor betere performance
-        netherlands['geometry'] = netherlands['geometry'].simplify(tolerance=0.001, preserve_topology=True)
-        
-        # Zorg dat PC4 als string is opgeslagen in beide dataframes
-        netherlands['PC4'] = netherlands['PC4'].astype(str)
-        df['PC4'] = df['PC4'].astype(str)
-        
-        # Verwijder rijen met ontbrekende woonplaats zoals gevraagd
-        if 'woonplaats' in df.columns:
-            df = df.dropna(subset=['woonplaats'])
-        
-        # Controleer welke kolommen daadwerkelijk bestaan in het dataframe
-        expected_columns = ['provincie', 'gemeente', 'woonplaats', 'cluster', 'voorstel_benaming_uvb', 'voorstel_onderneming']
-        existing_columns = [col for col in expected_columns if col in df.columns]
-        
-        # Log welke kolommen ontbreken
-        missing_columns = [col for col in expected_columns if col not in df.columns]
-        if missing_columns:
-            print(f"Waarschuwing: Deze kolommen ontbreken in het dataframe: {missing_columns}")
-            
-        # Alleen filteren op bestaande kolommen
-        if existing_columns:
-            df = df.dropna(subset=existing_columns)
-        
-        # Merge de datasets
-        print(f"Aantal rijen voor merge - Excel: {len(df)}, Shapefile: {len(netherlands)}")
-        merged_data = netherlands.merge(df, on='PC4', how='inner')
-        print(f"Aantal rijen na merge: {len(merged_data)}")
-        
-        if len(merged_data) == 0:
-            st.error("Geen overeenkomende postcodes gevonden bij het mergen van de datasets!")
-            # Toon een paar waarden om te helpen debuggen
-            print("Voorbeeld PC4 waarden in Excel:", df['PC4'].head(10).tolist())
-            print("Voorbeeld PC4 waarden in Shapefile:", netherlands['PC4'].head(10).tolist())
-            
-            return df, netherlands, gpd.GeoDataFrame()
-        
-        # Controleer of merged_data de PC4 kolom bevat
-        if 'PC4' not in merged_data.columns:
-            st.error("Na het mergen ontbreekt de 'PC4' kolom. Dit is onverwacht.")
-            return df, netherlands, merged_data
-        
-        # Aanwezigheid van belangrijke kolommen controleren en eventueel defaults instellen
-        for col in ['inwoners', 'sterfte_2023', 'uitvaarten_2023', 'uitvaarten_2024', 'uitvaarten_2025', 'aantal_verzekerden', 'reistijd_min']:
-            if col not in merged_data.columns:
-                print(f"Kolom {col} ontbreekt in de data en wordt aangemaakt met default waarden.")
-                merged_data[col] = 0
-        
-        return df, netherlands, merged_data
-    except Exception as e:
-        import traceback
-        st.error(f"Fout bij het laden van de data: {e}")
-        print("Gedetailleerde foutmelding:")
-        print(traceback.format_exc())
-        # Terugvallen op lege dataframes als de data niet kan worden geladen
-        return pd.DataFrame(), gpd.GeoDataFrame(), gpd.GeoDataFrame()
-
-# Functies voor het berekenen van afgeleide metrieken
-def calculate_derived_metrics(data):
-    # Maak kopie om originele data niet te wijzigen
-    data = data.copy()
-    
-    # Marktaandeel 2023 berekenen
-    if 'uitvaarten_2023' in data.columns and 'sterfte_2023' in data.columns:
-        # Voorkom delen door nul
-        data['berekend_marktaandeel_2023'] = np.where(
-            data['sterfte_2023'] > 0,
-            data['uitvaarten_2023'] / data['sterfte_2023'] * 100,
-            0
-        )
-    
-    # Percentage verzekerden berekenen
-    if 'aantal_verzekerden' in data.columns and 'inwoners' in data.columns:
-        data['percentage_verzekerden'] = np.where(
-            data['inwoners'] > 0,
-            data['aantal_verzekerden'] / data['inwoners'] * 100,
-            0
-        )
-    
-    return data
-
-# Vervang de huidige aggregate_to_gemeente functie met deze robuustere versie
-
-def aggregate_to_gemeente(data):
-    """
-    Aggregeert data van PC4-niveau naar gemeenteniveau met uitgebreide foutenafhandeling.
-    Probeert meerdere methoden om geometrieën samen te voegen, met fallbacks.
-    """
-    if 'gemeente' not in data.columns:
-        st.warning("Gemeente kolom niet gevonden, kan niet aggregeren.")
-        return data
-    
-    # Maak een kopie om de originele data niet te wijzigen
-    data_copy = data.copy()
-    
-    # Aggregeer de numerieke kolommen
-    numeric_columns = [
-        'inwoners', 'sterfte_2023', 'uitvaarten_2023', 
-        'uitvaarten_2024', 'uitvaarten_2025', 'aantal_verzekerden',
-        'reistijd_min'
-    ]
-    
-    # Selecteer alleen bestaande kolommen
-    numeric_columns = [col for col in numeric_columns if col in data_copy.columns]
-    
-    # Groeperen op gemeente en aggregeren
-    gemeente_aggs = {}
-    
-    # Voor numerieke kolommen die opgeteld moeten worden
-    for col in numeric_columns:
-        if col in data_copy.columns:
-            gemeente_aggs[col] = 'sum'
-    
-    if 'reistijd_min' in data_copy.columns:
-        gemeente_aggs['reistijd_min'] = 'mean'  # Gemiddelde reistijd
-    
-    # Aggregeer op gemeente
-    gemeente_data = data_copy.groupby('gemeente').agg(gemeente_aggs).reset_index()
-    
-    # Bereken de afgeleide metrics opnieuw
-    if 'sterfte_2023' in gemeente_data.columns and 'uitvaarten_2023' in gemeente_data.columns:
-        gemeente_data['berekend_marktaandeel_2023'] = np.where(
-            gemeente_data['sterfte_2023'] > 0,
-            gemeente_data['uitvaarten_2023'] / gemeente_data['sterfte_2023'] * 100,
-            0
-        )
+    else:
+        for ext, uploaded in ((".shp", uploaded_shapefile), (".shx", uploaded_shx),
+                              (".dbf", uploaded_dbf), (".prj", uploaded_prj)):
+            if uploaded is not None:
+                files[f"PC4{ext}"] = uploaded
+                shapefile_digests[ext] = digest_upload(uploaded)
     
-    # Percentage verzekerden berekenen
-    if 'aantal_verzekerden' in gemeente_data.columns and 'inwoners' in gemeente_data.columns:
-        gemeente_data['percentage_verzekerden'] = np.where(
-            gemeente_data['inwoners'] > 0,
-            gemeente_data['aantal_verzekerden'] / gemeente_data['inwoners'] * 100,
-            0
-        )
+    cache_key = content_key(excel_digest, shapefile_digests)
+    entry_dir = upload_cache.materialise(cache_key, files)
     
-    # Maak een GeoPandas dataframe van het resultaat
-    # Voor visualisatie hebben we geometrie nodig
-    if isinstance(data, gpd.GeoDataFrame):
-        try:
-            # METHODE 1: Probeer eerst de standaard methode maar met een hogere simplificatie
-            # Maak een kopie met sterk vereenvoudigde geometrieën
-            simple_data = data.copy()
-            # Vereenvoudig geometrieën agressiever voor dissolve
-            simple_data['geometry'] = simple_data['geometry'].simplify(tolerance=0.01, preserve_topology=True)
-            # Buffer met nul om kleine inconsistenties te repareren
-            simple_data['geometry'] = simple_data['geometry'].buffer(0)
-            
-            gemeente_geometries = simple_data.dissolve(by='gemeente')
-            
-            # Samenvoegen van de geaggregeerde data met de geometrieën
-            gemeente_gdf = gpd.GeoDataFrame(
-                gemeente_data.merge(gemeente_geometries.reset_index()[['gemeente', 'geometry']], on='gemeente'),
-                geometry='geometry'
-            )
-            
-            st.success("Gemeenteniveau kaart succesvol gemaakt met vereenvoudigde geometrieën.")
-            return gemeente_gdf
-            
-        except Exception as e1:
-            st.warning(f"Fout bij het samenvoegen van vereenvoudigde geometrieën: {type(e1).__name__}. Probeer methode 2.")
-            
-            try:
-                # METHODE 2: Probeer de dissolve per gemeente apart uit te voeren
-                gemeentes = data['gemeente'].unique()
-                all_geoms = []
-                
-                for gemeente in gemeentes:
-                    try:
-                        # Selecteer alle PC4-gebieden in deze gemeente
-                        gemeente_data_subset = data[data['gemeente'] == gemeente]
-                        # Probeer deze samen te voegen tot één geometrie
-                        if len(gemeente_data_subset) > 0:
-                            # Gebruik simplify en buffer om problemen te verminderen
-                            gemeente_geom = gemeente_data_subset['geometry'].simplify(0.01).buffer(0)
-                            # Probeer unary_union uit te voeren
-                            try:
-                                merged_geom = gemeente_geom.unary_union
-                                all_geoms.append((gemeente, merged_geom))
-                            except:
-                                # Als unary_union faalt, neem gewoon de eerste geometrie
-                                all_geoms.append((gemeente, gemeente_geom.iloc[0]))
-                    except:
-                        # Bij fouten, sla deze gemeente over
-                        continue
-                
-                if all_geoms:
-                    # Maak een nieuwe GeoDataFrame met de verzamelde geometrieën
-                    gemeente_gdf_from_parts = gpd.GeoDataFrame(
-                        [(g[0], g[1]) for g in all_geoms], 
-                        columns=['gemeente', 'geometry'],
-                        geometry='geometry'
-                    )
-                    
-                    # Samenvoegen met de geaggregeerde data
-                    gemeente_gdf = gpd.GeoDataFrame(
-                        gemeente_data.merge(gemeente_gdf_from_parts, on='gemeente'),
-                        geometry='geometry'
-                    )
-                    
-                    st.success("Gemeenteniveau kaart succesvol gemaakt met per-gemeente verwerking.")
-                    return gemeente_gdf
-                else:
-                    raise Exception("Geen geometrieën konden worden samengevoegd")
-                    
-            except Exception as e2:
-                st.warning(f"Fout bij methode 2 voor geometrieën: {type(e2).__name__}. Probeer methode 3.")
-                
-                try:
-                    # METHODE 3: Gebruik de centroïde van elke gemeente als punt
-                    # Groepeer per gemeente en bereken de gemiddelde centroïde
-                    gemeente_centroids = {}
-                    
-                    for gemeente in data['gemeente'].unique():
-                        gemeente_data_subset = data[data['gemeente'] == gemeente]
-                        if len(gemeente_data_subset) > 0:
-                            # Bereken een representatief punt voor deze gemeente
-                            points = [geom.centroid for geom in gemeente_data_subset['geometry']]
-                            x_coords = [p.x for p in points]
-                            y_coords = [p.y for p in points]
-                            # Gemiddelde coördinaat
-                            avg_x = sum(x_coords) / len(x_coords)
-                            avg_y = sum(y_coords) / len(y_coords)
-                            from shapely.geometry import Point
-                            gemeente_centroids[gemeente] = Point(avg_x, avg_y)
-                    
-                    # Maak een GeoDataFrame met de centroïde-punten
-                    gemeente_points = gpd.GeoDataFrame(
-                        [(gemeente, centroid) for gemeente, centroid in gemeente_centroids.items()], 
-                        columns=['gemeente', 'geometry'],
-                        geometry='geometry'
-                    )
-                    
-                    # Samenvoegen met de geaggregeerde data
-                    gemeente_gdf = gpd.GeoDataFrame(
-                        gemeente_data.merge(gemeente_points, on='gemeente'),
-                        geometry='geometry'
-                    )
-                    
-                    st.warning("Gemeenteniveau kaart gemaakt met centroïden (punten) in plaats van polygonen.")
-                    return gemeente_gdf
-                    
-                except Exception as e3:
-                    st.error(f"Alle methoden voor het maken van gemeenteniveau geometrieën zijn mislukt: {type(e3).__name__}.")
-                    # Als alle methodes mislukken, retourneer de data zonder geometrieën
-                    return gemeente_data
+    excel_path = os.path.join(entry_dir, "pc4_verrijkt.xlsx") if uploaded_excel is not None else None
+    if has_local_shapefile:
+        local_shapefile_path = shapefile_path
+    elif uploaded_shapefile is not None:
+        local_shapefile_path = os.path.join(entry_dir, "PC4.shp")
     else:
-        # Als het geen GeoDataFrame is, geef een waarschuwing
-        st.warning("Kan geen kaart maken zonder geometrie data.")
-        return gemeente_data
+        local_shapefile_path = None
+    
+    return cache_key, excel_path, local_shapefile_path
 
 # Controleer of de benodigde bestanden beschikbaar zijn
 can_load_data = False
@@ -410,16 +120,10 @@ can_load_data = False
 if uploaded_excel is not None:
     if has_local_shapefile:
         can_load_data = True
-    elif 'uploaded_shapefile' in locals() and 'uploaded_shx' in locals() and 'uploaded_dbf' in locals() and \
-         uploaded_shapefile is not None and uploaded_shx is not None and uploaded_dbf is not None:
+    elif uploaded_shapefile is not None and uploaded_shx is not None and uploaded_dbf is not None:
         can_load_data = True
 
-if can_load_data:
-    # Data laden met een spinner om te laten zien dat het bezig is
-    with st.spinner('Data wordt geladen...'):
-        temp_dir, excel_path, shapefile_path = save_uploaded_files()
-        df, netherlands, merged_data = load_data(excel_path, shapefile_path)
-else:
+if not can_load_data:
     # Toon intro bericht als bestanden niet zijn geüpload
     st.info("⚠️ Upload het Excel bestand om de applicatie te gebruiken")
     
@@ -437,17 +141,178 @@ else:
              caption="Upload de benodigde bestanden om de interactieve kaart te zien")
     st.stop()
 
+# Zware modules (pandas, geopandas, scipy via de datamodules) pas importeren als er data is:
+# titel en sidebar staan dan al in de browser. Na de eerste run zitten ze in sys.modules;
+# met warmup.py zijn ze al geïmporteerd voordat de eerste gebruiker verbinding maakt.
+profiling.checkpoint("imports")
+import pandas as pd
+import geopandas as gpd
+from aggregation import (
+    AggregationViews, LEVEL_GEMEENTE, LEVEL_PC4, RollupCube, summary_table
+)
+from export import EXPORT_FORMATS, export_cache
+from filters import FilterEngine
+from map_layers import ROOD_GRIJS_GROEN_PALETTE, layer_ids
+from spatial_index import SpatialIndex, location_columns, parse_locations
+from adjacency import NEIGHBOURHOOD_METRICS
+from map_figure import MAP_MODES, MAP_WORKERS, MapJobs, build_map_figure, image_cache, use_raster
+from catchment import DEFAULT_MAX_MINUTES, MODES as CATCHMENT_MODES, SPEED_KMH, CatchmentEngine
+from sql_engine import QUERY_BACKEND, SqlEngine, SqlViews, available as sql_available, compare_views
+from pc4_data import (
+    DataLoadError, load_adjacency, load_dataset, load_gemeente_geometry, load_geometry_pyramid, load_topology
+)
+
+# Afgeleide frames delen de kolommen van de gedeelde dataset tot ze worden aangepast
+# (Copy-on-Write, standaard vanaf pandas 3)
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+
+# Functie om data in te laden (uit de snapshot als die er is, zie pc4_data.py).
+# Alleen cache_key bepaalt de cache; de paden (met underscore) worden niet gehasht.
+# cache_resource: alle sessies delen één exemplaar (cache_data zou per aanroep een kopie
+# teruggeven). De dataset is daarom alleen-lezen; sessies werken met maskers erop.
+# Fouten worden buiten de cache afgehandeld: een exception wordt niet gecachet, zodat de
+# volgende rerun het opnieuw probeert (een leeg dataframe zou voorgoed in de cache blijven).
+@profiling.count_calls('load_data')
+@st.cache_resource(max_entries=4, show_spinner=False)
+@profiling.count_misses('load_data')
+def load_data(cache_key, _excel_path, _shapefile_path):
+    # Compacte types (categoricals, kleine integers) en afgeleide metrieken één keer per dataset
+    return load_dataset(_excel_path, _shapefile_path, cache_key=cache_key, warn=st.warning)
+
+# Gedeelde grenzen (arcs) van de PC4-laag; bron voor gemeentegrenzen en detailniveaus
+@profiling.count_calls('get_topology')
+@st.cache_resource(max_entries=4, show_spinner=False)
+@profiling.count_misses('get_topology')
+def get_topology(cache_key, _merged_data):
+    try:
+        return load_topology(_merged_data, cache_key)
+    except Exception as e:
+        logger.warning(f"Topologie kon niet worden opgebouwd: {e}")
+        return None
+
+# Gemeentegrenzen hangen niet af van de filters: eenmalig per dataset berekenen (en opslaan)
+@profiling.count_calls('get_gemeente_geometry')
+@st.cache_resource(max_entries=4, show_spinner=False)
+@profiling.count_misses('get_gemeente_geometry')
+def get_gemeente_geometry(cache_key, _merged_data):
+    if 'gemeente' not in _merged_data.columns:
+        return None
+    try:
+        return load_gemeente_geometry(_merged_data, cache_key, get_topology(cache_key, _merged_data))
+    except Exception as e:
+        logger.warning(f"Gemeentegrenzen konden niet worden berekend: {e}")
+        return None
+
+# Categorische filterkolommen en bitmaps per waarde, eenmalig per dataset
+@profiling.count_calls('get_filter_engine')
+@st.cache_resource(max_entries=4, show_spinner=False)
+@profiling.count_misses('get_filter_engine')
+def get_filter_engine(cache_key, _merged_data):
+    return FilterEngine(_merged_data)
+
+# Eén set aggregaties per filterstand, gedeeld door kaart, statistieken en ruwe data. Het
+# masker wordt alleen hier op de dataset toegepast, dus sessies met dezelfde filterstand
+# delen ook de gefilterde rijen.
+@profiling.count_calls('get_aggregation_views')
+@st.cache_resource(max_entries=32, show_spinner=False)
+@profiling.count_misses('get_aggregation_views')
+def get_aggregation_views(cache_key, filter_state, _merged_data, _filter_engine, _filter_mask, _gemeente_geometry, _rollup=None):
+    return AggregationViews(_filter_engine.take(_merged_data, _filter_mask), _gemeente_geometry, _rollup)
+
+# Dezelfde aggregaties als queries in DuckDB (optioneel, zie sql_engine.py). De tabel wordt
+# eenmalig per dataset opgebouwd; zonder duckdb valt de app terug op pandas.
+@profiling.count_calls('get_sql_engine')
+@st.cache_resource(max_entries=4, show_spinner=False)
+@profiling.count_misses('get_sql_engine')
+def get_sql_engine(cache_key, _merged_data, _filter_engine):
+    try:
+        return SqlEngine(_merged_data, _filter_engine)
+    except Exception as e:
+        logger.warning(f"DuckDB kan niet worden gebruikt, terugvallen op pandas: {e}")
+        return None
+
+@profiling.count_calls('get_sql_views')
+@st.cache_resource(max_entries=32, show_spinner=False)
+@profiling.count_misses('get_sql_views')
+def get_sql_views(cache_key, filter_state, _merged_data, _sql_engine, _selections, _ranges, _gemeente_geometry):
+    return SqlViews(_sql_engine, _merged_data, _selections, _ranges, _gemeente_geometry)
+
+# Totalen per combinatie van filterwaarden, eenmalig per dataset
+@profiling.count_calls('get_rollup_cube')
+@st.cache_resource(max_entries=4, show_spinner=False)
+@profiling.count_misses('get_rollup_cube')
+def get_rollup_cube(cache_key, _merged_data, _filter_engine):
+    try:
+        return RollupCube(_merged_data, _filter_engine)
+    except Exception as e:
+        logger.warning(f"Rollup-kubus kon niet worden opgebouwd: {e}")
+        return None
+
+# Detailniveaus en GeoJSON per kaartlaag één keer opbouwen; filterwijzigingen sturen alleen locaties en waarden
+@profiling.count_calls('get_geometry_pyramid')
+@st.cache_resource(max_entries=8, show_spinner=False)
+@profiling.count_misses('get_geometry_pyramid')
+def get_geometry_pyramid(cache_key, level, _data, _id_column, _topology=None, _groups=None):
+    return load_geometry_pyramid(
+        level, layer_ids(_data, _id_column), _data.geometry.values, cache_key,
+        topology=_topology, groups=_groups
+    )
+
+# Ruimtelijke index over de PC4-vormen (punt -> PC4, selectie op de kaart), eenmalig per dataset
+@profiling.count_calls('get_spatial_index')
+@st.cache_resource(max_entries=4, show_spinner=False)
+@profiling.count_misses('get_spatial_index')
+def get_spatial_index(cache_key, _merged_data):
+    return SpatialIndex(_merged_data.geometry.values, _merged_data['PC4'])
+
+# Threads voor het opbouwen van de kaartfiguur, gedeeld door alle sessies
+@st.cache_resource(show_spinner=False)
+def get_map_executor():
+    return ThreadPoolExecutor(max_workers=MAP_WORKERS, thread_name_prefix='kaart')
+
+# Burengraaf (CSR) van de PC4-gebieden; bij het laden van de dataset al in de snapshotmap gezet
+@profiling.count_calls('get_adjacency')
+@st.cache_resource(max_entries=4, show_spinner=False)
+@profiling.count_misses('get_adjacency')
+def get_adjacency(cache_key, _merged_data, _topology=None):
+    return load_adjacency(_merged_data, cache_key, _topology)
+
+# Punten, KD-tree en reistijdgraaf voor de reistijdanalyse, eenmalig per dataset
+@profiling.count_calls('get_catchment_engine')
+@st.cache_resource(max_entries=4, show_spinner=False)
+@profiling.count_misses('get_catchment_engine')
+def get_catchment_engine(cache_key, _merged_data, _topology=None):
+    return CatchmentEngine(_merged_data, get_adjacency(cache_key, _merged_data, _topology))
+
+profiling.checkpoint("data laden")
+# Data laden met een spinner om te laten zien dat het bezig is
+with st.spinner('Data wordt geladen...'):
+    cache_key, excel_path, data_shapefile_path = save_uploaded_files()
+    try:
+        merged_data = load_data(cache_key, excel_path, data_shapefile_path)
+    except DataLoadError as e:
+        st.error(str(e))
+        merged_data = gpd.GeoDataFrame()
+    except Exception as e:
+        st.error(f"Fout bij het laden van de data: {e}")
+        logger.exception("Gedetailleerde foutmelding:")
+        # Terugvallen op een leeg dataframe als de data niet kan worden geladen
+        merged_data = gpd.GeoDataFrame()
+
 # Controleer of we geldige data hebben ontvangen
 if len(merged_data) == 0:
     st.error("Geen data beschikbaar. Controleer de console voor meer informatie.")
     st.stop()  # Stop de uitvoering van de app
 
-# Bereken afgeleide metrieken
-merged_data = calculate_derived_metrics(merged_data)
+gemeente_geometry = get_gemeente_geometry(cache_key, merged_data)
+spatial_index = get_spatial_index(cache_key, merged_data) if 'PC4' in merged_data.columns else None
 
 # Definieer column_mapping voor visualisatie en filtering
 column_mapping = {
     "Marktaandeel 2023": "berekend_marktaandeel_2023",
+    "Marktaandeel 2023 (incl. buren)": "marktaandeel_buren",
+    "Marktaandeel 2023 (aaneengesloten regio)": "marktaandeel_regio",
     "Inwoners": "inwoners",
     "Sterfte 2023": "sterfte_2023",
     "Uitvaarten 2023": "uitvaarten_2023",
@@ -459,34 +324,68 @@ column_mapping = {
 }
 
 # Sidebar-filters
+profiling.checkpoint("filters")
 st.sidebar.header("Filters")
 st.sidebar.info(f"Dataset bevat {len(merged_data)} postcodegebieden")
 
-# Initialiseer filtered_data met merged_data
-filtered_data = merged_data.copy()
+# Filters werken op maskers; pas het eindmasker wordt op de data (met geometrie) toegepast
+filter_engine = get_filter_engine(cache_key, merged_data)
+filter_mask = filter_engine.full_mask()
+
+def set_pc4_filter(pc4_values):
+    """Zet de selectie van het PC4-filter (callback, dus vóór de rerun waarin het filter wordt getekend)."""
+    known = set(filter_engine.options('PC4'))
+    st.session_state['pc4_filter'] = sorted(str(value) for value in set(pc4_values) if str(value) in known)
+
+def apply_map_selection():
+    """Gebieden die op de kaart zijn aangeklikt of met een rechthoek/lasso geselecteerd."""
+    points = st.session_state['kaart'].selection.get('points', [])
+    locations = [point['location'] for point in points if point.get('location') is not None]
+    coordinates = [(point['lon'], point['lat']) for point in points if 'location' not in point and 'lon' in point]
+    if st.session_state.get('kaart_afbeelding'):
+        # Kaart als afbeelding: de punten erboven dragen het id van hun gebied
+        locations = [point['customdata'][0] for point in points if point.get('customdata')]
+        coordinates = []
+    if st.session_state.get('kaart_niveau') == LEVEL_GEMEENTE:
+        # Gemeenten op de kaart: alle PC4-gebieden van die gemeenten
+        locations = filter_engine.options('PC4', filter_engine.select('gemeente', locations)) if locations else []
+    if coordinates and spatial_index is not None:
+        lon, lat = zip(*coordinates)
+        locations += [pc4 for pc4 in spatial_index.locate(lon, lat) if pc4 is not None]
+    if locations:
+        set_pc4_filter(locations)
+        # Het PC4-filter staat in de sidebar: na deze fragment-rerun volgt een volledige rerun
+        st.session_state['kaart_filter_gewijzigd'] = True
+# Selecties van de filters tot nu toe; bepalen de (gecachte) keuzelijsten van de volgende
+upstream_selections = ()
+selected_pc4 = selected_provincies = selected_gemeenten = selected_woonplaatsen = []
+selected_clusters = selected_ondernemingen = selected_uvbs = []
+value_range = None
+value_range_active = False
 
 # Multi-level filters in de sidebar
 filter_container = st.sidebar.expander("Geografische filters", expanded=True)
 
 with filter_container:
     # PC4 filter (nieuw)
-    if 'PC4' in filtered_data.columns:
-        pc4_values = sorted(filtered_data['PC4'].unique().tolist())
+    if 'PC4' in filter_engine:
+        pc4_values = filter_engine.cascade_options('PC4', upstream_selections)
         selected_pc4 = st.multiselect(
             "Filter op PC4:",
             pc4_values,
-            default=[]
+            key='pc4_filter',
+            help="Ook te vullen door gebieden op de kaart te selecteren (klik, rechthoek of lasso)."
         )
         
         # Filter data op PC4 als er een selectie is gemaakt
-        if selected_pc4:
-            filtered_data = filtered_data[filtered_data['PC4'].isin(selected_pc4)]
+        filter_mask = filter_engine.restrict(filter_mask, 'PC4', selected_pc4)
+        upstream_selections += (('PC4', tuple(selected_pc4)),)
     else:
         st.warning("Geen PC4 kolom gevonden in de data. PC4 filter is niet beschikbaar.")
     
     # Provincie filter (multi-select)
-    if 'provincie' in filtered_data.columns:
-        provincie_values = sorted(filtered_data['provincie'].fillna('Onbekend').astype(str).unique().tolist())
+    if 'provincie' in filter_engine:
+        provincie_values = filter_engine.cascade_options('provincie', upstream_selections)
         selected_provincies = st.multiselect(
             "Filter op provincie:",
             provincie_values,
@@ -494,12 +393,12 @@ with filter_container:
         )
         
         # Filter data op provincie als er een selectie is gemaakt
-        if selected_provincies:
-            filtered_data = filtered_data[filtered_data['provincie'].isin(selected_provincies)]
+        filter_mask = filter_engine.restrict(filter_mask, 'provincie', selected_provincies)
+        upstream_selections += (('provincie', tuple(selected_provincies)),)
     
     # Gemeente filter (multi-select, afhankelijk van provincie selectie)
-    if 'gemeente' in filtered_data.columns:
-        gemeente_values = sorted(filtered_data['gemeente'].fillna('Onbekend').astype(str).unique().tolist())
+    if 'gemeente' in filter_engine:
+        gemeente_values = filter_engine.cascade_options('gemeente', upstream_selections)
         selected_gemeenten = st.multiselect(
             "Filter op gemeente:",
             gemeente_values,
@@ -507,12 +406,12 @@ with filter_container:
         )
         
         # Filter data op gemeente als er een selectie is gemaakt
-        if selected_gemeenten:
-            filtered_data = filtered_data[filtered_data['gemeente'].isin(selected_gemeenten)]
+        filter_mask = filter_engine.restrict(filter_mask, 'gemeente', selected_gemeenten)
+        upstream_selections += (('gemeente', tuple(selected_gemeenten)),)
     
     # Woonplaats filter (multi-select, afhankelijk van gemeente selectie)
-    if 'woonplaats' in filtered_data.columns:
-        woonplaats_values = sorted(filtered_data['woonplaats'].fillna('Onbekend').astype(str).unique().tolist())
+    if 'woonplaats' in filter_engine:
+        woonplaats_values = filter_engine.cascade_options('woonplaats', upstream_selections)
         selected_woonplaatsen = st.multiselect(
             "Filter op woonplaats:",
             woonplaats_values,
@@ -520,12 +419,12 @@ with filter_container:
         )
         
         # Filter data op woonplaats als er een selectie is gemaakt
-        if selected_woonplaatsen:
-            filtered_data = filtered_data[filtered_data['woonplaats'].isin(selected_woonplaatsen)]
+        filter_mask = filter_engine.restrict(filter_mask, 'woonplaats', selected_woonplaatsen)
+        upstream_selections += (('woonplaats', tuple(selected_woonplaatsen)),)
     
     # Cluster filter (nieuw, multi-select) - alleen als kolom bestaat
-    if 'cluster' in filtered_data.columns:
-        cluster_values = sorted(filtered_data['cluster'].fillna('Onbekend').astype(str).unique().tolist())
+    if 'cluster' in filter_engine:
+        cluster_values = filter_engine.cascade_options('cluster', upstream_selections)
         selected_clusters = st.multiselect(
             "Filter op cluster:",
             cluster_values,
@@ -533,16 +432,16 @@ with filter_container:
         )
         
         # Filter op cluster als er een selectie is gemaakt
-        if selected_clusters:
-            filtered_data = filtered_data[filtered_data['cluster'].isin(selected_clusters)]
+        filter_mask = filter_engine.restrict(filter_mask, 'cluster', selected_clusters)
+        upstream_selections += (('cluster', tuple(selected_clusters)),)
 
 # Organisatie filters
 organisatie_container = st.sidebar.expander("Organisatie filters", expanded=False)
 
 with organisatie_container:
     # Voorstel onderneming filter (nieuw) - alleen als kolom bestaat
-    if 'voorstel_onderneming' in filtered_data.columns:
-        onderneming_values = sorted(filtered_data['voorstel_onderneming'].fillna('Onbekend').astype(str).unique().tolist())
+    if 'voorstel_onderneming' in filter_engine:
+        onderneming_values = filter_engine.cascade_options('voorstel_onderneming', upstream_selections)
         selected_ondernemingen = st.multiselect(
             "Filter op voorstel onderneming:",
             onderneming_values,
@@ -550,12 +449,12 @@ with organisatie_container:
         )
         
         # Filter op voorstel onderneming als er een selectie is gemaakt
-        if selected_ondernemingen:
-            filtered_data = filtered_data[filtered_data['voorstel_onderneming'].isin(selected_ondernemingen)]
+        filter_mask = filter_engine.restrict(filter_mask, 'voorstel_onderneming', selected_ondernemingen)
+        upstream_selections += (('voorstel_onderneming', tuple(selected_ondernemingen)),)
     
     # Voorstel benaming UVB filter (nieuw) - alleen als kolom bestaat
-    if 'voorstel_benaming_uvb' in filtered_data.columns:
-        uvb_values = sorted(filtered_data['voorstel_benaming_uvb'].fillna('Onbekend').astype(str).unique().tolist())
+    if 'voorstel_benaming_uvb' in filter_engine:
+        uvb_values = filter_engine.cascade_options('voorstel_benaming_uvb', upstream_selections)
         selected_uvbs = st.multiselect(
             "Filter op voorstel benaming UVB:",
             uvb_values,
@@ -563,8 +462,36 @@ with organisatie_container:
         )
         
         # Filter op voorstel benaming UVB als er een selectie is gemaakt
-        if selected_uvbs:
-            filtered_data = filtered_data[filtered_data['voorstel_benaming_uvb'].isin(selected_uvbs)]
+        filter_mask = filter_engine.restrict(filter_mask, 'voorstel_benaming_uvb', selected_uvbs)
+        upstream_selections += (('voorstel_benaming_uvb', tuple(selected_uvbs)),)
+
+# PC4 opzoeken bij coördinaten (bijv. een lijst met geocodeerde uitvaartlocaties)
+if spatial_index is not None:
+    with st.sidebar.expander("PC4 bij locaties", expanded=False):
+        locations_text = st.text_area(
+            "Eén locatie per regel (breedtegraad, lengtegraad):", placeholder="52.3702, 4.8952"
+        )
+        locations_file = st.file_uploader("Of een CSV met kolommen lat en lon:", type=['csv'])
+        locations = parse_locations(locations_text)
+        if locations_file is not None:
+            uploaded_locations = pd.read_csv(locations_file)
+            columns = location_columns(uploaded_locations)
+            if columns is None:
+                st.warning("Geen kolommen voor breedte- en lengtegraad gevonden (bijv. lat en lon).")
+            else:
+                uploaded_locations = uploaded_locations.rename(columns={columns[0]: 'lat', columns[1]: 'lon'})
+                locations = pd.concat([locations, uploaded_locations], ignore_index=True)
+        if len(locations) > 0:
+            locations['lat'] = pd.to_numeric(locations['lat'], errors='coerce')
+            locations['lon'] = pd.to_numeric(locations['lon'], errors='coerce')
+            locations['PC4'] = spatial_index.locate(locations['lon'], locations['lat'])
+            found_pc4 = sorted(set(locations['PC4'].dropna()))
+            st.caption(f"{locations['PC4'].notna().sum()} van {len(locations)} locaties liggen in een PC4-gebied")
+            st.dataframe(locations, hide_index=True)
+            st.button(
+                "Gevonden PC4-gebieden als filter gebruiken", on_click=set_pc4_filter, args=(found_pc4,),
+                disabled=not found_pc4
+            )
 
 # Selecteer een kolom voor visualisatie in de statistieken aan rechterkant
 st.sidebar.subheader("Visualisatie opties")
@@ -582,20 +509,9 @@ for display_name, column_name in column_mapping.items():
     if column_name in merged_data.columns or column_name == 'berekend_marktaandeel_2023' or column_name == 'percentage_verzekerden':
         available_columns.append(display_name)
 
-# Selectie van de te visualiseren metriek
-selected_column_display = st.sidebar.selectbox(
-    "Selecteer kenmerk voor statistieken:",
-    options=available_columns,
-    index=0 if available_columns else None
-)
-
-# Converteer terug naar de echte kolomnaam als er een selectie is gemaakt
-selected_column = column_mapping.get(selected_column_display, None) if selected_column_display else None
-
 # Waardebereik filter voor marktaandeel (altijd beschikbaar)
 try:
-    min_val = float(filtered_data['berekend_marktaandeel_2023'].min())
-    max_val = float(filtered_data['berekend_marktaandeel_2023'].max())
+    min_val, max_val = filter_engine.value_bounds('berekend_marktaandeel_2023', filter_mask)
     
     # Voorkom identieke min en max waarden
     if min_val == max_val:
@@ -609,365 +525,531 @@ try:
     )
     
     # Filter op waardebereik
-    filtered_data = filtered_data[
-        (filtered_data['berekend_marktaandeel_2023'] >= value_range[0]) & 
-        (filtered_data['berekend_marktaandeel_2023'] <= value_range[1])
-    ]
+    filter_mask = filter_mask & filter_engine.between('berekend_marktaandeel_2023', *value_range)
+    value_range_active = value_range[0] > min_val or value_range[1] < max_val
 except Exception as e:
     st.sidebar.warning(f"Kon waardebereik niet instellen: {e}")
 
-# Dashboard layout met twee kolommen (maak kaart smaller)
-col1, col2 = st.columns([2, 1])
+# De filterstand bepaalt welke aggregaties hergebruikt kunnen worden
+filter_state = (
+    tuple(selected_pc4), tuple(selected_provincies), tuple(selected_gemeenten),
+    tuple(selected_woonplaatsen), tuple(selected_clusters), tuple(selected_ondernemingen),
+    tuple(selected_uvbs), value_range
+)
+profiling.checkpoint("aggregaties")
+# Rekenroute: pandas (standaard) of DuckDB; de beginstand komt uit PC4_QUERY_BACKEND of
+# ?backend=duckdb / ?backend=pandas
+duckdb_available = sql_available()
+use_duckdb = st.sidebar.toggle(
+    "Rekenen met DuckDB" if duckdb_available else "Rekenen met DuckDB (niet beschikbaar)",
+    value=duckdb_available and st.query_params.get("backend", QUERY_BACKEND) == 'duckdb',
+    disabled=not duckdb_available,
+    key='rekenroute_duckdb',
+    help=(
+        "Filters en aggregaties als queries in DuckDB in plaats van pandas." if duckdb_available
+        else "De module duckdb is niet geïnstalleerd (pip install duckdb); er wordt met pandas gerekend."
+    )
+)
+query_backend = 'duckdb' if use_duckdb else 'pandas'
+value_ranges = {'berekend_marktaandeel_2023': value_range} if value_range is not None else None
+sql_engine = get_sql_engine(cache_key, merged_data, filter_engine) if query_backend == 'duckdb' else None
+if use_duckdb and sql_engine is None:
+    st.sidebar.caption("DuckDB kon niet worden gestart; er wordt met pandas gerekend.")
+if sql_engine is not None:
+    # Filters, gemeente-aggregatie, statistieken en ranglijsten als queries op de filterstand
+    views = get_sql_views(
+        cache_key, filter_state, merged_data, sql_engine, dict(upstream_selections), value_ranges, gemeente_geometry
+    )
+else:
+    query_backend = 'pandas'
+    # Zonder PC4- of bereikfilter komen de totalen uit de rollup-kubus in plaats van uit de rijen
+    rollup_cube = get_rollup_cube(cache_key, merged_data, filter_engine)
+    cube_selections = dict(upstream_selections)
+    rollup = None
+    if rollup_cube is not None and not selected_pc4 and not value_range_active and rollup_cube.can_answer(cube_selections):
+        rollup = partial(rollup_cube.summary, cube_selections, require_value=value_range is not None)
+    views = get_aggregation_views(cache_key, filter_state, merged_data, filter_engine, filter_mask, gemeente_geometry, rollup)
+# Gefilterde rijen (de dataset zelf als er geen filter actief is)
+filtered_data = views.pc4
+profiling.record_frame("gedeelde dataset", merged_data, shared=True)
+profiling.record_frame("gefilterde rijen", filtered_data, shared=filtered_data is merged_data)
+niveau = LEVEL_GEMEENTE if visualisatie_niveau == "Gemeente" else LEVEL_PC4
 
-# Voeg export functionaliteit toe bovenaan de pagina
-export_container = st.container()
-with export_container:
-    export_col1, export_col2 = st.columns(2)
-    
-    with export_col1:
-        # Export geselecteerde PC4 data
-        if len(filtered_data) > 0:
-            # Bereid data voor voor export (zonder geometrie kolom die niet naar CSV kan)
-            export_data = filtered_data.drop(columns=['geometry'])
-            
-            # Converteer naar CSV
-            csv = export_data.to_csv(index=False)
-            
-            st.download_button(
-                label="📥 Exporteer PC4 data (CSV)",
-                data=csv,
-                file_name=f"pc4_data_export_{len(filtered_data)}_gebieden.csv",
-                mime="text/csv",
-            )
-    
-    with export_col2:
-        # Export statistieken samenvatting
-        if len(filtered_data) > 0:
-            # Bereken alle statistieken
-            total_sterfte = filtered_data['sterfte_2023'].sum()
-            total_uitvaarten = filtered_data['uitvaarten_2023'].sum()
-            total_uitvaarten_2024 = filtered_data['uitvaarten_2024'].sum() if 'uitvaarten_2024' in filtered_data.columns else 0
-            total_uitvaarten_2025 = filtered_data['uitvaarten_2025'].sum() if 'uitvaarten_2025' in filtered_data.columns else 0
-            
-            overall_marktaandeel = (total_uitvaarten / total_sterfte) * 100 if total_sterfte > 0 else 0
-            
-            total_inwoners = filtered_data['inwoners'].sum() if 'inwoners' in filtered_data.columns else 0
-            
-            total_verzekerden = filtered_data['aantal_verzekerden'].sum() if 'aantal_verzekerden' in filtered_data.columns else 0
-            percentage_verzekerden = (total_verzekerden / total_inwoners) * 100 if total_inwoners > 0 else 0
-            
-            gem_reistijd = filtered_data['reistijd_min'].mean() if 'reistijd_min' in filtered_data.columns else 0
-            
-            # Bepaal gebiedsnaam op basis van filters
-            gebied_naam = "Heel Nederland"
-            if selected_pc4:
-                gebied_naam = f"PC4: {', '.join(selected_pc4)}"
-            elif selected_provincies:
-                gebied_naam = f"Provincie(s): {', '.join(selected_provincies)}"
-            elif selected_gemeenten:
-                gebied_naam = f"Gemeente(n): {', '.join(selected_gemeenten)}"
-            elif selected_woonplaatsen:
-                gebied_naam = f"Woonplaats(en): {', '.join(selected_woonplaatsen)}"
-            
-            # Maak een DataFrame van de statistieken
-            stats_data = {
-                'Kenmerk': [
-                    'Gebied', 'Aantal PC4-gebieden', 'Marktaandeel 2023 (%)', 
-                    'Totaal inwoners', 'Sterfte 2023', 
-                    'Uitvaarten 2023', 'Uitvaarten 2024', 'Uitvaarten 2025',
-                    'Aantal verzekerden', 'Percentage verzekerden (%)', 'Gemiddelde reistijd (min)'
-                ],
-                'Waarde': [
-                    gebied_naam, len(filtered_data), round(overall_marktaandeel, 2),
-                    int(total_inwoners), int(total_sterfte),
-                    int(total_uitvaarten), int(total_uitvaarten_2024), int(total_uitvaarten_2025),
-                    int(total_verzekerden), round(percentage_verzekerden, 2), round(gem_reistijd, 1)
-                ]
-            }
-            stats_df = pd.DataFrame(stats_data)
-            
-            # Converteer naar CSV
-            stats_csv = stats_df.to_csv(index=False)
-            
-            st.download_button(
-                label="📥 Exporteer statistieken (CSV)",
-                data=stats_csv,
-                file_name=f"statistieken_{gebied_naam.replace(':', '').replace(',', '_')}.csv",
-                mime="text/csv",
-            )
 
-st.markdown("---")  # Horizontale lijn voor visuele scheiding
+# Gebiedsnaam op basis van filters (voor de export van de statistieken)
+gebied_naam = "Heel Nederland"
+if selected_pc4:
+    gebied_naam = f"PC4: {', '.join(selected_pc4)}"
+elif selected_provincies:
+    gebied_naam = f"Provincie(s): {', '.join(selected_provincies)}"
+elif selected_gemeenten:
+    gebied_naam = f"Gemeente(n): {', '.join(selected_gemeenten)}"
+elif selected_woonplaatsen:
+    gebied_naam = f"Woonplaats(en): {', '.join(selected_woonplaatsen)}"
+
+# De panelen hieronder zijn fragments: een widget in een paneel draait alleen dat paneel
+# opnieuw. Wat een paneel van de rest nodig heeft (filterstand, niveau) gaat als argument
+# mee; filters en niveau staan in de sidebar en draaien bij een wijziging alles opnieuw.
+# Kaart en statistieken staan bovenaan maar worden als laatste gevuld, omdat dat paneel
+# op de kaartfiguur wacht.
+kaart_panel = st.container()
 
-# Vervang het visualisatiegedeelte (rond regel 560-615) met deze aangepaste versie
 
-with col1:
-    niveau_label = "Gemeente" if visualisatie_niveau == "Gemeente" else "PC4"
-    st.subheader(f"{niveau_label} Kaart - {selected_column_display}")
+@profiled_fragment("kaart en statistieken")
+def kaart_en_statistieken(views, filtered_data, filter_state, niveau, visualisatie_niveau):
+    # Een selectie op de kaart heeft het PC4-filter aangepast: de hele pagina opnieuw
+    if st.session_state.pop('kaart_filter_gewijzigd', False):
+        st.rerun(scope='app')
+
+    # Selectie van de te visualiseren metriek (kaart en ranglijsten)
+    selected_column_display = st.selectbox(
+        "Selecteer kenmerk voor statistieken:",
+        options=available_columns,
+        index=0 if available_columns else None,
+        key='kenmerk'
+    )
+
+    # Converteer terug naar de echte kolomnaam als er een selectie is gemaakt
+    selected_column = column_mapping.get(selected_column_display, None) if selected_column_display else None
+
+    # Dashboard layout met twee kolommen (maak kaart smaller)
+    col1, col2 = st.columns([2, 1])
+
+    profiling.checkpoint("kaart")
+    map_job = None
+    with col1:
+        niveau_label = "Gemeente" if visualisatie_niveau == "Gemeente" else "PC4"
+        st.subheader(f"{niveau_label} Kaart - {selected_column_display}")
     
-    # Check of er data is om te visualiseren
-    if len(filtered_data) > 0:
-        # Bepaal de te visualiseren data op basis van gekozen niveau
-        if visualisatie_niveau == "Gemeente":
-            # Aggregeer data naar gemeenteniveau
-            visualisation_data = aggregate_to_gemeente(filtered_data)
+        # Check of er data is om te visualiseren
+        if len(filtered_data) > 0:
+            # Bepaal de te visualiseren data op basis van gekozen niveau
+            map_niveau = niveau
+            if niveau == LEVEL_GEMEENTE:
+                # Geaggregeerde data op gemeenteniveau
+                visualisation_data = views.gemeente
             
-            # Controleer of visualisation_data een GeoDataFrame is met geometrie kolom
-            is_geodataframe = isinstance(visualisation_data, gpd.GeoDataFrame) and 'geometry' in visualisation_data.columns
+                # Controleer of visualisation_data een GeoDataFrame is met geometrie kolom
+                is_geodataframe = isinstance(visualisation_data, gpd.GeoDataFrame) and 'geometry' in visualisation_data.columns
             
-            if not is_geodataframe:
-                st.warning("Kon geen gemeente-niveau kaart maken door problemen met geometrieën. Teruggevallen op PC4-niveau.")
-                visualisation_data = filtered_data
+                if not is_geodataframe:
+                    st.warning("Kon geen gemeente-niveau kaart maken door problemen met geometrieën. Teruggevallen op PC4-niveau.")
+                    visualisation_data = filtered_data
+                    map_niveau = LEVEL_PC4
+                else:
+                    st.info(f"Kaart toont {len(visualisation_data)} gemeenten.")
             else:
-                st.info(f"Kaart toont {len(visualisation_data)} gemeenten.")
-        else:
-            # Gebruik PC4 niveau (standaard)
-            visualisation_data = filtered_data
+                # Gebruik PC4 niveau (standaard)
+                visualisation_data = filtered_data
         
-        # Controleer opnieuw of we een geldige GeoDataFrame hebben
-        if not isinstance(visualisation_data, gpd.GeoDataFrame) or 'geometry' not in visualisation_data.columns:
-            st.error("Kan geen kaart maken zonder geldige geometrieën.")
-        else:
-            # Maak een kopie voor visualisatie om de originele data intact te houden
-            viz_data = visualisation_data.copy()
-            
-            # Check geometrietype (polygonen of punten)
-            from shapely.geometry import Point
-            is_point_geometry = False
-            if len(viz_data) > 0:
-                # Controleer het type van de eerste geometrie
-                first_geom = viz_data.iloc[0]['geometry']
-                is_point_geometry = isinstance(first_geom, Point)
-            
-            # Check of we categorische of numerieke data visualiseren
-            is_categorical = False
-            selected_col = selected_column  # standaard kolomnaam
-            
-            # Als het een categorische kolom is
-            if selected_column in viz_data.columns and (pd.api.types.is_object_dtype(viz_data[selected_column]) or pd.api.types.is_string_dtype(viz_data[selected_column])):
-                is_categorical = True
-                viz_data[selected_column] = viz_data[selected_column].fillna("Onbekend").astype(str)
+            # Controleer opnieuw of we een geldige GeoDataFrame hebben
+            if not isinstance(visualisation_data, gpd.GeoDataFrame) or 'geometry' not in visualisation_data.columns:
+                st.error("Kan geen kaart maken zonder geldige geometrieën.")
+            else:
+                # Check geometrietype (polygonen of punten) van de eerste geometrie
+                is_point_geometry = len(visualisation_data) > 0 and visualisation_data.geom_type.iloc[0] == 'Point'
             
-            try:
-                # Kies de juiste visualisatiemethode op basis van geometrietype
+                # Kopie zonder geometrie voor visualisatie; de vormen komen uit de gecachte GeoJSON
+                pyramid = feature_id_column = None
                 if is_point_geometry:
-                    # Voor punt-geometrieën gebruiken we een andere visualisatie
-                    if is_categorical:
-                        # Categorische data met punten
-                        fig = px.scatter_mapbox(
-                            viz_data,
-                            lat=viz_data.geometry.y,
-                            lon=viz_data.geometry.x,
-                            color=selected_col,
-                            color_discrete_sequence=monuta_palette,
-                            size_max=15,  # Max grootte van punten
-                            zoom=6.5,
-                            mapbox_style="carto-positron",
-                            center={"lat": 52.1326, "lon": 5.2913},
-                            hover_data=['gemeente'],
-                            labels={selected_col: selected_column_display}
-                        )
-                    else:
-                        # Numerieke data met punten
-                        fig = px.scatter_mapbox(
-                            viz_data,
-                            lat=viz_data.geometry.y,
-                            lon=viz_data.geometry.x,
-                            color=selected_column,
-                            color_continuous_scale=rood_grijs_groen_palette,
-                            size_max=15,  # Max grootte van punten
-                            zoom=6.5,
-                            mapbox_style="carto-positron",
-                            center={"lat": 52.1326, "lon": 5.2913},
-                            hover_data=['gemeente'],
-                            labels={selected_column: selected_column_display}
-                        )
+                    viz_data = visualisation_data.copy(deep=False)
                 else:
-                    # Voor polygoon-geometrieën gebruiken we de originele visualisatie
-                    if is_categorical:
-                        # Categorische data met polygonen
-                        fig = px.choropleth_mapbox(
-                            viz_data,
-                            geojson=viz_data.geometry,
-                            locations=viz_data.index,
-                            color=selected_col,
-                            color_discrete_sequence=monuta_palette,
-                            mapbox_style="carto-positron",
-                            zoom=6.5,
-                            center={"lat": 52.1326, "lon": 5.2913},
-                            opacity=0.7,
-                            hover_data=['gemeente', 'woonplaats', selected_col] if visualisatie_niveau == "Postcode (PC4)" and 'woonplaats' in viz_data.columns else ['gemeente', selected_col],
-                            labels={selected_col: selected_column_display}
+                    viz_data = pd.DataFrame(visualisation_data.drop(columns=['geometry']))
+                    if map_niveau == LEVEL_GEMEENTE:
+                        feature_id_column = 'gemeente'
+                        pyramid = get_geometry_pyramid(
+                            cache_key, LEVEL_GEMEENTE, gemeente_geometry, None,
+                            get_topology(cache_key, merged_data), merged_data['gemeente']
                         )
                     else:
-                        # Numerieke data met polygonen
-                        fig = px.choropleth_mapbox(
-                            viz_data,
-                            geojson=viz_data.geometry,
-                            locations=viz_data.index,
-                            color=selected_column,
-                            color_continuous_scale=rood_grijs_groen_palette,
-                            mapbox_style="carto-positron",
-                            zoom=6.5,
-                            center={"lat": 52.1326, "lon": 5.2913},
-                            opacity=0.7,
-                            hover_data=['gemeente', 'woonplaats', selected_column] if visualisatie_niveau == "Postcode (PC4)" and 'woonplaats' in viz_data.columns else ['gemeente', selected_column],
-                            labels={selected_column: selected_column_display}
-                        )
-                
-                # Layout aanpassen
-                fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0}, height=600)
-                st.plotly_chart(fig, use_container_width=True)
-            except Exception as e:
-                st.error(f"Fout bij het maken van de kaart: {type(e).__name__}. Probeer een andere weergave of dataset.")
-                st.code(str(e), language="python")
-                
-                # Als de visualisatie faalt, toon een tabel met de aggregated data als alternatief
-                st.subheader("Alternatieve weergave (tabel)")
-                display_data = viz_data.drop(columns=['geometry'])
-                st.dataframe(display_data)
-    else:
-        st.warning("Geen data beschikbaar met de huidige filters.")
+                        feature_id_column = 'PC4'
+                        pyramid = get_geometry_pyramid(cache_key, LEVEL_PC4, merged_data, 'PC4', get_topology(cache_key, merged_data))
+                    viz_data[feature_id_column] = viz_data[feature_id_column].astype(str)
+
+                # De buurmetrieken bestaan alleen per PC4-gebied
+                if selected_column not in viz_data.columns and selected_column in NEIGHBOURHOOD_METRICS:
+                    st.info(f"{selected_column_display} is alleen per PC4-gebied beschikbaar; de kaart toont het marktaandeel.")
+                    selected_column, selected_column_display = 'berekend_marktaandeel_2023', "Marktaandeel 2023"
+
+                # Check of we categorische of numerieke data visualiseren
+                is_categorical = False
+                if selected_column in viz_data.columns and (pd.api.types.is_object_dtype(viz_data[selected_column]) or pd.api.types.is_string_dtype(viz_data[selected_column])):
+                    is_categorical = True
+                    viz_data[selected_column] = viz_data[selected_column].fillna("Onbekend").astype(str)
+
+                if is_point_geometry:
+                    hover_data = ['gemeente']
+                elif visualisatie_niveau == "Postcode (PC4)" and 'woonplaats' in viz_data.columns:
+                    hover_data = ['gemeente', 'woonplaats', selected_column]
+                else:
+                    hover_data = ['gemeente', selected_column]
+
+                # Veel vlakken (bijv. heel Nederland per PC4) tekent de server als afbeelding
+                map_mode = st.radio(
+                    "Kaartweergave:", options=list(MAP_MODES), format_func=MAP_MODES.get,
+                    horizontal=True, key='kaartweergave'
+                )
+                raster = use_raster(map_mode, len(viz_data), is_categorical, pyramid)
+                if raster:
+                    st.caption(f"De kaart is als afbeelding getekend ({len(viz_data)} gebieden); kies 'Vlakken' voor scherpe grenzen bij inzoomen.")
+
+                # De figuur wordt in een thread opgebouwd en onderaan de pagina ingevoegd; een
+                # nieuwere interactie met een andere kaart annuleert deze opdracht
+                use_static = st.get_option("server.enableStaticServing")
+                map_key = (cache_key, filter_state, map_niveau, selected_column, use_static, raster)
+                map_job = st.session_state.setdefault('kaart_opdrachten', MapJobs()).submit(
+                    get_map_executor(), map_key,
+                    build_map_figure, viz_data, selected_column, selected_column_display,
+                    categorical=is_categorical, hover_data=hover_data, pyramid=pyramid,
+                    feature_id_column=feature_id_column, use_static=use_static,
+                    raster=raster, image_key=map_key
+                )
+                map_niveau_rendered = map_niveau
+                map_slot = st.empty()
+                map_slot.caption("Kaart wordt opgebouwd...")
+        else:
+            st.warning("Geen data beschikbaar met de huidige filters.")
 
-with col2:
-    niveau_label = "gemeente" if visualisatie_niveau == "Gemeente" else "PC4-gebied"
-    st.subheader(f"Statistieken ({visualisatie_niveau})")
+    profiling.checkpoint("statistieken")
+    with col2:
+        niveau_label = "gemeente" if visualisatie_niveau == "Gemeente" else "PC4-gebied"
+        st.subheader(f"Statistieken ({visualisatie_niveau})")
     
-    if len(filtered_data) > 0:
-        # Bepaal de data voor statistieken op basis van niveau
-        if visualisatie_niveau == "Gemeente":
-            stats_data = aggregate_to_gemeente(filtered_data)
-            if isinstance(stats_data, pd.DataFrame) and len(stats_data) > 0:
-                # Gebruik geaggregeerde data voor statistieken
-                pass
-            else:
-                stats_data = filtered_data
+        if len(filtered_data) > 0:
+            # Bepaal het niveau voor statistieken (uit de gedeelde aggregaties)
+            stats_niveau = niveau
+            if niveau == LEVEL_GEMEENTE and len(views.gemeente) == 0:
+                stats_niveau = LEVEL_PC4
                 st.warning("Kon statistieken niet berekenen op gemeenteniveau. Teruggevallen op PC4-niveau.")
-        else:
-            stats_data = filtered_data
-            
-        # Bereken het algehele marktaandeel voor de geselecteerde regio's
-        total_sterfte = stats_data['sterfte_2023'].sum()
-        total_uitvaarten = stats_data['uitvaarten_2023'].sum()
-        
-        if total_sterfte > 0:
-            overall_marktaandeel = (total_uitvaarten / total_sterfte) * 100
-        else:
-            overall_marktaandeel = 0
-            
-        # Percentage verzekerden berekenen
-        total_inwoners = stats_data['inwoners'].sum()
-        total_verzekerden = stats_data['aantal_verzekerden'].sum()
-        if total_inwoners > 0:
-            percentage_verzekerden = (total_verzekerden / total_inwoners) * 100
-        else:
-            percentage_verzekerden = 0
+            stats_data = views.frame(stats_niveau)
+            summary = views.summary(stats_niveau)
         
-        # Statistieken in twee kolommen weergeven
-        stat_col1, stat_col2 = st.columns(2)
+            # Statistieken in twee kolommen weergeven
+            stat_col1, stat_col2 = st.columns(2)
         
-        with stat_col1:
-            # Eerste kolom statistieken
-            st.metric(f"Aantal {niveau_label}en", len(stats_data))
-            st.metric("Marktaandeel 2023", f"{round(overall_marktaandeel, 2)}%")
+            with stat_col1:
+                # Eerste kolom statistieken
+                st.metric(f"Aantal {niveau_label}en", summary['aantal'])
+                st.metric("Marktaandeel 2023", f"{round(summary['marktaandeel'], 2)}%")
             
-            # Controleer en bereken inwoners totaal
-            if 'inwoners' in stats_data.columns:
-                total_inwoners = stats_data['inwoners'].sum()
-                st.metric("Totaal inwoners", f"{int(total_inwoners):,}".replace(",", "."))
+                if 'inwoners' in stats_data.columns:
+                    st.metric("Totaal inwoners", f"{int(summary['inwoners']):,}".replace(",", "."))
                 
-            # Percentage verzekerden
-            st.metric("Percentage verzekerden", f"{round(percentage_verzekerden, 2)}%")
+                # Percentage verzekerden
+                st.metric("Percentage verzekerden", f"{round(summary['percentage_verzekerden'], 2)}%")
         
-        with stat_col2:
-            # Tweede kolom statistieken
-            st.metric("Sterfte 2023", int(total_sterfte))
-            st.metric("Uitvaarten 2023", int(total_uitvaarten))
+            with stat_col2:
+                # Tweede kolom statistieken
+                st.metric("Sterfte 2023", int(summary['sterfte_2023']))
+                st.metric("Uitvaarten 2023", int(summary['uitvaarten_2023']))
             
-            # Nieuwe statistieken toevoegen
-            if 'uitvaarten_2024' in stats_data.columns:
-                st.metric("Uitvaarten 2024", int(stats_data['uitvaarten_2024'].sum()))
+                # Nieuwe statistieken toevoegen
+                if 'uitvaarten_2024' in stats_data.columns:
+                    st.metric("Uitvaarten 2024", int(summary['uitvaarten_2024']))
                 
-            if 'uitvaarten_2025' in stats_data.columns:
-                st.metric("Uitvaarten 2025", int(stats_data['uitvaarten_2025'].sum()))
+                if 'uitvaarten_2025' in stats_data.columns:
+                    st.metric("Uitvaarten 2025", int(summary['uitvaarten_2025']))
                 
-            if 'aantal_verzekerden' in stats_data.columns:
-                st.metric("Aantal verzekerden", f"{int(stats_data['aantal_verzekerden'].sum()):,}".replace(",", "."))
+                if 'aantal_verzekerden' in stats_data.columns:
+                    st.metric("Aantal verzekerden", f"{int(summary['aantal_verzekerden']):,}".replace(",", "."))
                     
-            if 'reistijd_min' in stats_data.columns:
-                # Gemiddelde reistijd berekenen
-                gem_reistijd = stats_data['reistijd_min'].mean()
-                st.metric("Gem. reistijd (min)", round(gem_reistijd, 1))
+                if 'reistijd_min' in stats_data.columns:
+                    st.metric("Gem. reistijd (min)", round(summary['gem_reistijd'], 1))
         
-        # Top 5 gebieden op basis van marktaandeel
-        st.subheader(f"Top 5 {niveau_label}en (hoogste marktaandeel)")
+            # Top 5 en laagste 5 gebieden op basis van marktaandeel (metrieken zijn al berekend); met
+            # een marktaandeel inclusief buren of regio gekozen wordt daarop gerangschikt (minder ruis)
+            top_metric = selected_column if selected_column in NEIGHBOURHOOD_METRICS and selected_column in stats_data.columns else 'berekend_marktaandeel_2023'
+            top5, bottom5 = views.ranking(stats_niveau, 5, top_metric)
         
-        # Bereken marktaandeel per gebied (vermijd delen door nul)
-        top_data = stats_data.copy()
-        top_data['marktaandeel'] = np.where(
-            top_data['sterfte_2023'] > 0,
-            top_data['uitvaarten_2023'] / top_data['sterfte_2023'] * 100,
-            0
-        )
+            # Bepaal welke kolommen te tonen in de tabel
+            if stats_niveau == LEVEL_GEMEENTE:
+                columns_to_display = ['gemeente', 'berekend_marktaandeel_2023', 'percentage_verzekerden', 'sterfte_2023', 'uitvaarten_2023']
+            else:
+                columns_to_display = ['PC4', 'gemeente', 'woonplaats', 'berekend_marktaandeel_2023', 'percentage_verzekerden', 'sterfte_2023', 'uitvaarten_2023']
+            if top_metric != 'berekend_marktaandeel_2023':
+                columns_to_display.insert(columns_to_display.index('berekend_marktaandeel_2023') + 1, top_metric)
+            columns_to_display = [col for col in columns_to_display if col in top5.columns]
         
-        # Bereken percentage verzekerden per gebied (vermijd delen door nul)
-        top_data['perc_verzekerden'] = np.where(
-            top_data['inwoners'] > 0,
-            top_data['aantal_verzekerden'] / top_data['inwoners'] * 100,
-            0
-        )
+            def format_ranking(ranking, columns=columns_to_display):
+                ranking = ranking[columns].copy()
+                # Formatteer marktaandeel en percentage verzekerden als percentage
+                for col in ['berekend_marktaandeel_2023', 'percentage_verzekerden'] + NEIGHBOURHOOD_METRICS:
+                    if col in ranking.columns:
+                        ranking[col] = ranking[col].round(2).astype(str) + '%'
+                # Hernoem kolommen voor betere weergave
+                return ranking.rename(columns={
+                    'berekend_marktaandeel_2023': 'Marktaandeel', 'percentage_verzekerden': 'Perc. verzekerden',
+                    'marktaandeel_buren': 'Marktaandeel incl. buren', 'marktaandeel_regio': 'Marktaandeel regio',
+                })
         
-        # Filter gebieden met ten minste 1 sterfgeval voor betekenisvolle ranking
-        valid_data = top_data[top_data['sterfte_2023'] > 0]
+            st.subheader(f"Top 5 {niveau_label}en (hoogste marktaandeel)")
+            st.dataframe(format_ranking(top5))
         
-        # Bepaal welke kolommen te tonen in de tabel
-        if visualisatie_niveau == "Gemeente":
-            columns_to_display = ['gemeente', 'marktaandeel', 'perc_verzekerden', 'sterfte_2023', 'uitvaarten_2023']
+            st.subheader(f"Laagste 5 {niveau_label}en (laagste marktaandeel)")
+            st.dataframe(format_ranking(bottom5))
+
+            # Ranglijst per provincie of cluster op het gekozen kenmerk (zonder sortering per groep)
+            group_columns = [col for col in ('provincie', 'cluster', 'aaneengesloten_regio') if col in stats_data.columns]
+            ranking_metric = selected_column if selected_column in stats_data.columns else 'berekend_marktaandeel_2023'
+            if group_columns and pd.api.types.is_numeric_dtype(stats_data[ranking_metric]):
+                with st.expander(f"Top 3 per groep ({selected_column_display})"):
+                    group_column = st.selectbox("Groepeer op:", group_columns)
+                    group_top, group_bottom = views.ranking_by_group(stats_niveau, group_column, 3, ranking_metric)
+                    group_display = [group_column] + [col for col in columns_to_display if col != group_column]
+                    if ranking_metric not in group_display:
+                        group_display.append(ranking_metric)
+                    st.markdown("**Hoogste**")
+                    st.dataframe(format_ranking(group_top, group_display), hide_index=True)
+                    st.markdown("**Laagste**")
+                    st.dataframe(format_ranking(group_bottom, group_display), hide_index=True)
         else:
-            columns_to_display = ['PC4', 'gemeente', 'woonplaats', 'marktaandeel', 'perc_verzekerden', 'sterfte_2023', 'uitvaarten_2023']
+            st.warning("Geen data beschikbaar voor statistieken.")
+
+    # De kaart invoegen zodra de figuur klaar is; de rest van de pagina staat er dan al
+    profiling.checkpoint("kaart invoegen")
+    if map_job is not None:
+        # Tijdens het wachten de status bijwerken; daarbij breekt Streamlit deze rerun af als er
+        # een nieuwere interactie is
+        map_error = None
+        try:
+            fig = map_job.wait(lambda seconds: map_slot.caption(f"Kaart wordt opgebouwd... ({seconds:.1f} s)"))
+        except Exception as e:
+            map_error = e
+        with map_slot.container():
+            if map_error is None:
+                with profiling.span("plotly_chart"):
+                    # Selectie op de kaart (klik, rechthoek of lasso) vult het PC4-filter
+                    st.session_state['kaart_niveau'] = map_niveau_rendered
+                    st.session_state['kaart_afbeelding'] = raster
+                    st.plotly_chart(
+                        fig, use_container_width=True, key='kaart', on_select=apply_map_selection,
+                        selection_mode=('points', 'box', 'lasso')
+                    )
+                profiling.record_frame("kaartdata", viz_data)
+            else:
+                st.error(f"Fout bij het maken van de kaart: {type(map_error).__name__}. Probeer een andere weergave of dataset.")
+                st.code(str(map_error), language="python")
             
-        # Top 5 hoogste marktaandeel
-        top5 = valid_data.sort_values(by='marktaandeel', ascending=False)[columns_to_display].head(5)
-        
-        # Formatteer marktaandeel en percentage verzekerden als percentage
-        top5['marktaandeel'] = top5['marktaandeel'].round(2).astype(str) + '%'
-        top5['perc_verzekerden'] = top5['perc_verzekerden'].round(2).astype(str) + '%'
-        
-        # Hernoem kolommen voor betere weergave
-        top5 = top5.rename(columns={'marktaandeel': 'Marktaandeel', 'perc_verzekerden': 'Perc. verzekerden'})
-        
-        st.dataframe(top5)
-        
-        # Bottom 5 gebieden op basis van marktaandeel
-        st.subheader(f"Laagste 5 {niveau_label}en (laagste marktaandeel)")
-        
-        # Bottom 5 laagste marktaandeel
-        bottom5 = valid_data.sort_values(by='marktaandeel', ascending=True)[columns_to_display].head(5)
-        
-        # Formatteer marktaandeel en percentage verzekerden als percentage
-        bottom5['marktaandeel'] = bottom5['marktaandeel'].round(2).astype(str) + '%'
-        bottom5['perc_verzekerden'] = bottom5['perc_verzekerden'].round(2).astype(str) + '%'
-        
-        # Hernoem kolommen voor betere weergave
-        bottom5 = bottom5.rename(columns={'marktaandeel': 'Marktaandeel', 'perc_verzekerden': 'Perc. verzekerden'})
-        
-        st.dataframe(bottom5)
-    else:
-        st.warning("Geen data beschikbaar voor statistieken.")
+                # Als de visualisatie faalt, toon een tabel met de aggregated data als alternatief
+                st.subheader("Alternatieve weergave (tabel)")
+                display_data = viz_data.drop(columns=['geometry'], errors='ignore')
+                st.dataframe(display_data)
+
+
+@profiled_fragment("export")
+def export_panel(views, filtered_data, filter_state, gebied_naam):
+    # Voeg export functionaliteit toe bovenaan de pagina
+    profiling.checkpoint("export")
+    export_container = st.container()
+    with export_container:
+        export_col1, export_col2 = st.columns(2)
+    
+        with export_col1:
+            # Export geselecteerde PC4 data
+            if len(filtered_data) > 0:
+                export_format = st.selectbox(
+                    "Exportformaat:",
+                    options=list(EXPORT_FORMATS),
+                    format_func=lambda fmt: EXPORT_FORMATS[fmt][0],
+                )
+                export_label, export_extension, export_mime = EXPORT_FORMATS[export_format]
+
+                # Het bestand wordt pas bij een klik gemaakt (zonder geometrie) en per filterstand bewaard
+                export_key = (cache_key, filter_state, export_format)
+                export_rows = filtered_data
+
+                def build_export():
+                    return export_cache.get(export_key, export_rows, export_format)
+
+                st.download_button(
+                    label=f"📥 Exporteer PC4 data ({export_label})",
+                    data=build_export,
+                    file_name=f"pc4_data_export_{len(filtered_data)}_gebieden{export_extension}",
+                    mime=export_mime,
+                )
+    
+        with export_col2:
+            # Export statistieken samenvatting
+            if len(filtered_data) > 0:
+                # Statistieken op PC4-niveau (uit de gedeelde aggregaties)
+                summary = views.summary(LEVEL_PC4)
+            
+                # Maak een DataFrame van de statistieken
+                stats_df = summary_table(summary, gebied_naam)
+            
+                # Converteer naar CSV
+                stats_csv = stats_df.to_csv(index=False)
+            
+                st.download_button(
+                    label="📥 Exporteer statistieken (CSV)",
+                    data=stats_csv,
+                    file_name=f"statistieken_{gebied_naam.replace(':', '').replace(',', '_')}.csv",
+                    mime="text/csv",
+                )
+
+
+export_panel(views, filtered_data, filter_state, gebied_naam)
+
+st.markdown("---")  # Horizontale lijn voor visuele scheiding
+
+
+@profiled_fragment("verzorgingsgebied")
+def verzorgingsgebied_panel():
+    # Verzorgingsgebieden van (mogelijke) locaties op basis van geschatte reistijd
+    profiling.checkpoint("verzorgingsgebied")
+    if 'PC4' in merged_data.columns and 'geometry' in merged_data.columns:
+        with st.expander("Verzorgingsgebied (reistijd)"):
+            st.caption(
+                f"Welke PC4-gebieden liggen binnen de gekozen reistijd van een of meer locaties? De reistijd is "
+                f"geschat (gemiddeld {SPEED_KMH} km/u) en de analyse gebruikt alle gebieden, los van de filters."
+            )
+            catchment_col1, catchment_col2 = st.columns([1, 2])
+            with catchment_col1:
+                catchment_text = st.text_area(
+                    "Locaties (breedtegraad, lengtegraad per regel):", placeholder="52.3702, 4.8952", key='catchment_locaties'
+                )
+                catchment_minutes = st.slider("Maximale reistijd (minuten):", 5, 60, DEFAULT_MAX_MINUTES)
+                catchment_mode = st.radio("Reistijd:", list(CATCHMENT_MODES), format_func=CATCHMENT_MODES.get, horizontal=True)
+            catchment_locations = parse_locations(catchment_text)
+
+            if len(catchment_locations) > 0:
+                topology = get_topology(cache_key, merged_data)
+                catchment_engine = get_catchment_engine(cache_key, merged_data, topology)
+                with profiling.span("verzorgingsgebied berekenen"):
+                    catchment = catchment_engine.analyse(
+                        catchment_locations['lon'], catchment_locations['lat'], catchment_minutes, catchment_mode
+                    )
+                catchment_summary = catchment['samenvatting']
+
+                with catchment_col1:
+                    st.metric("Aantal PC4-gebieden", catchment_summary['aantal'])
+                    st.metric("Sterfte 2023", int(catchment_summary['sterfte_2023']))
+                    st.metric("Uitvaarten 2023", int(catchment_summary['uitvaarten_2023']))
+                    st.metric("Marktaandeel 2023", f"{round(catchment_summary['marktaandeel'], 2)}%")
+                    st.metric("Aantal verzekerden", f"{int(catchment_summary['aantal_verzekerden']):,}".replace(",", "."))
+                    st.metric("Sneller dan de huidige reistijd", f"{catchment['sneller']} gebieden")
+
+                with catchment_col2:
+                    reached = catchment['reistijd']
+                    if len(reached) > 0:
+                        # Plotly is alleen nodig voor de kaarten
+                        import plotly.express as px
+                        pyramid = get_geometry_pyramid(cache_key, LEVEL_PC4, merged_data, 'PC4', topology)
+                        catchment_center, catchment_zoom, catchment_lod = pyramid.view(reached.index)
+                        catchment_fig = px.choropleth_mapbox(
+                            reached.rename_axis('PC4').reset_index(),
+                            geojson=pyramid.geojson(reached.index, catchment_lod),
+                            locations='PC4',
+                            featureidkey="id",
+                            color='reistijd_schatting',
+                            # Korte reistijd groen, lange rood
+                            color_continuous_scale=ROOD_GRIJS_GROEN_PALETTE[::-1],
+                            mapbox_style="carto-positron",
+                            zoom=catchment_zoom,
+                            center=catchment_center,
+                            opacity=0.7,
+                            labels={'reistijd_schatting': "Reistijd (min)"}
+                        )
+                        catchment_fig.add_scattermapbox(
+                            lat=catchment_locations['lat'], lon=catchment_locations['lon'], mode='markers',
+                            marker={'size': 12, 'color': 'black'}, name="Locaties", showlegend=False
+                        )
+                        catchment_fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0}, height=450)
+                        st.plotly_chart(catchment_fig, use_container_width=True)
+                    else:
+                        st.warning("Geen PC4-gebieden binnen deze reistijd.")
+
+                st.dataframe(
+                    catchment['locaties'].rename(columns={
+                        'aantal_pc4': "PC4-gebieden", 'snelste_pc4': "Snelste voor", 'sneller_dan_nu': "Sneller dan nu"
+                    }),
+                    hide_index=True
+                )
+
+
+verzorgingsgebied_panel()
+
 
 # Optionele ruwe data weergave
-if st.checkbox("Toon ruwe data"):
-    # Toon data afhankelijk van het geselecteerde niveau
-    if visualisatie_niveau == "Gemeente" and len(filtered_data) > 0:
-        gemeente_data = aggregate_to_gemeente(filtered_data)
-        if isinstance(gemeente_data, pd.DataFrame) and len(gemeente_data) > 0:
-            # Toon de data zonder geometrie kolom
-            display_data = gemeente_data.drop(columns=['geometry']) if 'geometry' in gemeente_data.columns else gemeente_data
-            st.dataframe(display_data)
+@profiled_fragment("ruwe data")
+def ruwe_data_panel(views, filtered_data, niveau):
+    profiling.checkpoint("ruwe data")
+    if st.checkbox("Toon ruwe data"):
+        # Toon data afhankelijk van het geselecteerde niveau
+        if niveau == LEVEL_GEMEENTE and len(filtered_data) > 0:
+            gemeente_data = views.gemeente
+            if isinstance(gemeente_data, pd.DataFrame) and len(gemeente_data) > 0:
+                # Toon de data zonder geometrie kolom
+                display_data = gemeente_data.drop(columns=['geometry']) if 'geometry' in gemeente_data.columns else gemeente_data
+                st.dataframe(display_data)
+            else:
+                display_data = filtered_data.drop(columns=['geometry']) if 'geometry' in filtered_data.columns else filtered_data
+                st.dataframe(display_data)
+                st.warning("Kon geen gemeente-niveau data genereren. Toon PC4-niveau data.")
         else:
             display_data = filtered_data.drop(columns=['geometry']) if 'geometry' in filtered_data.columns else filtered_data
             st.dataframe(display_data)
-            st.warning("Kon geen gemeente-niveau data genereren. Toon PC4-niveau data.")
-    else:
-        display_data = filtered_data.drop(columns=['geometry']) if 'geometry' in filtered_data.columns else filtered_data
-        st.dataframe(display_data)
-                
+        profiling.record_frame("ruwe data", display_data)
+
+
+ruwe_data_panel(views, filtered_data, niveau)
+
+
+with kaart_panel:
+    kaart_en_statistieken(views, filtered_data, filter_state, niveau, visualisatie_niveau)
+
+# Meting afsluiten; het debugpaneel zelf wordt niet meegemeten
+profile_record = profiling.finish_run()
+profile_history = remember_profile(profile_record)
+
+# Debugpaneel met de metingen (via ?debug=1 of PC4_DEBUG=1)
+if st.query_params.get("debug") == "1" or os.environ.get("PC4_DEBUG") == "1":
+    with st.sidebar.expander("Prestaties (debug)", expanded=True):
+        st.metric("Laatste rerun", f"{profile_record['total_seconds'] * 1000:.0f} ms")
+        if profile_record['first_paint_seconds'] is not None:
+            cold_text = " (koude start)" if profile_record['cold_start'] else ""
+            st.metric("Eerste weergave", f"{profile_record['first_paint_seconds'] * 1000:.0f} ms{cold_text}")
+        budget_text = f" van {profile_record['budget_mb']:.0f} MB budget" if profile_record['budget_mb'] else ""
+        st.metric("Geheugen sessie", f"{profile_record['session_mb']:.1f} MB{budget_text}")
+        st.dataframe(pd.DataFrame([
+            {'Frame': name, 'MB': round(entry['mb'], 2), 'Gedeeld': entry['shared']}
+            for name, entry in profile_record['memory'].items()
+        ]), hide_index=True)
+        st.dataframe(pd.DataFrame([
+            {
+                'Fase': '  ' * span['depth'] + span['name'].split('/')[-1],
+                'ms': round(span['seconds'] * 1000, 1),
+                'RSS (MB)': round(span['rss_mb'], 1) if span['rss_mb'] is not None else None,
+                'Δ RSS (MB)': round(span['rss_delta_mb'], 1) if span['rss_delta_mb'] is not None else None,
+            }
+            for span in profile_record['spans']
+        ]), hide_index=True)
+        st.dataframe(
+            pd.DataFrame.from_dict(profile_record['caches'], orient='index').rename_axis('Cache'),
+        )
+        # Meldingen (logging) van de bewaarde metingen, nieuwste eerst
+        messages = [
+            {'Rerun': record['label'] or record['run_id'], 'Niveau': message['level'], 'Melding': message['message']}
+            for record in reversed(profile_history) for message in record.get('messages', [])
+        ]
+        if messages:
+            st.dataframe(pd.DataFrame(messages), hide_index=True)
+        st.caption(f"Export cache: {export_cache.hits} hits, {export_cache.misses} misses")
+        st.caption(f"Kaartafbeeldingen: {image_cache.hits} hits, {image_cache.misses} misses")
+        st.caption(f"Rekenroute: {query_backend}")
+        if query_backend == 'duckdb' and st.button("Vergelijk DuckDB met pandas"):
+            # Dezelfde filterstand via de pandas-route; verschillen in frames, totalen of ranglijsten
+            pandas_views = get_aggregation_views(
+                cache_key, filter_state, merged_data, filter_engine, filter_mask, gemeente_geometry
+            )
+            differences = compare_views(pandas_views, views, group_column='provincie')
+            if differences:
+                st.warning("\n\n".join(differences))
+            else:
+                st.success("DuckDB en pandas geven dezelfde uitkomsten")
+        st.download_button(
+            label="Metingen exporteren (JSONL)",
+            data=profiling.to_jsonl(profile_history),
+            file_name="pc4_dashboard_profiel.jsonl",
+            mime="application/jsonl",
+        )
@@ -0,0 +1,364 @@
+"""
+Benchmark van de datapijplijn op synthetische PC4 data.
+
+Genereert een Excel bestand in de vorm van PC4_verrijkt.xlsx en een bijpassende shapefile
+(Voronoi-vlakken over Nederland, met provincie > gemeente > woonplaats als aaneengesloten
+gebieden) op schaal x1 (ca. 4.000 gebieden), x10 of x100. Daarna worden de stappen van
+app.py gemeten en vergeleken met een opgeslagen baseline.
+
+Gebruik:
+    python benchmark.py --scale x1
+    python benchmark.py --scale x1 x10 --repeat 5
+    python benchmark.py --scale x1 --save-baseline
+    python benchmark.py --scale x1 --check            # exit code 1 bij een regressie
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+# Aantal PC4-gebieden in de echte dataset
+BASE_AREAS = 4070
+SCALES = {'x1': 1, 'x10': 10, 'x100': 100}
+
+# Ongeveer de omvang van Nederland (lon/lat) en de indeling
+NL_BOUNDS = (3.36, 50.75, 7.23, 53.55)
+PROVINCIES = 12
+GEMEENTEN = 342
+WOONPLAATSEN = 2500
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'benchmark')
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# Een stap is een regressie als hij zoveel keer trager is dan de baseline
+REGRESSION_FACTOR = 1.25
+
+
+# Synthetische data
+
+def _nearest(points, seeds):
+    """Index van het dichtstbijzijnde zaadpunt voor elk punt."""
+    tree = shapely.STRtree(seeds)
+    _, nearest = tree.query_nearest(points, all_matches=False)
+    return nearest
+
+
+def generate_dataset(scale, directory, seed=0):
+    """
+    Schrijf PC4_verrijkt.xlsx en PC4.shp voor de schaal naar directory (als ze er nog niet
+    zijn). Geeft de paden van het Excel bestand en de shapefile.
+    """
+    excel_path = os.path.join(directory, 'PC4_verrijkt.xlsx')
+    shapefile_path = os.path.join(directory, 'PC4.shp')
+    if os.path.exists(excel_path) and os.path.exists(shapefile_path):
+        return excel_path, shapefile_path
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    count = BASE_AREAS * SCALES[scale]
+    minx, miny, maxx, maxy = NL_BOUNDS
+
+    # PC4-vlakken: Voronoi rond willekeurige punten, afgesneden op de kaartuitsnede
+    centers = shapely.points(rng.uniform(minx, maxx, count), rng.uniform(miny, maxy, count))
+    extent = shapely.box(*NL_BOUNDS)
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(centers), extend_to=extent))
+    cells = shapely.intersection(cells, extent)
+    # Voronoi geeft de vlakken niet in de volgorde van de punten
+    point_index, cell_index = shapely.STRtree(cells).query(centers, predicate='intersects')
+    cell_order = np.empty(count, dtype=np.intp)
+    cell_order[point_index] = cell_index
+    cells = cells[cell_order]
+
+    def seeds(n):
+        return shapely.points(rng.uniform(minx, maxx, n), rng.uniform(miny, maxy, n))
+
+    # Aaneengesloten indeling: elk gebied hoort bij het dichtstbijzijnde zaadpunt
+    gemeente_seeds = seeds(GEMEENTEN)
+    gemeente = _nearest(centers, gemeente_seeds)
+    provincie = _nearest(gemeente_seeds, seeds(PROVINCIES))[gemeente]
+    woonplaats = _nearest(centers, seeds(WOONPLAATSEN))
+
+    pc4 = np.arange(1000, 1000 + count)
+    inwoners = np.round(rng.lognormal(8.2, 0.9, count)).astype(np.int64)
+    sterfte = rng.poisson(inwoners * 0.0095)
+    regional_share = rng.beta(3, 7, GEMEENTEN)[gemeente]
+    verzekerden = rng.binomial(inwoners, rng.beta(2.5, 7.5, count))
+
+    excel = pd.DataFrame({
+        'PC4': pc4,
+        'provincie': [f"Provincie {p + 1}" for p in provincie],
+        'gemeente': [f"Gemeente {g + 1}" for g in gemeente],
+        'woonplaats': [f"Plaats {g + 1}-{w + 1}" for g, w in zip(gemeente, woonplaats)],
+        'cluster': [f"Cluster {c + 1}" for c in (gemeente % 9)],
+        'voorstel_benaming_uvb': [f"UVB {u + 1}" for u in (provincie % 5)],
+        'voorstel_onderneming': [f"Onderneming {o + 1}" for o in (gemeente % 4)],
+        'inwoners': inwoners,
+        'sterfte_2023': sterfte,
+        'uitvaarten_2023': rng.binomial(sterfte, regional_share),
+        'uitvaarten_2024': rng.binomial(rng.poisson(inwoners * 0.0097), regional_share),
+        'uitvaarten_2025': rng.binomial(rng.poisson(inwoners * 0.0099), regional_share),
+        'aantal_verzekerden': verzekerden,
+        'reistijd_min': np.round(rng.gamma(4, 5, count), 1),
+    })
+    # Enkele ontbrekende waarden, zoals in de echte data
+    excel.loc[rng.random(count) < 0.01, 'woonplaats'] = None
+    excel.loc[rng.random(count) < 0.02, 'reistijd_min'] = np.nan
+
+    print(f"Synthetische data {scale}: {count} gebieden schrijven naar {directory}")
+    gpd.GeoDataFrame({'PC4': pc4.astype(str)}, geometry=cells, crs='EPSG:4326').to_file(shapefile_path)
+    excel.to_excel(excel_path, index=False)
+    return excel_path, shapefile_path
+
+
+# Metingen
+
+def _measure(function, repeat):
+    """Mediaan van de duur over repeat keer, plus het piekgeheugen (tracemalloc) van één extra keer."""
+    durations = []
+    result = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {'seconds': statistics.median(durations), 'peak_mb': peak / 2 ** 20}
+
+
+def _import_in_new_process(modules):
+    """Importeer modules in een nieuw Python proces (koude start, niets in sys.modules)."""
+    code = ''.join(f"import {name}\n" for name in modules)
+    subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_benchmark(scale, repeat=3, directory=None):
+    """Meet de stappen van de pijplijn voor één schaal; geeft een dict stap -> meting."""
+    import plotly.express as px
+    from aggregation import (
+        AggregationViews, LEVEL_GEMEENTE, LEVEL_PC4, RollupCube, aggregate_to_gemeente,
+        build_gemeente_geometry, calculate_derived_metrics
+    )
+    from adjacency import add_neighbourhood_metrics, build_adjacency
+    from filters import FilterEngine
+    from map_layers import MAP_HEIGHT_PX, MAP_WIDTH_PX, build_topology_levels, GeometryPyramid
+    from map_figure import RASTER_SCALE, MapJob, build_map_figure, image_cache, label_cache
+    from map_raster import fit_bounds, render_labels
+    from pc4_data import compact_dtypes, load_merged_data, read_sources
+    from sql_engine import SqlEngine, SqlViews, available as duckdb_available, compare_views
+    from topology import Topology
+    from warmup import HEAVY_MODULES
+
+    directory = directory or os.path.join(BENCHMARK_DIR, scale)
+    excel_path, shapefile_path = generate_dataset(scale, directory)
+    snapshot_dir = os.path.join(directory, 'snapshots')
+    results = {}
+
+    def quiet(*args, **kwargs):
+        pass
+
+    def step(name, function, times=repeat):
+        # Meldingen van de pijplijn zelf (bijv. 'Snapshot ingelezen') niet tussen de resultaten
+        with contextlib.redirect_stdout(io.StringIO()):
+            value, measurement = _measure(function, times)
+        results[name] = measurement
+        print(f"  {name:<32} {measurement['seconds'] * 1000:>10.1f} ms {measurement['peak_mb']:>9.1f} MB")
+        return value
+
+    print(f"Benchmark {scale}")
+    # Koude start: wat app.py vóór de eerste weergave importeert, en alles daarna
+    step('imports (eerste weergave)', lambda: _import_in_new_process(['streamlit', 'profiling', 'upload_cache']), times=1)
+    step('imports (volledig)', lambda: _import_in_new_process(['streamlit'] + HEAVY_MODULES), times=1)
+    # Inlezen: bronbestanden (eerste keer) en daarna vanuit de snapshot
+    merged = step('load_data (bron)', lambda: read_sources(excel_path, shapefile_path, warn=quiet), times=1)
+    # Snapshot schrijven (niet gemeten), net als bij step() zonder meldingen tussen de resultaten
+    with contextlib.redirect_stdout(io.StringIO()):
+        load_merged_data(excel_path, shapefile_path, snapshot_dir=snapshot_dir, warn=quiet)
+    merged = step('load_data (snapshot)', lambda: load_merged_data(
+        excel_path, shapefile_path, snapshot_dir=snapshot_dir, warn=quiet))
+    compact = step('compact_dtypes', lambda: compact_dtypes(merged))
+    print(
+        f"  {'dataset in geheugen':<32} {merged.memory_usage(deep=True).sum() / 2 ** 20:>10.1f} MB"
+        f" -> {compact.memory_usage(deep=True).sum() / 2 ** 20:.1f} MB"
+    )
+    data = step('calculate_derived_metrics', lambda: calculate_derived_metrics(compact))
+
+    # Eenmalige voorbereiding per dataset
+    topology = step('topologie', lambda: Topology.build(data.geometry.values, ids=data['PC4']), times=1)
+    gemeente_geometry = step('gemeentegrenzen', lambda: build_gemeente_geometry(data, topology), times=1)
+    adjacency = step('burengraaf', lambda: build_adjacency(topology=topology), times=1)
+    step('buurmetrieken', lambda: add_neighbourhood_metrics(data, adjacency))
+    engine = step('filter engine', lambda: FilterEngine(data))
+    cube = step('rollup kubus', lambda: RollupCube(data, engine))
+
+    # Filterketen: een provincie, de helft van haar gemeenten en een smaller bereik
+    provincie = engine.cascade_options('provincie', ())[0]
+    gemeenten = engine.cascade_options('gemeente', (('provincie', (provincie,)),))
+    selections = {'provincie': [provincie], 'gemeente': gemeenten[::2]}
+    low, high = engine.value_bounds('berekend_marktaandeel_2023')
+    value_range = (low + (high - low) * 0.1, high - (high - low) * 0.1)
+
+    def filter_chain():
+        upstream = (('provincie', (provincie,)), ('gemeente', tuple(gemeenten[::2])))
+        for column in ('woonplaats', 'cluster', 'voorstel_onderneming', 'voorstel_benaming_uvb'):
+            engine.cascade_options(column, upstream)
+        mask = engine.apply(selections, {'berekend_marktaandeel_2023': value_range})
+        return engine.take(data, mask)
+    filtered = step('filterketen', filter_chain)
+
+    step('aggregate_to_gemeente', lambda: aggregate_to_gemeente(data, gemeente_geometry))
+
+    def statistics_block():
+        views = AggregationViews(filtered, gemeente_geometry)
+        views.summary(LEVEL_PC4)
+        views.summary(LEVEL_GEMEENTE)
+        views.ranking(LEVEL_PC4, 5)
+        views.ranking(LEVEL_GEMEENTE, 5)
+        cube.summary(selections)
+        return views
+    step('statistieken', statistics_block)
+
+    # Dezelfde filterstand en statistieken als queries in DuckDB (als die geïnstalleerd is)
+    if duckdb_available():
+        ranges = {'berekend_marktaandeel_2023': value_range}
+        sql_engine = step('duckdb tabel', lambda: SqlEngine(data, engine), times=1)
+
+        def sql_statistics_block():
+            views = SqlViews(sql_engine, data, selections, ranges, gemeente_geometry)
+            views.pc4
+            views.summary(LEVEL_PC4)
+            views.summary(LEVEL_GEMEENTE)
+            views.ranking(LEVEL_PC4, 5)
+            views.ranking(LEVEL_GEMEENTE, 5)
+            return views
+        sql_views = step('filters en statistieken (duckdb)', sql_statistics_block)
+        differences = compare_views(AggregationViews(filtered, gemeente_geometry), sql_views, group_column='provincie')
+        print(f"  {'duckdb tegen pandas':<32} {'gelijk' if not differences else f'{len(differences)} verschil(len)':>10}")
+        for difference in differences:
+            print(f"    {difference}")
+    else:
+        print(f"  {'duckdb':<32} {'niet geïnstalleerd':>10}")
+
+    # Kaart: detailniveaus (eenmalig) en daarna de figuur voor heel Nederland
+    ids, levels = step('detailniveaus', lambda: build_topology_levels(topology), times=1)
+    pyramid = GeometryPyramid(f"benchmark_{scale}", ids, levels)
+
+    def map_figure():
+        viz_data = pd.DataFrame(data.drop(columns=['geometry']))
+        center, zoom, lod = pyramid.view(viz_data['PC4'])
+        fig = px.choropleth_mapbox(
+            viz_data, geojson=pyramid.geojson(viz_data['PC4'], lod), locations='PC4', featureidkey='id',
+            color='berekend_marktaandeel_2023', mapbox_style='carto-positron', zoom=zoom, center=center,
+        )
+        return fig.to_json()
+    step('kaartfiguur', map_figure)
+
+    # Labelraster van alle gebieden op het detailniveau van de kaart (zonder cache), de
+    # duurste stap van de kaart als afbeelding
+    def label_raster():
+        lod = pyramid.view(data['PC4'].astype(str))[2]
+        bounds = fit_bounds(shapely.total_bounds(pyramid.levels[lod]))
+        return render_labels(pyramid.levels[lod], bounds, MAP_WIDTH_PX * RASTER_SCALE, MAP_HEIGHT_PX * RASTER_SCALE)
+    step('labelraster', label_raster)
+
+    # Dezelfde kaart als afbeelding: eerst met lege caches, daarna een ander kenmerk (het
+    # labelraster van de uitsnede wordt dan hergebruikt)
+    def map_image(column, cold):
+        if cold:
+            label_cache.clear()
+        image_cache.clear()
+        viz_data = pd.DataFrame(data.drop(columns=['geometry']))
+        viz_data['PC4'] = viz_data['PC4'].astype(str)
+        fig = build_map_figure(
+            MapJob(None), viz_data, column, column, pyramid=pyramid, feature_id_column='PC4',
+            raster=True, image_key=column
+        )
+        return fig.to_json()
+    step('kaartafbeelding', lambda: map_image('berekend_marktaandeel_2023', cold=True))
+    step('kaartafbeelding (ander kenmerk)', lambda: map_image('percentage_verzekerden', cold=False))
+    return results
+
+
+# Baseline
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    baseline = load_baseline(path)
+    baseline.update(results)
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+    print(f"Baseline opgeslagen: {path}")
+
+
+def compare(results, baseline, factor=REGRESSION_FACTOR):
+    """Druk de vergelijking af; geeft de lijst met (schaal, stap) die trager zijn geworden."""
+    regressions = []
+    for scale, steps in results.items():
+        reference = baseline.get(scale, {})
+        print(f"\nVergelijking {scale} met baseline")
+        print(f"  {'stap':<32} {'ms':>10} {'baseline':>10} {'factor':>7} {'MB':>9} {'baseline':>9}")
+        for name, measurement in steps.items():
+            base = reference.get(name)
+            if base is None:
+                print(f"  {name:<32} {measurement['seconds'] * 1000:>10.1f} {'-':>10} {'-':>7} {measurement['peak_mb']:>9.1f} {'-':>9}")
+                continue
+            ratio = measurement['seconds'] / base['seconds'] if base['seconds'] > 0 else 1.0
+            flag = '  <-- trager' if ratio > factor else ''
+            if ratio > factor:
+                regressions.append((scale, name))
+            print(
+                f"  {name:<32} {measurement['seconds'] * 1000:>10.1f} {base['seconds'] * 1000:>10.1f} "
+                f"{ratio:>7.2f} {measurement['peak_mb']:>9.1f} {base['peak_mb']:>9.1f}{flag}"
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark van het PC4 dashboard op synthetische data.")
+    parser.add_argument('--scale', nargs='+', choices=list(SCALES), default=['x1'])
+    parser.add_argument('--repeat', type=int, default=3, help="Aantal herhalingen per stap (mediaan)")
+    parser.add_argument('--data-dir', default=BENCHMARK_DIR, help="Map voor de synthetische data")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help="Sla de resultaten op als baseline")
+    parser.add_argument('--check', action='store_true', help="Exit code 1 bij een regressie")
+    parser.add_argument('--factor', type=float, default=REGRESSION_FACTOR)
+    args = parser.parse_args(argv)
+
+    results = {
+        scale: run_benchmark(scale, args.repeat, os.path.join(args.data_dir, scale))
+        for scale in args.scale
+    }
+    regressions = compare(results, load_baseline(args.baseline), args.factor)
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+    if regressions:
+        print(f"\n{len(regressions)} stap(pen) trager dan {args.factor}x de baseline")
+        return 1 if args.check else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
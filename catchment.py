@@ -0,0 +1,152 @@
+"""
+Verzorgingsgebieden op basis van reistijd: welke PC4-gebieden liggen binnen X minuten van
+een of meer (nieuwe of bestaande) locaties, en hoeveel sterfte, uitvaarten en verzekerden
+vallen daarbinnen.
+
+Eén keer per dataset worden een punt per PC4-gebied (binnen het gebied), een KD-tree
+daarover en de burengraaf (adjacency.py) met reistijden per stap opgebouwd. Een analyse is
+daarna een paar gevectoriseerde bewerkingen, ook voor veel locaties tegelijk:
+
+- 'weg': de locatie wordt aan het dichtstbijzijnde gebied gekoppeld (KD-tree) en de reistijd
+  loopt via buurgebieden (Dijkstra over de graaf, afgekapt op de drempel). Water zonder
+  verbinding tussen gebieden wordt zo niet overgestoken.
+- 'hemelsbreed': afstand in rechte lijn (KD-tree), maal een omrijfactor.
+
+De reistijden zijn een schatting met een vaste gemiddelde snelheid; reistijd_min in de data
+(de huidige reistijd per gebied) wordt gebruikt om te tonen waar een locatie sneller is.
+"""
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from aggregation import CUBE_SUM_COLUMNS, build_summary
+
+# Gemiddelde snelheid (km/u) en omrijfactor ten opzichte van de rechte lijn
+SPEED_KMH = 50
+DETOUR_FACTOR = 1.3
+
+# Standaard drempel in minuten
+DEFAULT_MAX_MINUTES = 20
+
+MODES = {'weg': "Via buurgebieden", 'hemelsbreed': "Hemelsbreed"}
+
+# Aantal bronnen per Dijkstra-aanroep (begrenst het geheugen bij veel locaties)
+SOURCE_BATCH = 64
+
+# Kilometers per graad breedte
+KM_PER_DEGREE = 111.32
+
+# Kleinste reistijd, zodat 0 minuten (locatie op het punt zelf) niet als 'leeg' wegvalt
+_MIN_MINUTES = 1e-6
+
+
+class CatchmentEngine:
+    """Punten, KD-tree en reistijdgraaf van de PC4-gebieden van één dataset."""
+
+    def __init__(self, data, adjacency, speed_kmh=SPEED_KMH, detour_factor=DETOUR_FACTOR):
+        self.ids = data['PC4'].astype(str).to_numpy()
+        self.speed_kmh = speed_kmh
+        self.detour_factor = detour_factor
+
+        points = shapely.point_on_surface(data.geometry.values)
+        lon, lat = shapely.get_x(points), shapely.get_y(points)
+        self.reference_lat = float(np.nanmean(lat))
+        self.xy = self.project(lon, lat)
+        self.tree = cKDTree(self.xy)
+
+        # Reistijd per stap naar een buurgebied: afstand tussen de punten (de omweg zit in de route)
+        edges = adjacency.tocoo()
+        hop_km = np.linalg.norm(self.xy[edges.row] - self.xy[edges.col], axis=1)
+        self.graph = sparse.csr_matrix(
+            (np.maximum(hop_km / speed_kmh * 60, _MIN_MINUTES), (edges.row, edges.col)), shape=adjacency.shape
+        )
+
+        self.columns = [col for col in CUBE_SUM_COLUMNS if col in data.columns]
+        self.totals = np.column_stack([data[col].to_numpy(dtype=float) for col in self.columns])
+        self.reistijd = data['reistijd_min'].to_numpy(dtype=float) if 'reistijd_min' in data.columns else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def project(self, lon, lat):
+        """Lengte- en breedtegraad naar kilometers in een vlak rond het midden van de data."""
+        lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+        return np.column_stack((
+            lon * KM_PER_DEGREE * np.cos(np.radians(self.reference_lat)), lat * KM_PER_DEGREE
+        ))
+
+    def _minutes(self, km):
+        return np.maximum(km * self.detour_factor / self.speed_kmh * 60, _MIN_MINUTES)
+
+    def travel_times(self, lon, lat, max_minutes=DEFAULT_MAX_MINUTES, mode='weg'):
+        """
+        Sparse matrix (locaties x PC4-gebieden) met de geschatte reistijd in minuten; alleen
+        gebieden binnen max_minutes hebben een waarde.
+        """
+        xy = self.project(lon, lat)
+        if mode == 'hemelsbreed':
+            reach_km = max_minutes / 60 * self.speed_kmh / self.detour_factor
+            pairs = cKDTree(xy).sparse_distance_matrix(self.tree, reach_km, output_type='ndarray')
+            return sparse.csr_matrix(
+                (self._minutes(pairs['v']), (pairs['i'], pairs['j'])), shape=(len(xy), len(self.ids))
+            )
+
+        # Naar het dichtstbijzijnde gebied en vandaar via de graaf; elke bron één keer
+        access_km, node = self.tree.query(xy)
+        access = self._minutes(access_km)
+        nodes, inverse = np.unique(node, return_inverse=True)
+        batches = []
+        for start in range(0, len(nodes), SOURCE_BATCH):
+            times = dijkstra(self.graph, directed=False, indices=nodes[start:start + SOURCE_BATCH], limit=max_minutes)
+            reachable = np.isfinite(times)
+            batches.append(sparse.csr_matrix(np.where(reachable, np.maximum(times, _MIN_MINUTES), 0)))
+        times = sparse.vstack(batches).tocsr()[inverse]
+        times.data += np.repeat(access, np.diff(times.indptr))
+        times.data[times.data > max_minutes] = 0
+        times.eliminate_zeros()
+        return times
+
+    def analyse(self, lon, lat, max_minutes=DEFAULT_MAX_MINUTES, mode='weg'):
+        """
+        Verzorgingsgebieden van de locaties. Geeft een dict met:
+        - 'locaties': per locatie het aantal gebieden en de totalen binnen de drempel, en in
+          hoeveel gebieden de locatie de snelste is en sneller dan de huidige reistijd;
+        - 'samenvatting': totalen over alle gebieden binnen bereik (zoals de statistieken);
+        - 'reistijd': kortste reistijd per bereikt gebied (Series met PC4 als index);
+        - 'sneller': aantal gebieden waar een locatie sneller is dan reistijd_min.
+        """
+        lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+        times = self.travel_times(lon, lat, max_minutes, mode)
+
+        inside = times.copy()
+        inside.data[:] = 1
+        per_location = pd.DataFrame(inside @ self.totals, columns=self.columns)
+        per_location.insert(0, 'aantal_pc4', np.diff(times.indptr))
+
+        # Per gebied de snelste locatie
+        entries = times.tocoo()
+        order = np.lexsort((entries.data, entries.col))
+        column, row, minutes = entries.col[order], entries.row[order], entries.data[order]
+        first = np.ones(len(column), dtype=bool)
+        first[1:] = column[1:] != column[:-1]
+        reached, nearest, best = column[first], row[first], minutes[first]
+
+        faster = np.zeros(len(reached), dtype=bool)
+        if self.reistijd is not None:
+            faster = best < np.nan_to_num(self.reistijd[reached], nan=np.inf)
+        per_location['snelste_pc4'] = np.bincount(nearest, minlength=len(lon))
+        per_location['sneller_dan_nu'] = np.bincount(nearest[faster], minlength=len(lon))
+        per_location.insert(0, 'lon', lon)
+        per_location.insert(0, 'lat', lat)
+
+        totals = dict(zip(self.columns, self.totals[reached].sum(axis=0)))
+        reistijd_mean = np.nanmean(self.reistijd[reached]) if self.reistijd is not None and len(reached) else 0
+        return {
+            'locaties': per_location,
+            'samenvatting': build_summary(len(reached), totals, reistijd_mean),
+            'reistijd': pd.Series(best, index=self.ids[reached], name='reistijd_schatting'),
+            'sneller': int(faster.sum()),
+        }
@@ -0,0 +1,116 @@
+"""
+Export van de gefilterde PC4 data (CSV, CSV met gzip of Parquet).
+
+Het bestand wordt pas gemaakt als iemand op de downloadknop klikt (st.download_button met
+een functie als data). Het wordt per blok rijen naar een SpooledTemporaryFile geschreven:
+kleine exports blijven in het geheugen, grote gaan naar schijf. Per dataset, filterstand
+en formaat wordt het resultaat bewaard, zodat een tweede klik niets opnieuw schrijft.
+"""
+import gzip
+import io
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Aantal rijen per geschreven blok
+CHUNK_ROWS = 20_000
+
+# Tot deze grootte blijft een export in het geheugen, daarboven in een tijdelijk bestand
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+DEFAULT_MAX_ENTRIES = int(os.environ.get('PC4_EXPORT_CACHE_ENTRIES', '8'))
+
+# Formaat -> (label, extensie, mime type)
+EXPORT_FORMATS = {
+    'csv': ("CSV", '.csv', 'text/csv'),
+    'csv.gz': ("CSV (gzip)", '.csv.gz', 'application/gzip'),
+    'parquet': ("Parquet", '.parquet', 'application/vnd.apache.parquet'),
+}
+
+
+def _chunks(data, chunk_rows=CHUNK_ROWS):
+    """Blokken rijen zonder geometrie; de geometrie wordt nooit in zijn geheel gekopieerd."""
+    columns = [col for col in data.columns if col != 'geometry']
+    for start in range(0, max(len(data), 1), chunk_rows):
+        yield data.iloc[start:start + chunk_rows][columns]
+
+
+def write_csv(data, fileobj, compress=False, chunk_rows=CHUNK_ROWS):
+    """Schrijf data als CSV (optioneel gzip) naar een binair bestand, blok voor blok."""
+    target = gzip.GzipFile(fileobj=fileobj, mode='wb') if compress else fileobj
+    text = io.TextIOWrapper(target, encoding='utf-8', newline='')
+    for i, chunk in enumerate(_chunks(data, chunk_rows)):
+        chunk.to_csv(text, header=(i == 0), index=False)
+    text.flush()
+    text.detach()
+    if compress:
+        target.close()
+
+
+def write_parquet(data, fileobj, chunk_rows=CHUNK_ROWS):
+    """Schrijf data als Parquet naar een binair bestand, één row group per blok."""
+    writer = None
+    for chunk in _chunks(data, chunk_rows):
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(fileobj, table.schema)
+        writer.write_table(table.cast(writer.schema))
+    writer.close()
+
+
+def write_export(data, fmt, fileobj):
+    if fmt == 'parquet':
+        write_parquet(data, fileobj)
+    else:
+        write_csv(data, fileobj, compress=(fmt == 'csv.gz'))
+
+
+class ExportCache:
+    """Gemaakte exports per sleutel (dataset, filterstand, formaat), met LRU opruimen."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _read(self, spool):
+        spool.seek(0)
+        return spool.read()
+
+    def get(self, key, data, fmt):
+        """Inhoud van de export als bytes; wordt alleen de eerste keer geschreven."""
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._read(self._entries[key])
+            self.misses += 1
+
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES, mode='w+b')
+        write_export(data, fmt, spool)
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = spool
+            else:
+                spool.close()
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                _, old = self._entries.popitem(last=False)
+                old.close()
+            return self._read(self._entries[key])
+
+    def clear(self):
+        with self._lock:
+            for spool in self._entries.values():
+                spool.close()
+            self._entries.clear()
+
+
+export_cache = ExportCache()
@@ -0,0 +1,268 @@
+"""
+Filters in de sidebar als bewerkingen op vooraf berekende maskers.
+
+Elke filterkolom wordt één keer per dataset als pandas Categorical opgeslagen (codes plus
+labels). Per categoriewaarde is er een bitmap (np.packbits, één bit per PC4-gebied), zodat
+een selectie een OR van een paar bitmaps is en filters samen een AND. Pas het eindmasker
+wordt op de GeoDataFrame toegepast, dus de geometrie wordt maar één keer gekopieerd.
+
+De keuzelijsten komen uit een index van welke waarden samen voorkomen (provincie ->
+gemeente -> woonplaats -> PC4, plus cluster en organisatie), per selectie gecachet.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# Filterkolommen in de volgorde van de sidebar (elke filter beperkt de keuzes van de volgende)
+FILTER_COLUMNS = [
+    'PC4', 'provincie', 'gemeente', 'woonplaats', 'cluster',
+    'voorstel_onderneming', 'voorstel_benaming_uvb'
+]
+
+# Label voor ontbrekende waarden in de keuzelijsten
+MISSING_LABEL = 'Onbekend'
+
+# Kolommen met waardebereik-filters (slider)
+RANGE_COLUMNS = ['berekend_marktaandeel_2023']
+
+# Maximale grootte van de bitmaps per kolom; bij meer (bijv. PC4 zelf) via een opzoektabel
+BITMAP_BUDGET_BYTES = 32 * 1024 * 1024
+
+# Aantal bewaarde keuzelijsten (per kolom en selectie van de filters erboven)
+OPTION_CACHE_ENTRIES = 512
+
+
+def _labels(values):
+    """Kolom als Categorical met tekstlabels; ontbrekende waarden als MISSING_LABEL."""
+    # Via een categorical hoeft elke unieke waarde maar één keer naar tekst (ook voor PC4 als getal)
+    categorical = values.astype('category').array.remove_unused_categories()
+    labels = categorical.categories.astype(str)
+    if labels.has_duplicates:
+        # Verschillende waarden met dezelfde tekst (bijv. 1 en '1'): per rij omzetten
+        return pd.Categorical(values.astype(object).where(values.notna(), MISSING_LABEL).astype(str))
+    codes = categorical.codes
+    if (codes < 0).any():
+        if MISSING_LABEL not in labels:
+            labels = labels.append(pd.Index([MISSING_LABEL]))
+        codes = np.where(codes < 0, labels.get_loc(MISSING_LABEL), codes)
+    order = labels.argsort()
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return pd.Categorical.from_codes(rank[codes], categories=labels[order])
+
+
+class FilterEngine:
+    """
+    Maskers en keuzelijsten voor één dataset. Maskers zijn packed bitmaps (uint8 arrays);
+    combineer ze met & en zet ze met take() om naar de gefilterde GeoDataFrame.
+    """
+
+    def __init__(self, data, columns=FILTER_COLUMNS, range_columns=RANGE_COLUMNS):
+        self.size = len(data)
+        self.categoricals = {}
+        for column in columns:
+            if column not in data.columns:
+                continue
+            self.categoricals[column] = _labels(data[column])
+        self.values = {
+            column: pd.to_numeric(data[column], errors='coerce').to_numpy(dtype=float)
+            for column in range_columns if column in data.columns
+        }
+        self._bitmaps = {}
+        self.option_index = OptionIndex(self)
+
+    def __contains__(self, column):
+        return column in self.categoricals
+
+    # Maskers
+
+    def full_mask(self):
+        """Masker zonder filter (alle gebieden)."""
+        return np.packbits(np.ones(self.size, dtype=bool))
+
+    def _bitmap_matrix(self, column):
+        """Per categorie een bitmap (rijen), of None als dat te veel geheugen kost."""
+        if column not in self._bitmaps:
+            categorical = self.categoricals[column]
+            row_bytes = (self.size + 7) // 8
+            if len(categorical.categories) * row_bytes > BITMAP_BUDGET_BYTES:
+                self._bitmaps[column] = None
+            else:
+                codes = categorical.codes
+                matrix = np.zeros((len(categorical.categories), self.size), dtype=bool)
+                matrix[codes, np.arange(self.size)] = True
+                self._bitmaps[column] = np.packbits(matrix, axis=1)
+        return self._bitmaps[column]
+
+    def select(self, column, selected):
+        """Masker van de gebieden waarvan de kolom een van de geselecteerde waarden heeft."""
+        categorical = self.categoricals[column]
+        codes = categorical.categories.get_indexer([str(value) for value in selected])
+        codes = codes[codes >= 0]
+        if len(codes) == 0:
+            return np.zeros((self.size + 7) // 8, dtype=np.uint8)
+
+        matrix = self._bitmap_matrix(column)
+        if matrix is not None:
+            return np.bitwise_or.reduce(matrix[codes], axis=0)
+        lookup = np.zeros(len(categorical.categories), dtype=bool)
+        lookup[codes] = True
+        return np.packbits(lookup[categorical.codes])
+
+    def between(self, column, low, high):
+        """Masker van de gebieden met een waarde binnen [low, high]."""
+        values = self.values[column]
+        return np.packbits((values >= low) & (values <= high))
+
+    def restrict(self, mask, column, selected):
+        """Beperk een bestaand masker tot de geselecteerde waarden (lege selectie: geen filter)."""
+        if not selected or column not in self.categoricals:
+            return mask
+        return mask & self.select(column, selected)
+
+    def apply(self, selections, ranges=None):
+        """
+        Eindmasker voor een complete filterstand: selections is een dict kolom -> waarden,
+        ranges een dict kolom -> (low, high).
+        """
+        mask = self.full_mask()
+        for column, selected in selections.items():
+            mask = self.restrict(mask, column, selected)
+        for column, value_range in (ranges or {}).items():
+            if value_range is not None and column in self.values:
+                mask = mask & self.between(column, *value_range)
+        return mask
+
+    def to_bool(self, mask):
+        return np.unpackbits(mask, count=self.size).astype(bool)
+
+    def count(self, mask):
+        return int(np.unpackbits(mask, count=self.size).sum())
+
+    def take(self, data, mask):
+        """De gefilterde rijen; de enige plek waar de (geo)data zelf wordt gekopieerd."""
+        rows = self.to_bool(mask)
+        if rows.all():
+            return data
+        return data[rows]
+
+    # Keuzelijsten
+
+    def options(self, column, mask=None):
+        """Gesorteerde waarden van de kolom die binnen het masker voorkomen."""
+        categorical = self.categoricals[column]
+        if mask is None:
+            return categorical.categories.tolist()
+        codes = categorical.codes[self.to_bool(mask)]
+        present = np.bincount(codes, minlength=len(categorical.categories)) > 0
+        return categorical.categories[present].tolist()
+
+    def cascade_options(self, column, upstream):
+        """
+        Keuzelijst van de kolom gegeven de selecties in de filters erboven; upstream is een
+        tuple van (kolom, tuple met waarden) paren, in de volgorde van de sidebar.
+        """
+        return self.option_index.options(column, upstream)
+
+    def value_bounds(self, column, mask=None):
+        """Minimum en maximum van een numerieke kolom binnen het masker (NaN als leeg)."""
+        values = self.values[column]
+        if mask is not None:
+            values = values[self.to_bool(mask)]
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return np.nan, np.nan
+        return float(values.min()), float(values.max())
+
+
+class OptionIndex:
+    """
+    Per kolompaar welke waarden samen voorkomen (als CSR: per code van de ene kolom de
+    gesorteerde codes van de andere). Een keuzelijst is dan de vereniging van een paar
+    rijen, in O(aantal opties) in plaats van een pass over alle PC4-gebieden.
+
+    Bij selecties in meerdere filters wordt gezocht naar een geselecteerde kolom die de
+    andere bepaalt (gemeente bepaalt provincie, PC4 bepaalt alles). Is die er niet
+    (bijv. provincie en cluster), dan valt de index terug op het masker.
+    """
+
+    def __init__(self, engine, max_entries=OPTION_CACHE_ENTRIES):
+        self.engine = engine
+        self.max_entries = max_entries
+        self._links = {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _link(self, source, target):
+        """(indptr, indices): voor elke code van source de codes van target die voorkomen."""
+        key = (source, target)
+        if key not in self._links:
+            source_codes = self.engine.categoricals[source].codes.astype(np.int64)
+            target_codes = self.engine.categoricals[target].codes.astype(np.int64)
+            target_count = len(self.engine.categoricals[target].categories)
+            pairs = np.unique(source_codes * target_count + target_codes)
+            indptr = np.searchsorted(
+                pairs // target_count, np.arange(len(self.engine.categoricals[source].categories) + 1)
+            )
+            self._links[key] = (indptr, pairs % target_count)
+        return self._links[key]
+
+    def _targets(self, source, target, codes):
+        indptr, indices = self._link(source, target)
+        if len(codes) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate([indices[indptr[code]:indptr[code + 1]] for code in codes]))
+
+    def _determines(self, source, target):
+        """Hoort bij elke waarde van source precies één waarde van target?"""
+        indptr, _ = self._link(source, target)
+        return bool(np.all(np.diff(indptr) <= 1))
+
+    def _codes(self, column, selected):
+        codes = self.engine.categoricals[column].categories.get_indexer([str(value) for value in selected])
+        return codes[codes >= 0]
+
+    def _compute(self, column, upstream):
+        categories = self.engine.categoricals[column].categories
+        selections = [(col, values) for col, values in upstream if values and col in self.engine]
+        if not selections:
+            return categories.tolist()
+
+        selected_columns = [col for col, _ in selections]
+        pivot = next((
+            col for col in reversed(selected_columns)
+            if all(other == col or self._determines(col, other) for other in selected_columns)
+        ), None)
+        if pivot is None:
+            mask = self.engine.apply(dict(selections))
+            return self.engine.options(column, mask)
+
+        # Alleen waarden van de bepalende kolom waarvan de 'ouders' ook geselecteerd zijn
+        codes = self._codes(pivot, dict(selections)[pivot])
+        for other, values in selections:
+            if other == pivot:
+                continue
+            indptr, indices = self._link(pivot, other)
+            allowed = np.zeros(len(self.engine.categoricals[other].categories), dtype=bool)
+            allowed[self._codes(other, values)] = True
+            # Elke categorie komt in de data voor, dus elke code heeft precies één ouder
+            codes = codes[allowed[indices[indptr[codes]]]]
+
+        if pivot == column:
+            return categories[np.sort(codes)].tolist()
+        return categories[self._targets(pivot, column, codes)].tolist()
+
+    def options(self, column, upstream):
+        key = (column, tuple((col, tuple(values)) for col, values in upstream))
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        result = self._compute(column, upstream)
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return result
@@ -0,0 +1,298 @@
+"""
+De kaartfiguur (Plotly) opbouwen naast de rest van de pagina.
+
+app.py toont eerst de sidebar en de statistieken; ondertussen worden de uitsnede, de
+GeoJSON en de Plotly figuur in een thread opgebouwd en op de plek van de kaart ingevoegd
+zodra ze klaar zijn. Per sessie loopt er hooguit één kaartopdracht: een nieuwere
+interactie die een andere kaart nodig heeft (andere filters, kenmerk of niveau) annuleert
+de vorige, dezelfde kaart wordt hergebruikt.
+
+Annuleren gebeurt tussen de stappen: een opdracht die nog in de wachtrij staat start niet
+meer, een lopende opdracht stopt bij de volgende controle.
+
+Bij veel vlakken (heel Nederland op PC4-niveau) tekent de server de kaart als afbeelding
+(map_raster.py) in plaats van duizenden polygonen naar de browser te sturen. De afbeelding
+ligt als image-laag op de kaart, met daarboven onzichtbare punten per gebied voor de
+tooltip, de kleurenschaal en selecties. Labelrasters (per uitsnede) en afbeeldingen (per
+filterstand en kenmerk) worden gedeeld door alle sessies bewaard.
+"""
+import base64
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import numpy as np
+import shapely
+
+from map_layers import MAP_HEIGHT_PX, MAP_WIDTH_PX, MONUTA_PALETTE, ROOD_GRIJS_GROEN_PALETTE, fit_view
+from map_raster import colorize, fit_bounds, paint_labels, render_labels, to_png
+
+# Threads voor kaartopdrachten, gedeeld door alle sessies
+MAP_WORKERS = 2
+
+# Hoe vaak (in seconden) de wachtende rerun de status bijwerkt; daarbij merkt Streamlit
+# ook een nieuwere interactie op
+WAIT_INTERVAL = 0.2
+
+MAP_HEIGHT = 600
+
+# Weergave van de kaart: automatisch vanaf RASTER_FEATURE_LIMIT gebieden als afbeelding
+MAP_MODES = {'auto': "Automatisch", 'vector': "Vlakken", 'raster': "Afbeelding"}
+RASTER_FEATURE_LIMIT = 1500
+
+# Pixels van de afbeelding per kaartpixel (scherp op hoge-resolutie schermen en bij inzoomen)
+RASTER_SCALE = 2
+
+# Doorzichtigheid van de vlakken, zoals bij de choropleth
+MAP_OPACITY = 0.7
+
+# Bewaarde labelrasters (per laag, detailniveau en uitsnede) en afbeeldingen
+LABEL_CACHE_ENTRIES = 8
+IMAGE_CACHE_ENTRIES = 32
+
+
+class MapCancelled(Exception):
+    """De kaartopdracht is geannuleerd door een nieuwere interactie."""
+
+
+class MapJob:
+    """Eén kaartopdracht: de sleutel (kaartstand), de future en het annuleersignaal."""
+
+    def __init__(self, key):
+        self.key = key
+        self.future = None
+        self._cancelled = threading.Event()
+        self.started = time.perf_counter()
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        """Tussen de stappen van de opdracht: stop als de kaart niet meer nodig is."""
+        if self._cancelled.is_set():
+            raise MapCancelled()
+
+    def wait(self, on_wait=None, interval=WAIT_INTERVAL):
+        """Resultaat van de opdracht; on_wait(seconden) wordt tijdens het wachten aangeroepen."""
+        while True:
+            try:
+                return self.future.result(timeout=interval)
+            except FutureTimeoutError:
+                if on_wait is not None:
+                    on_wait(time.perf_counter() - self.started)
+
+
+class MapJobs:
+    """De kaartopdracht van één sessie."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._job = None
+
+    def submit(self, executor, key, function, *args, **kwargs):
+        """
+        Start function(job, *args, **kwargs) in de executor, of geef de lopende opdracht
+        terug als die dezelfde sleutel heeft. Een opdracht met een andere sleutel wordt
+        geannuleerd.
+        """
+        with self._lock:
+            if self._job is not None and self._job.key == key and not self._job.cancelled:
+                return self._job
+            if self._job is not None:
+                self._job.cancel()
+            job = MapJob(key)
+
+            def run():
+                job.check()
+                return function(job, *args, **kwargs)
+
+            job.future = executor.submit(run)
+            self._job = job
+            return job
+
+    def cancel(self):
+        with self._lock:
+            if self._job is not None:
+                self._job.cancel()
+                self._job = None
+
+
+class RasterCache:
+    """Berekende rasters of afbeeldingen per sleutel, met LRU opruimen."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, function):
+        """Waarde voor de sleutel; function() wordt alleen aangeroepen als die er nog niet is."""
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+
+        value = function()
+
+        with self._lock:
+            self._entries.setdefault(key, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+label_cache = RasterCache(LABEL_CACHE_ENTRIES)
+image_cache = RasterCache(IMAGE_CACHE_ENTRIES)
+
+
+def use_raster(mode, feature_count, categorical=False, pyramid=None):
+    """
+    Kaart als afbeelding of als vlakken. Alleen voor numerieke kenmerken op een laag met
+    vlakken (pyramid); automatisch vanaf RASTER_FEATURE_LIMIT gebieden.
+    """
+    if pyramid is None or categorical or mode == 'vector':
+        return False
+    return mode == 'raster' or feature_count >= RASTER_FEATURE_LIMIT
+
+
+def _raster_layer(job, pyramid, lod, positions, values, value_range, image_key):
+    """
+    PNG (als data-URI) van de gebieden op posities in de piramide, plus de hoeken
+    (lon, lat) voor de image-laag van mapbox.
+    """
+    layer_bounds = pyramid.bounds[positions]
+    bounds = fit_bounds((
+        np.nanmin(layer_bounds[:, 0]), np.nanmin(layer_bounds[:, 1]),
+        np.nanmax(layer_bounds[:, 2]), np.nanmax(layer_bounds[:, 3]),
+    ))
+    width, height = MAP_WIDTH_PX * RASTER_SCALE, MAP_HEIGHT_PX * RASTER_SCALE
+
+    def draw_labels():
+        # Alle vlakken binnen de uitsnede (ook niet-geselecteerde), zodat het raster per uitsnede herbruikbaar is
+        minx, miny, maxx, maxy = bounds
+        inside = np.flatnonzero(
+            (pyramid.bounds[:, 2] >= minx) & (pyramid.bounds[:, 0] <= maxx)
+            & (pyramid.bounds[:, 3] >= miny) & (pyramid.bounds[:, 1] <= maxy)
+        )
+        return render_labels(pyramid.levels[lod][inside], bounds, width, height, labels=inside)
+
+    def draw_image():
+        labels = label_cache.get((pyramid.name, lod, bounds, width, height), draw_labels)
+        job.check()
+        colors = np.zeros((len(pyramid.ids), 3), dtype=np.uint8)
+        visible = np.zeros(len(pyramid.ids), dtype=bool)
+        shown = ~np.isnan(values)
+        colors[positions[shown]] = colorize(values[shown], ROOD_GRIJS_GROEN_PALETTE, value_range)
+        visible[positions[shown]] = True
+        image = paint_labels(labels, colors, visible, opacity=MAP_OPACITY, background=(0, 0, 0, 0))
+        return "data:image/png;base64," + base64.b64encode(to_png(image)).decode('ascii')
+
+    source = image_cache.get((image_key, pyramid.name, lod, bounds), draw_image)
+    minx, miny, maxx, maxy = bounds
+    return source, [[minx, maxy], [maxx, maxy], [maxx, miny], [minx, miny]]
+
+
+def build_map_figure(job, viz_data, color_column, label, categorical=False, hover_data=None,
+                     pyramid=None, feature_id_column=None, use_static=False, raster=False, image_key=None):
+    """
+    Plotly figuur van de kaart: punten (zonder pyramid) of vlakken uit de gecachte GeoJSON
+    van de piramide, numeriek met de rood-grijs-groen schaal of categorisch. Met raster
+    worden de vlakken op de server getekend (image_key: sleutel van de afbeelding, bijv.
+    dataset, filterstand en kenmerk).
+    """
+    # Plotly is alleen nodig voor de kaart
+    import plotly.express as px
+
+    colors = (
+        {'color_discrete_sequence': MONUTA_PALETTE} if categorical
+        else {'color_continuous_scale': ROOD_GRIJS_GROEN_PALETTE}
+    )
+    if pyramid is None:
+        center, zoom = fit_view(viz_data.total_bounds)
+        job.check()
+        fig = px.scatter_mapbox(
+            viz_data,
+            lat=viz_data.geometry.y,
+            lon=viz_data.geometry.x,
+            color=color_column,
+            size_max=15,  # Max grootte van punten
+            zoom=zoom,
+            mapbox_style="carto-positron",
+            center=center,
+            hover_data=hover_data,
+            labels={color_column: label},
+            **colors
+        )
+    elif raster:
+        center, zoom, lod = pyramid.view(viz_data[feature_id_column])
+        positions = pyramid.ids.get_indexer(viz_data[feature_id_column].astype(str))
+        found = positions >= 0
+        positions = positions[found]
+        values = viz_data[color_column].to_numpy(dtype=float)[found]
+        finite = values[np.isfinite(values)]
+        value_range = (float(finite.min()), float(finite.max())) if len(finite) else (0.0, 1.0)
+        job.check()
+        source, coordinates = _raster_layer(job, pyramid, lod, positions, values, value_range, image_key)
+        job.check()
+
+        # Onzichtbare punten per gebied: tooltip, kleurenschaal en selectie (het id in custom_data)
+        points = label_cache.get((pyramid.name, 'punten'), lambda: shapely.point_on_surface(pyramid.levels[0]))[positions]
+        fig = px.scatter_mapbox(
+            viz_data[found],
+            # Op ca. 10 m nauwkeurig: genoeg om een gebied aan te wijzen, en kleiner om te versturen
+            lat=np.round(shapely.get_y(points), 4),
+            lon=np.round(shapely.get_x(points), 4),
+            color=color_column,
+            range_color=value_range,
+            custom_data=[feature_id_column],
+            zoom=zoom,
+            mapbox_style="carto-positron",
+            center=center,
+            hover_data=hover_data,
+            labels={color_column: label},
+            **colors
+        )
+        fig.update_traces(marker={'size': 8, 'opacity': 0})
+        fig.update_layout(mapbox_layers=[{
+            'sourcetype': 'image', 'source': source, 'coordinates': coordinates, 'below': 'traces',
+        }])
+    else:
+        # Uitsnede en het grofste detailniveau dat daarbij niet zichtbaar verschilt
+        center, zoom, lod = pyramid.view(viz_data[feature_id_column])
+        job.check()
+        # Bij grote selecties downloadt de browser de vormen via een statisch bestand maar één keer
+        geojson = pyramid.geojson(viz_data[feature_id_column], lod, use_static=use_static)
+        job.check()
+        fig = px.choropleth_mapbox(
+            viz_data,
+            geojson=geojson,
+            locations=feature_id_column,
+            featureidkey="id",
+            color=color_column,
+            mapbox_style="carto-positron",
+            zoom=zoom,
+            center=center,
+            opacity=0.7,
+            hover_data=hover_data,
+            labels={color_column: label},
+            **colors
+        )
+    job.check()
+    fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0}, height=MAP_HEIGHT)
+    return fig
@@ -0,0 +1,211 @@
+"""
+GeoJSON voor de kaart, één keer per niveau (PC4 of gemeente) en detailniveau geserialiseerd.
+
+Plotly accepteert de geometrie als GeoJSON object of als URL. Als Streamlit statische
+bestanden serveert (server.enableStaticServing) wordt de GeoJSON één keer als bestand
+weggeschreven en haalt de browser hem via de URL op (en bewaart hem in de HTTP cache).
+Bij een filterwijziging gaan dan alleen de locaties en waarden mee. Zonder statische
+bestanden wordt een deelverzameling van de al geserialiseerde features meegestuurd.
+
+Per laag is er een piramide van vereenvoudigingsniveaus (level of detail). Gedeelde grenzen
+worden één keer per arc vereenvoudigd (topology.py), zodat buren op elkaar blijven
+aansluiten. De kaart kiest het grofste niveau dat bij de zichtbare uitsnede nog geen zichtbaar verschil geeft.
+"""
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from profiling import span
+
+logger = logging.getLogger(__name__)
+
+# Toleranties (in graden) van de detailniveaus, van fijn naar grof
+LOD_TOLERANCES = (0.0001, 0.0003, 0.001, 0.003, 0.008)
+
+# Boven dit aantal coördinaten wordt een grover niveau gekozen, ook als dat zichtbaar is
+VERTEX_BUDGET = 250_000
+
+# Tot dit aantal gebieden gaan alleen de geselecteerde vormen mee in de figuur
+INLINE_FEATURE_LIMIT = 400
+
+# Afmetingen van de kaart in pixels (kolom van 2/3 breed, hoogte 600)
+MAP_WIDTH_PX = 800
+MAP_HEIGHT_PX = 600
+
+# Kleurenschalen: rood naar groen via grijs voor numerieke data, Monuta kleuren voor categorieën
+ROOD_GRIJS_GROEN_PALETTE = ["#ff0000", "#ff4d4d", "#ff9999", "#ffcccc", "#e0e0e0", "#ccffcc", "#99ff99", "#4dff4d", "#00ff00"]
+MONUTA_PALETTE = ["#3f582d", "#74975d", "#6e0038", "#d87f7e", "#d763a9", "#66b3c9"]
+
+# Standaard uitsnede: heel Nederland
+NL_CENTER = {"lat": 52.1326, "lon": 5.2913}
+NL_ZOOM = 6.5
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+GEOJSON_SUBDIR = 'geojson'
+
+
+class GeoJSONPayload:
+    """Features met een stabiel id (PC4 of gemeentenaam) voor choropleth_mapbox."""
+
+    def __init__(self, name, ids, geometries):
+        self.name = name
+        ids = [str(i) for i in ids]
+        # Vectorieel naar GeoJSON; gebeurt maar één keer per niveau
+        geometry_json = shapely.to_geojson(np.asarray(geometries))
+        self.features = {}
+        for feature_id, geometry_text in zip(ids, geometry_json):
+            if geometry_text is None:
+                continue
+            self.features[feature_id] = {
+                'type': 'Feature',
+                'id': feature_id,
+                'properties': {},
+                'geometry': json.loads(geometry_text),
+            }
+        self._lock = threading.Lock()
+
+    def subset(self, ids):
+        """FeatureCollection met alleen de gevraagde features (zonder opnieuw te serialiseren)."""
+        features = self.features
+        return {
+            'type': 'FeatureCollection',
+            'features': [features[i] for i in map(str, ids) if i in features],
+        }
+
+    def url(self, static_dir=STATIC_DIR):
+        """Relatieve URL van het statische GeoJSON bestand; wordt weggeschreven als het ontbreekt."""
+        file_name = f"{self.name}.geojson"
+        path = os.path.join(static_dir, GEOJSON_SUBDIR, file_name)
+        with self._lock:
+            # Ook na het opruimen van oude bestanden (pc4_data.prune_snapshots) opnieuw wegschrijven
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump({'type': 'FeatureCollection', 'features': list(self.features.values())}, f, separators=(',', ':'))
+                os.replace(tmp_path, path)
+        return f"app/static/{GEOJSON_SUBDIR}/{file_name}"
+
+
+def layer_ids(data, id_column):
+    """Ids van een laag; id_column None betekent dat de ids in de index staan."""
+    return data.index if id_column is None else data[id_column]
+
+
+def simplify_coverage(geometries, tolerance):
+    """Vereenvoudig alle vormen samen, zodat gedeelde grenzen gelijk blijven."""
+    geometries = np.asarray(geometries)
+    polygonal = np.isin(shapely.get_type_id(geometries), (3, 6))
+    if polygonal.all():
+        try:
+            return shapely.coverage_simplify(geometries, tolerance)
+        except (AttributeError, shapely.errors.GEOSException) as e:
+            # Oudere GEOS (< 3.12) of geen geldige coverage
+            logger.warning(f"Coverage vereenvoudiging niet mogelijk ({type(e).__name__}), per vorm vereenvoudigen.")
+    return shapely.simplify(geometries, tolerance, preserve_topology=True)
+
+
+def build_lod_levels(geometries, tolerances=LOD_TOLERANCES):
+    """Lijst met per tolerantie een array van vereenvoudigde geometrieën."""
+    return [simplify_coverage(geometries, tolerance) for tolerance in tolerances]
+
+
+def build_topology_levels(topology, groups=None, tolerances=LOD_TOLERANCES):
+    """
+    Detailniveaus uit de gedeelde arcs van de PC4-topologie (zie topology.py). Zonder
+    groups de PC4-vormen zelf, met groups (bijv. de gemeente per PC4) de samengevoegde vormen.
+    Geeft de ids en per tolerantie een array met geometrieën.
+    """
+    ids, levels = topology.ids, []
+    for tolerance in tolerances:
+        arcs = topology.simplified_arcs(tolerance)
+        if groups is None:
+            levels.append(topology.geometries(arcs))
+        else:
+            merged = topology.merge(groups, arcs)
+            ids = merged.index
+            levels.append(np.asarray(merged.values))
+    return ids, levels
+
+
+def _mercator_y(lat):
+    return np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+
+
+def fit_view(bounds, width=MAP_WIDTH_PX, height=MAP_HEIGHT_PX):
+    """Centrum en zoomniveau (mapbox, 512px tegels) waarin de uitsnede past."""
+    minx, miny, maxx, maxy = bounds
+    if not np.all(np.isfinite(bounds)):
+        return NL_CENTER, NL_ZOOM
+
+    dx = max(maxx - minx, 1e-6)
+    dy = max(_mercator_y(maxy) - _mercator_y(miny), 1e-6)
+    zoom_x = np.log2(width * 360 / (512 * dx))
+    zoom_y = np.log2(height * 2 * np.pi / (512 * dy))
+    # Iets uitzoomen voor wat ruimte rond de selectie
+    zoom = float(np.clip(min(zoom_x, zoom_y) - 0.2, 5, 14))
+
+    center_y = (_mercator_y(maxy) + _mercator_y(miny)) / 2
+    center_lat = float(np.degrees(2 * np.arctan(np.exp(center_y)) - np.pi / 2))
+    return {"lat": center_lat, "lon": float((minx + maxx) / 2)}, zoom
+
+
+def pixel_size(zoom):
+    """Breedte van één pixel in graden lengte bij het gegeven zoomniveau."""
+    return 360 / (512 * 2 ** zoom)
+
+
+class GeometryPyramid:
+    """Detailniveaus van één laag, met per niveau een (lui opgebouwde) GeoJSON payload."""
+
+    def __init__(self, name, ids, levels, tolerances=LOD_TOLERANCES):
+        self.name = name
+        self.ids = pd.Index([str(i) for i in ids])
+        self.levels = levels
+        self.tolerances = tolerances
+        self.bounds = shapely.bounds(levels[0])
+        self.vertex_counts = [shapely.get_num_coordinates(level) for level in levels]
+        self._payloads = {}
+        self._lock = threading.Lock()
+
+    def positions(self, ids):
+        positions = self.ids.get_indexer([str(i) for i in ids])
+        return positions[positions >= 0]
+
+    def view(self, ids):
+        """Kies centrum, zoom en detailniveau voor de gegeven gebieden."""
+        positions = self.positions(ids)
+        if len(positions) == 0:
+            return NL_CENTER, NL_ZOOM, len(self.levels) - 1
+        bounds = self.bounds[positions]
+        center, zoom = fit_view((
+            np.nanmin(bounds[:, 0]), np.nanmin(bounds[:, 1]),
+            np.nanmax(bounds[:, 2]), np.nanmax(bounds[:, 3]),
+        ))
+
+        # Grofste niveau waarvan de tolerantie kleiner is dan één pixel
+        lossless = [i for i, tolerance in enumerate(self.tolerances) if tolerance <= pixel_size(zoom)]
+        lod = lossless[-1] if lossless else 0
+        # Te veel coördinaten voor de browser: stap naar een grover niveau
+        while lod < len(self.levels) - 1 and self.vertex_counts[lod][positions].sum() > VERTEX_BUDGET:
+            lod += 1
+        return center, zoom, lod
+
+    def payload(self, lod):
+        with self._lock:
+            if lod not in self._payloads:
+                with span("geojson serialiseren"):
+                    self._payloads[lod] = GeoJSONPayload(f"{self.name}_lod{lod}", self.ids, self.levels[lod])
+            return self._payloads[lod]
+
+    def geojson(self, ids, lod, use_static=False):
+        """URL van het statische bestand (grote selecties) of alleen de geselecteerde features."""
+        payload = self.payload(lod)
+        if use_static and len(ids) > INLINE_FEATURE_LIMIT:
+            return payload.url()
+        return payload.subset(ids)
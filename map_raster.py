@@ -0,0 +1,236 @@
+"""
+Kaarten als afbeelding (PNG), zonder browser of Plotly.
+
+Polygonen worden in Web Mercator (dezelfde projectie als de kaart in de app) op een
+vaste uitsnede gerasterd met numpy (scanline over alle randen tegelijk) en gekleurd met
+een continue kleurenschaal; Pillow schrijft de PNG en tekent de legenda. De vormen worden
+niet vereenvoudigd: buren delen dan precies dezelfde grens en er ontstaan geen kieren.
+
+Het tekenen gebeurt in twee stappen: render_labels tekent per pixel welk gebied er ligt
+(een labelraster), paint_labels kleurt dat raster met één opzoektabel over alle pixels.
+Een labelraster hangt alleen af van de vormen en de uitsnede, dus een ander kenmerk of
+een andere selectie binnen dezelfde uitsnede hoeft niet opnieuw te worden getekend.
+"""
+import io
+
+import numpy as np
+import shapely
+from PIL import Image, ImageDraw, ImageFont
+
+from map_layers import MAP_HEIGHT_PX, MAP_WIDTH_PX, ROOD_GRIJS_GROEN_PALETTE, _mercator_y
+
+# Ruimte rond de uitsnede (fractie van breedte en hoogte)
+MAP_MARGIN = 0.05
+
+# Grenzen worden alleen getekend als een gebied gemiddeld minstens zoveel pixels breed is
+OUTLINE_MIN_PX = 6
+
+BACKGROUND = (255, 255, 255, 255)
+OUTLINE = (255, 255, 255, 255)
+
+# Hoogte van de legenda onder de kaart
+LEGEND_HEIGHT_PX = 44
+
+# Label in het labelraster voor pixels zonder gebied
+NO_LABEL = -1
+
+# Aantal coördinaten of pixels per blok bij het rasteren (begrenst het geheugen)
+SCANLINE_BLOCK = 1 << 18
+
+
+def _rgb(color):
+    color = color.lstrip('#')
+    return tuple(int(color[i:i + 2], 16) for i in (0, 2, 4))
+
+
+def _latitude(mercator_y):
+    return float(np.degrees(2 * np.arctan(np.exp(mercator_y)) - np.pi / 2))
+
+
+def colorize(values, palette=ROOD_GRIJS_GROEN_PALETTE, value_range=None):
+    """RGB per waarde (uint8, n x 3) door lineair tussen de kleuren van de schaal te interpoleren."""
+    values = np.asarray(values, dtype=float)
+    stops = np.array([_rgb(color) for color in palette], dtype=float)
+    low, high = value_range if value_range is not None else (np.nanmin(values), np.nanmax(values))
+    scaled = (values - low) / (high - low) if high > low else np.full(len(values), 0.5)
+    position = np.clip(np.nan_to_num(scaled, nan=0.5), 0, 1) * (len(stops) - 1)
+    lower = np.minimum(position.astype(int), len(stops) - 2)
+    fraction = (position - lower)[:, None]
+    return np.rint(stops[lower] * (1 - fraction) + stops[lower + 1] * fraction).astype(np.uint8)
+
+
+def fit_bounds(bounds, width=MAP_WIDTH_PX, height=MAP_HEIGHT_PX, margin=MAP_MARGIN):
+    """
+    Breid (minx, miny, maxx, maxy) in graden uit tot de verhouding van de afbeelding
+    (in Web Mercator), met wat marge; de uitsnede voor render_map.
+    """
+    minx, miny, maxx, maxy = bounds
+    x0, x1 = np.radians(minx), np.radians(maxx)
+    y0, y1 = _mercator_y(miny), _mercator_y(maxy)
+    dx = max(x1 - x0, 1e-9) * (1 + 2 * margin)
+    dy = max(y1 - y0, 1e-9) * (1 + 2 * margin)
+    scale = max(dx / width, dy / height)
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+    half_x, half_y = scale * width / 2, scale * height / 2
+    return (
+        float(np.degrees(cx - half_x)), _latitude(cy - half_y),
+        float(np.degrees(cx + half_x)), _latitude(cy + half_y),
+    )
+
+
+def render_labels(geometries, bounds, width=MAP_WIDTH_PX, height=MAP_HEIGHT_PX, labels=None):
+    """
+    Labelraster (height x width, int32) van de polygonen op de uitsnede (bounds, in graden):
+    per pixel het label van het gebied (standaard de positie in geometries), NO_LABEL waar
+    geen gebied ligt. Grote gebieden eerst, zodat enclaves erbovenop komen.
+
+    Gevectoriseerde scanline over alle randen tegelijk (in blokken van SCANLINE_BLOCK
+    coördinaten en pixels, dat begrenst het geheugen): per pixelrij de snijpunten met de
+    randen, per gebied op volgorde; tussen elk paar snijpunten ligt het gebied (even-oneven,
+    dus gaten vallen weg). Een pixel hoort bij een gebied als het midden erin ligt.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    labels = np.arange(len(geometries)) if labels is None else np.asarray(labels)
+    keep = ~shapely.is_missing(geometries)
+    labels = labels[keep]
+    parts, owner = shapely.get_parts(geometries[keep], return_index=True)
+    order = np.argsort(-shapely.area(parts), kind='stable')
+    parts, owner = parts[order], owner[order]
+
+    # Blokken naar het aantal coördinaten en snijpunten (ongeveer twee per pixelrij van een deel)
+    part_bounds = shapely.bounds(parts)
+    rows_per_y = height / (_mercator_y(bounds[3]) - _mercator_y(bounds[1]))
+    rows = (_mercator_y(part_bounds[:, 3]) - _mercator_y(part_bounds[:, 1])) * rows_per_y
+    sizes = shapely.get_num_coordinates(parts) + 2 * np.nan_to_num(np.clip(rows, 0, height)).astype(np.int64)
+
+    # Per pixel het volgnummer van het laatst getekende deel
+    top = np.full(height * width, -1, dtype=np.int32)
+    for block in _blocks(sizes):
+        _scan_parts(parts[block], block, bounds, width, height, top)
+
+    # Volgnummer -> label; -1 (geen deel) valt op het laatste element, NO_LABEL
+    lookup = np.append(labels[owner], NO_LABEL).astype(np.int32)
+    return lookup[top].reshape(height, width)
+
+
+def _scan_parts(parts, numbers, bounds, width, height, top):
+    """Teken polygonen (met hun volgnummer) in top; een hoger nummer wint."""
+    minx, miny, maxx, maxy = bounds
+    x0, x1 = np.radians(minx), np.radians(maxx)
+    y0, y1 = _mercator_y(miny), _mercator_y(maxy)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, ring_index = shapely.get_coordinates(rings, return_index=True)
+    px = (np.radians(coords[:, 0]) - x0) / (x1 - x0) * width
+    py = (y1 - _mercator_y(coords[:, 1])) / (y1 - y0) * height
+
+    # Randen (van coördinaat i naar i + 1 binnen dezelfde ring) en de pixelrijen waarvan het
+    # midden tussen de uiteinden ligt (halfopen, zodat een hoekpunt maar één keer telt).
+    # Randen zonder zo'n rij doen niet mee.
+    low = np.clip(np.ceil(np.minimum(py[:-1], py[1:]) - 0.5), 0, height).astype(np.int64)
+    high = np.clip(np.ceil(np.maximum(py[:-1], py[1:]) - 0.5), 0, height).astype(np.int64)
+    edges = np.flatnonzero((high > low) & (ring_index[1:] == ring_index[:-1]))
+    edge, row = _expand(low[edges], high[edges])
+    edge = edges[edge]
+    x = px[edge] + (row + 0.5 - py[edge]) / (py[edge + 1] - py[edge]) * (px[edge + 1] - px[edge])
+    part = numbers[ring_part[ring_index[edge]]]
+
+    # Per deel en rij de snijpunten op volgorde; elk paar is een stuk rij binnen het deel
+    order = np.lexsort((x, row, part))
+    x, row, part = x[order], row[order], part[order]
+    first = row[0::2] * width + np.clip(np.ceil(x[0::2] - 0.5), 0, width).astype(np.int64)
+    last = row[0::2] * width + np.clip(np.ceil(x[1::2] - 0.5), 0, width).astype(np.int64)
+    last = np.maximum(last, first)
+    part = part[0::2].astype(np.int32)
+
+    for spans in _blocks(last - first):
+        span, pixel = _expand(first[spans], last[spans])
+        np.maximum.at(top, pixel, part[spans][span])
+
+
+def _blocks(sizes, block=SCANLINE_BLOCK):
+    """Posities opgedeeld in opeenvolgende blokken van samen ongeveer block."""
+    ends = np.cumsum(sizes)
+    cuts = np.searchsorted(ends, np.arange(block, ends[-1] if len(ends) else 0, block))
+    return np.split(np.arange(len(sizes)), cuts)
+
+
+def _expand(start, stop):
+    """Voor reeksen [start, stop): per element het reeksnummer en de waarde."""
+    counts = stop - start
+    index = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return index, start[index] + offsets
+
+
+def paint_labels(labels, colors, visible=None, opacity=1.0, background=BACKGROUND, outline=True):
+    """
+    Kleur een labelraster: colors is RGB (n x 3) per label 0..n-1. Labels die niet
+    zichtbaar zijn (visible False) en pixels zonder gebied krijgen de achtergrond; met
+    outline een lijn van één pixel op de grens tussen twee zichtbare gebieden.
+    """
+    count = len(colors)
+    lookup = np.empty((count + 1, 4), dtype=np.uint8)
+    lookup[:count, :3] = colors
+    lookup[:count, 3] = int(round(opacity * 255))
+    lookup[count] = background
+    if visible is not None:
+        lookup[:count][~np.asarray(visible, dtype=bool)] = background
+    index = np.where(labels == NO_LABEL, count, labels)
+    rgba = lookup[index]
+
+    if outline:
+        shown = lookup[index, 3] > 0 if visible is not None else index != count
+        edges = np.zeros(labels.shape, dtype=bool)
+        edges[:, 1:] |= labels[:, 1:] != labels[:, :-1]
+        edges[1:, :] |= labels[1:, :] != labels[:-1, :]
+        rgba[edges & shown] = OUTLINE
+    return Image.fromarray(rgba, 'RGBA')
+
+
+def render_map(geometries, values, bounds=None, width=MAP_WIDTH_PX, height=MAP_HEIGHT_PX,
+               palette=ROOD_GRIJS_GROEN_PALETTE, value_range=None, opacity=1.0, background=BACKGROUND):
+    """
+    Teken de polygonen gekleurd op hun waarde als RGBA afbeelding. De uitsnede (bounds, in
+    graden) valt precies op de randen van de afbeelding; zonder bounds die van de geometrie
+    via fit_bounds. Gebieden zonder waarde worden niet getekend.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    values = np.asarray(values, dtype=float)
+    if bounds is None:
+        bounds = fit_bounds(shapely.total_bounds(geometries), width, height)
+    keep = ~np.isnan(values) & ~shapely.is_missing(geometries)
+    if not keep.any():
+        return Image.new('RGBA', (width, height), background)
+
+    labels = render_labels(geometries[keep], bounds, width, height)
+    colors = colorize(values[keep], palette, value_range)
+    # Grenzen alleen als een gebied gemiddeld breed genoeg is
+    draw_outline = width / np.sqrt(shapely.get_num_geometries(geometries[keep]).sum()) >= OUTLINE_MIN_PX
+    return paint_labels(labels, colors, opacity=opacity, background=background, outline=draw_outline)
+
+
+def add_legend(image, value_range, label='', palette=ROOD_GRIJS_GROEN_PALETTE, height=LEGEND_HEIGHT_PX):
+    """Kaart met daaronder een kleurenbalk van de schaal, met minimum en maximum."""
+    width = image.width
+    canvas = Image.new('RGBA', (width, image.height + height), BACKGROUND)
+    canvas.paste(image, (0, 0))
+    bar = colorize(np.linspace(0, 1, width - 20), palette, (0, 1))
+    strip = np.repeat(np.concatenate([bar, np.full((len(bar), 1), 255, dtype=np.uint8)], axis=1)[None], 10, axis=0)
+    canvas.paste(Image.fromarray(strip, 'RGBA'), (10, image.height + 6))
+
+    draw = ImageDraw.Draw(canvas)
+    font = ImageFont.load_default()
+    low, high = value_range
+    y = image.height + 20
+    draw.text((10, y), f"{low:.2f}", fill=(0, 0, 0, 255), font=font)
+    high_text = f"{high:.2f}"
+    draw.text((width - 10 - draw.textlength(high_text, font=font), y), high_text, fill=(0, 0, 0, 255), font=font)
+    if label:
+        draw.text(((width - draw.textlength(label, font=font)) / 2, y), label, fill=(0, 0, 0, 255), font=font)
+    return canvas
+
+
+def to_png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
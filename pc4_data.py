@@ -0,0 +1,663 @@
+"""
+Inladen van de PC4 dataset (Excel + shapefile) met een GeoParquet snapshot.
+
+Het inlezen van het Excel bestand (openpyxl) en de shapefile is traag. Het samengevoegde,
+vereenvoudigde resultaat wordt daarom eenmalig weggeschreven als GeoParquet snapshot.
+Volgende starts lezen die snapshot (memory-mapped) in plaats van de bronbestanden.
+
+Snapshot vooraf bouwen, bijvoorbeeld tijdens de deploy:
+
+    python pc4_data.py --excel data/PC4_verrijkt.xlsx --shapefile data/PC4.shp
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from scipy import sparse
+
+from adjacency import BORDER_TOLERANCE, MIN_SHARED_BORDER, add_neighbourhood_metrics, build_adjacency
+from aggregation import build_gemeente_geometry, calculate_derived_metrics
+from map_layers import (
+    GEOJSON_SUBDIR, LOD_TOLERANCES, STATIC_DIR, GeometryPyramid, build_lod_levels, build_topology_levels
+)
+from profiling import configure_logging
+from topology import Topology
+from upload_cache import (
+    SHAPEFILE_EXTENSIONS, content_key, digest_file, shapefile_component_path
+)
+
+logger = logging.getLogger(__name__)
+
+# Verhoog dit nummer als de inhoud van de snapshot verandert, zodat oude snapshots vervallen
+SNAPSHOT_VERSION = 3
+
+SNAPSHOT_DIR = os.environ.get(
+    'PC4_SNAPSHOT_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'snapshots')
+)
+
+# Aantal datasets (inhoudssleutels) waarvan de snapshotbestanden bewaard blijven
+SNAPSHOT_ENTRIES = int(os.environ.get('PC4_SNAPSHOT_ENTRIES', '4'))
+
+# Snapshotbestanden en statische GeoJSON: soort, versie en de eerste 16 tekens van de sleutel
+_SNAPSHOT_NAME = re.compile(r'^(?:pc4|gemeente|topology|adjacency|lod_\w+?)_v\d+_([0-9a-f]{16})[._]')
+
+# Tolerantie (in graden, ca. 10 meter) van de vereenvoudiging bij het inlezen
+BASE_SIMPLIFY_TOLERANCE = 0.0001
+
+# Kolommen waarop gefilterd wordt; rijen zonder waarde worden verwijderd
+EXPECTED_COLUMNS = ['provincie', 'gemeente', 'woonplaats', 'cluster', 'voorstel_benaming_uvb', 'voorstel_onderneming']
+
+# Numerieke kolommen die altijd aanwezig moeten zijn (default 0)
+NUMERIC_COLUMNS = ['inwoners', 'sterfte_2023', 'uitvaarten_2023', 'uitvaarten_2024', 'uitvaarten_2025', 'aantal_verzekerden', 'reistijd_min']
+
+# Schema van de compacte representatie in het geheugen (zie compact_dtypes)
+COUNT_COLUMNS = ['inwoners', 'sterfte_2023', 'uitvaarten_2023', 'uitvaarten_2024', 'uitvaarten_2025', 'aantal_verzekerden']
+FLOAT32_COLUMNS = ['reistijd_min']
+CATEGORY_COLUMNS = EXPECTED_COLUMNS
+
+# Tekstkolommen met minder unieke waarden dan deze fractie van de rijen worden categorisch
+CATEGORY_MAX_UNIQUE_FRACTION = 0.5
+
+_index_lock = threading.Lock()
+
+# Per proces: ingelezen shapefiles en vooraf ingelezen snapshots (zie warmup.py)
+_geometry_lock = threading.Lock()
+_geometry_cache = {}
+_preloaded_snapshots = {}
+
+
+class DataLoadError(Exception):
+    """De bronbestanden konden niet tot een bruikbare dataset worden gecombineerd."""
+
+
+def read_sources(excel_path, shapefile_path, warn=logger.warning):
+    """Lees Excel en shapefile in en voeg ze samen op PC4 (zonder snapshot)."""
+    # Controleer of bestanden bestaan
+    if not excel_path or not os.path.exists(excel_path):
+        raise DataLoadError(f"Excel bestand niet gevonden: {excel_path}")
+
+    if not shapefile_path or not os.path.exists(shapefile_path):
+        raise DataLoadError(f"Shapefile niet gevonden: {shapefile_path}")
+
+    # Controleer of .shx bestand bestaat
+    if shapefile_component_path(shapefile_path, '.shx') is None:
+        warn(".shx bestand ontbreekt voor shapefile. Probeer het shapefile opnieuw te uploaden met alle bijbehorende bestanden.")
+
+    # Data inladen
+    df = pd.read_excel(excel_path)
+
+    # Zorg dat postcode kolom PC4 heet in het excel bestand
+    if 'PC4' not in df.columns and 'pc4' in df.columns:
+        df = df.rename(columns={'pc4': 'PC4'})  # Hernoem 'pc4' naar 'PC4' indien nodig
+
+    # Log de eerste paar rijen en kolomnamen om te helpen bij debugging
+    logger.debug(f"Excel kolommen: {df.columns.tolist()}")
+    logger.debug(f"Eerste 3 rijen van Excel:\n{df.head(3)}")
+
+    # Controleer of de PC4 kolom bestaat
+    if 'PC4' not in df.columns:
+        raise DataLoadError("Kolom 'PC4' niet gevonden in Excel bestand. Beschikbare kolommen: " + ", ".join(df.columns.tolist()))
+
+    netherlands = read_geometry(shapefile_path)
+
+    # Zorg dat PC4 als string is opgeslagen in beide dataframes
+    df['PC4'] = df['PC4'].astype(str)
+
+    # Verwijder rijen met ontbrekende woonplaats zoals gevraagd
+    if 'woonplaats' in df.columns:
+        df = df.dropna(subset=['woonplaats'])
+
+    # Controleer welke kolommen daadwerkelijk bestaan in het dataframe
+    existing_columns = [col for col in EXPECTED_COLUMNS if col in df.columns]
+
+    # Log welke kolommen ontbreken
+    missing_columns = [col for col in EXPECTED_COLUMNS if col not in df.columns]
+    if missing_columns:
+        logger.warning(f"Deze kolommen ontbreken in het dataframe: {missing_columns}")
+
+    # Alleen filteren op bestaande kolommen
+    if existing_columns:
+        df = df.dropna(subset=existing_columns)
+
+    # Merge de datasets
+    logger.info(f"Aantal rijen voor merge - Excel: {len(df)}, Shapefile: {len(netherlands)}")
+    merged_data = netherlands.merge(df, on='PC4', how='inner')
+    logger.info(f"Aantal rijen na merge: {len(merged_data)}")
+
+    if len(merged_data) == 0:
+        # Toon een paar waarden om te helpen debuggen
+        logger.warning(f"Voorbeeld PC4 waarden in Excel: {df['PC4'].head(10).tolist()}")
+        logger.warning(f"Voorbeeld PC4 waarden in Shapefile: {netherlands['PC4'].head(10).tolist()}")
+        raise DataLoadError("Geen overeenkomende postcodes gevonden bij het mergen van de datasets!")
+
+    # Aanwezigheid van belangrijke kolommen controleren en eventueel defaults instellen
+    for col in NUMERIC_COLUMNS:
+        if col not in merged_data.columns:
+            logger.warning(f"Kolom {col} ontbreekt in de data en wordt aangemaakt met default waarden.")
+            merged_data[col] = 0
+
+    return normalise_types(merged_data)
+
+
+def _geometry_key(shapefile_path):
+    components = {ext: shapefile_component_path(shapefile_path, ext) for ext in SHAPEFILE_EXTENSIONS}
+    try:
+        stats = _file_stats({ext: path for ext, path in components.items() if path is not None})
+    except OSError:
+        return None
+    return (os.path.abspath(shapefile_path), json.dumps(stats, sort_keys=True)) if stats else None
+
+
+def read_geometry(shapefile_path):
+    """
+    PC4-vormen uit de shapefile (licht vereenvoudigd, PC4 als string). Per proces bewaard
+    zolang de bestanden niet veranderen: een nieuw Excel bestand met de meegeleverde
+    shapefile leest dan alleen het Excel bestand.
+    """
+    cache_key = _geometry_key(shapefile_path)
+    with _geometry_lock:
+        if cache_key is not None and cache_key in _geometry_cache:
+            return _geometry_cache[cache_key].copy(deep=False)
+
+    # Probeer expliciete configuratie voor het herstellen van het .shx bestand
+    os.environ['SHAPE_RESTORE_SHX'] = 'YES'
+
+    # Shapefile inladen met foutafvang
+    try:
+        netherlands = gpd.read_file(shapefile_path)
+    except Exception as e:
+        raise DataLoadError(f"Fout bij het laden van het shapefile: {e}. Controleer of alle benodigde bestanden (.shp, .shx, .dbf) zijn geüpload.") from e
+
+    # Log de eerste paar rijen en kolomnamen van de shapefile
+    logger.debug(f"Shapefile kolommen: {netherlands.columns.tolist()}")
+    logger.debug(f"Eerste 3 rijen van Shapefile:\n{netherlands.head(3)}")
+
+    # Controleer of de PC4 kolom bestaat in de shapefile
+    if 'PC4' not in netherlands.columns:
+        # Probeer andere mogelijke namen voor postcode kolom
+        potential_pc4_columns = [col for col in netherlands.columns if 'pc' in col.lower() or 'post' in col.lower()]
+        if potential_pc4_columns:
+            netherlands = netherlands.rename(columns={potential_pc4_columns[0]: 'PC4'})
+            logger.info(f"Hernoemd shapefile kolom '{potential_pc4_columns[0]}' naar 'PC4'")
+        else:
+            raise DataLoadError("Kolom 'PC4' niet gevonden in Shapefile. Beschikbare kolommen: " + ", ".join(netherlands.columns.tolist()))
+
+    # Lichte vereenvoudiging; grovere niveaus voor de kaart komen uit de detailpiramide (map_layers.py)
+    netherlands['geometry'] = netherlands['geometry'].simplify(tolerance=BASE_SIMPLIFY_TOLERANCE, preserve_topology=True)
+    netherlands['PC4'] = netherlands['PC4'].astype(str)
+
+    # Sleutel na het inlezen: met SHAPE_RESTORE_SHX kan GDAL het .shx bestand herschrijven
+    cache_key = _geometry_key(shapefile_path)
+    if cache_key is not None:
+        with _geometry_lock:
+            # Alleen de laatste versie per pad bewaren
+            for key in [key for key in _geometry_cache if key[0] == cache_key[0]]:
+                del _geometry_cache[key]
+            _geometry_cache[cache_key] = netherlands
+    return netherlands.copy(deep=False)
+
+
+def normalise_types(data):
+    """Maak kolomtypes eenduidig, zodat de data naar Parquet kan en na inlezen gelijk is."""
+    for col in NUMERIC_COLUMNS:
+        if not pd.api.types.is_numeric_dtype(data[col]):
+            data[col] = pd.to_numeric(data[col], errors='coerce')
+
+    # Excel kolommen met gemengde types (bijv. getallen en tekst) kunnen niet naar Arrow
+    for col in data.columns:
+        if col != 'geometry' and pd.api.types.is_object_dtype(data[col]):
+            data[col] = data[col].where(data[col].isna(), data[col].astype(str))
+
+    return data
+
+
+def _compact_pc4(values):
+    """PC4 als kleinst mogelijk geheel getal (uint16), of ongewijzigd als dat niet kan."""
+    numbers = pd.to_numeric(values, errors='coerce')
+    if numbers.isna().any() or (numbers != np.floor(numbers)).any() or len(numbers) == 0:
+        return values
+    if numbers.min() >= 0 and numbers.max() <= np.iinfo(np.uint16).max:
+        return numbers.astype(np.uint16)
+    return pd.to_numeric(numbers, downcast='integer')
+
+
+def _compact_count(values):
+    """Gehele aantallen naar het kleinste integer type; met ontbrekende waarden float32."""
+    if values.isna().any() or (values != np.floor(values)).any():
+        return values.astype(np.float32)
+    return pd.to_numeric(values, downcast='integer')
+
+
+def compact_dtypes(data):
+    """
+    Kleinere types voor de dataset in het geheugen: aantallen als int8/16/32, reistijd als
+    float32, herhaalde teksten (provincie, gemeente, ...) als categorical en PC4 als uint16.
+    De geometrie wordt niet gekopieerd. Afgeleide metrieken blijven float64.
+    """
+    before = data.memory_usage(deep=True).sum()
+    data = data.copy(deep=False)
+
+    if 'PC4' in data.columns:
+        data['PC4'] = _compact_pc4(data['PC4'])
+    for col in COUNT_COLUMNS:
+        if col in data.columns and pd.api.types.is_numeric_dtype(data[col]):
+            data[col] = _compact_count(data[col])
+    for col in FLOAT32_COLUMNS:
+        if col in data.columns and pd.api.types.is_float_dtype(data[col]):
+            data[col] = data[col].astype(np.float32)
+    for col in data.columns:
+        if col == 'geometry' or col == 'PC4' or isinstance(data[col].dtype, pd.CategoricalDtype):
+            continue
+        if not (pd.api.types.is_object_dtype(data[col]) or pd.api.types.is_string_dtype(data[col])):
+            continue
+        if col in CATEGORY_COLUMNS or data[col].nunique() < CATEGORY_MAX_UNIQUE_FRACTION * len(data):
+            data[col] = data[col].astype('category')
+
+    after = data.memory_usage(deep=True).sum()
+    logger.info(f"Dataset in geheugen: {after / 2 ** 20:.1f} MB (was {before / 2 ** 20:.1f} MB)")
+    return data
+
+
+def _source_files(excel_path, shapefile_path):
+    files = {'excel': excel_path}
+    for ext in SHAPEFILE_EXTENSIONS:
+        component = shapefile_component_path(shapefile_path, ext)
+        if component is not None:
+            files[ext] = component
+    return files
+
+
+def _file_stats(files):
+    stats = {}
+    for name, path in files.items():
+        stat = os.stat(path)
+        stats[name] = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    return stats
+
+
+def source_key(excel_path, shapefile_path):
+    """Zelfde sleutel als de upload cache gebruikt: hash van Excel en shapefile-onderdelen."""
+    files = _source_files(excel_path, shapefile_path)
+    shapefile_digests = {name: digest_file(path) for name, path in files.items() if name != 'excel'}
+    return content_key(digest_file(files['excel']), shapefile_digests)
+
+
+def snapshot_path(key, snapshot_dir=SNAPSHOT_DIR):
+    return os.path.join(snapshot_dir, f"pc4_v{SNAPSHOT_VERSION}_{key[:16]}.parquet")
+
+
+def gemeente_geometry_path(key, snapshot_dir=SNAPSHOT_DIR):
+    return os.path.join(snapshot_dir, f"gemeente_v{SNAPSHOT_VERSION}_{key[:16]}.parquet")
+
+
+def topology_path(key, snapshot_dir=SNAPSHOT_DIR):
+    return os.path.join(snapshot_dir, f"topology_v{SNAPSHOT_VERSION}_{key[:16]}.topojson.gz")
+
+
+def adjacency_path(key, snapshot_dir=SNAPSHOT_DIR):
+    # Net als bij lod_path: andere toleranties geven een ander bestand
+    tolerances = hashlib.sha256(repr((BORDER_TOLERANCE, MIN_SHARED_BORDER)).encode()).hexdigest()[:8]
+    return os.path.join(snapshot_dir, f"adjacency_v{SNAPSHOT_VERSION}_{key[:16]}_{tolerances}.npz")
+
+
+def lod_path(layer, key, snapshot_dir=SNAPSHOT_DIR):
+    # De toleranties horen bij de inhoud: andere toleranties geven een ander bestand
+    tolerances = hashlib.sha256(repr(LOD_TOLERANCES).encode()).hexdigest()[:8]
+    return os.path.join(snapshot_dir, f"lod_{layer}_v{SNAPSHOT_VERSION}_{key[:16]}_{tolerances}.parquet")
+
+
+def prune_snapshots(keep_key=None, snapshot_dir=SNAPSHOT_DIR, static_dir=STATIC_DIR, max_entries=SNAPSHOT_ENTRIES):
+    """
+    Bewaar alleen de bestanden van de max_entries laatst gebruikte datasets, in de snapshotmap
+    en de map met statische GeoJSON. Net als de upload cache op mtime: een ingelezen snapshot
+    wordt aangeraakt. De bestanden van keep_key blijven altijd staan.
+    """
+    groups = {}
+    for directory in (snapshot_dir, os.path.join(static_dir, GEOJSON_SUBDIR)):
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        for name in names:
+            match = _SNAPSHOT_NAME.match(name)
+            if match is None or name.endswith('.tmp'):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                groups.setdefault(match.group(1), []).append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+
+    recent = sorted(groups, key=lambda key: max(groups[key])[0], reverse=True)
+    for key in recent[max(1, max_entries):]:
+        if keep_key is not None and key == keep_key[:16]:
+            continue
+        logger.info(f"Snapshots: verwijder {len(groups[key])} oude bestanden van {key}")
+        for _, path in groups[key]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _index_path(snapshot_dir):
+    return os.path.join(snapshot_dir, 'index.json')
+
+
+def _read_index(snapshot_dir):
+    try:
+        with open(_index_path(snapshot_dir)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json_atomic(path, content):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(content, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _remember_sources(snapshot_dir, excel_path, shapefile_path, key):
+    files = _source_files(excel_path, shapefile_path)
+    with _index_lock:
+        index = _read_index(snapshot_dir)
+        index[os.path.abspath(excel_path)] = {
+            'key': key,
+            'version': SNAPSHOT_VERSION,
+            'sources': _file_stats(files),
+        }
+        _write_json_atomic(_index_path(snapshot_dir), index)
+
+
+def _key_from_mtime(snapshot_dir, excel_path, shapefile_path):
+    """Sleutel uit de index als grootte en mtime van alle bronbestanden ongewijzigd zijn."""
+    entry = _read_index(snapshot_dir).get(os.path.abspath(excel_path))
+    if not entry or entry.get('version') != SNAPSHOT_VERSION:
+        return None
+    try:
+        current = _file_stats(_source_files(excel_path, shapefile_path))
+    except OSError:
+        return None
+    return entry['key'] if current == entry.get('sources') else None
+
+
+def _write_parquet_atomic(data, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    data.to_parquet(tmp_path, index=False)
+    # Atomisch vervangen, zodat andere sessies nooit een half geschreven bestand lezen
+    os.replace(tmp_path, path)
+    logger.info(f"Snapshot geschreven: {path}")
+    return path
+
+
+def write_snapshot(merged_data, key, snapshot_dir=SNAPSHOT_DIR):
+    return _write_parquet_atomic(merged_data, snapshot_path(key, snapshot_dir))
+
+
+def read_snapshot(path):
+    # Vooraf ingelezen (preload_snapshots) wordt één keer doorgegeven; daarna bewaart de app hem zelf
+    with _geometry_lock:
+        preloaded = _preloaded_snapshots.pop(os.path.abspath(path), None)
+    if preloaded is not None:
+        return preloaded
+    # memory_map voorkomt een extra kopie van het bestand bij het inlezen
+    return gpd.read_parquet(path, memory_map=True)
+
+
+def preload_snapshots(snapshot_dir=SNAPSHOT_DIR, limit=1):
+    """
+    Lees de nieuwste dataset-snapshots alvast in (bijv. bij het opstarten, zie warmup.py),
+    zodat de eerste sessie die ze nodig heeft niet op de schijf hoeft te wachten.
+    """
+    try:
+        names = [name for name in os.listdir(snapshot_dir)
+                 if name.startswith(f"pc4_v{SNAPSHOT_VERSION}_") and name.endswith('.parquet')]
+    except OSError:
+        return []
+    paths = sorted((os.path.join(snapshot_dir, name) for name in names), key=os.path.getmtime, reverse=True)[:limit]
+    loaded = []
+    for path in paths:
+        try:
+            data = gpd.read_parquet(path, memory_map=True)
+        except Exception as e:
+            logger.warning(f"Snapshot {path} kon niet vooraf worden ingelezen: {e}")
+            continue
+        with _geometry_lock:
+            _preloaded_snapshots[os.path.abspath(path)] = data
+        loaded.append(path)
+    return loaded
+
+
+def load_merged_data(excel_path, shapefile_path, cache_key=None, snapshot_dir=SNAPSHOT_DIR, use_snapshot=True, warn=logger.warning):
+    """
+    Geef de samengevoegde PC4 dataset terug, bij voorkeur uit een snapshot.
+
+    De snapshot wordt hergebruikt als grootte en mtime van de bronnen gelijk zijn aan die
+    in de index, of anders als de inhoudshash (cache_key) overeenkomt.
+    """
+    if not use_snapshot:
+        return read_sources(excel_path, shapefile_path, warn=warn)
+
+    key = cache_key or _key_from_mtime(snapshot_dir, excel_path, shapefile_path)
+    if key is None:
+        if not excel_path or not os.path.exists(excel_path):
+            raise DataLoadError(f"Excel bestand niet gevonden: {excel_path}")
+        if not shapefile_path or not os.path.exists(shapefile_path):
+            raise DataLoadError(f"Shapefile niet gevonden: {shapefile_path}")
+        key = source_key(excel_path, shapefile_path)
+
+    path = snapshot_path(key, snapshot_dir)
+    if os.path.exists(path):
+        try:
+            merged_data = read_snapshot(path)
+            logger.info(f"Snapshot ingelezen: {path} ({len(merged_data)} rijen)")
+        except Exception as e:
+            logger.warning(f"Snapshot {path} kon niet worden gelezen ({e}), bronbestanden worden opnieuw ingelezen.")
+        else:
+            try:
+                # Laatst gebruikt, voor het opruimen van oude snapshots (prune_snapshots)
+                os.utime(path)
+                if cache_key is None:
+                    _remember_sources(snapshot_dir, excel_path, shapefile_path, key)
+            except OSError as e:
+                logger.warning(f"Snapshotindex kon niet worden bijgewerkt: {e}")
+            return merged_data
+
+    merged_data = read_sources(excel_path, shapefile_path, warn=warn)
+    try:
+        write_snapshot(merged_data, key, snapshot_dir)
+        if cache_key is None:
+            _remember_sources(snapshot_dir, excel_path, shapefile_path, key)
+        prune_snapshots(key, snapshot_dir)
+    except Exception as e:
+        # Een snapshot is een optimalisatie; zonder snapshot werkt de app gewoon door
+        logger.warning(f"Snapshot kon niet worden geschreven: {e}")
+    return merged_data
+
+
+def load_dataset(excel_path, shapefile_path, cache_key=None, snapshot_dir=SNAPSHOT_DIR, warn=logger.warning):
+    """De dataset zoals de app en de rapporten hem gebruiken: compacte types en afgeleide metrieken."""
+    merged_data = load_merged_data(excel_path, shapefile_path, cache_key=cache_key, snapshot_dir=snapshot_dir, warn=warn)
+    data = calculate_derived_metrics(compact_dtypes(merged_data))
+    if 'geometry' not in data.columns:
+        return data
+    try:
+        key = cache_key or _key_from_mtime(snapshot_dir, excel_path, shapefile_path)
+        data = add_neighbourhood_metrics(data, load_adjacency(data, key, snapshot_dir=snapshot_dir))
+    except Exception as e:
+        # De buurmetrieken zijn een aanvulling; zonder burengraaf werkt de rest gewoon door
+        logger.warning(f"Buurmetrieken konden niet worden berekend: {e}")
+    return data
+
+
+def load_adjacency(merged_data, key=None, topology=None, snapshot_dir=SNAPSHOT_DIR):
+    """
+    Burengraaf (CSR, zie adjacency.py) uit de snapshotmap, of eenmalig opgebouwd en
+    opgeslagen. Zonder key wordt de graaf alleen opgebouwd. De app, de rapporten en de CLI
+    bouwen de graaf op dezelfde manier: uit de topologie (zonder topologie wordt die hier
+    geladen) aangevuld met de geometrieën.
+    """
+    size = len(merged_data)
+    path = adjacency_path(key, snapshot_dir) if key else None
+    if path and os.path.exists(path):
+        try:
+            adjacency = sparse.load_npz(path).tocsr()
+            if adjacency.shape == (size, size):
+                return adjacency
+            logger.warning(f"Burengraaf {path} hoort niet bij deze dataset, opnieuw opbouwen.")
+        except Exception as e:
+            logger.warning(f"Burengraaf {path} kon niet worden gelezen ({e}), opnieuw opbouwen.")
+
+    if topology is None:
+        try:
+            topology = (
+                load_topology(merged_data, key, snapshot_dir) if key
+                else Topology.build(merged_data.geometry.values, ids=merged_data['PC4'].astype(str).tolist())
+            )
+        except Exception as e:
+            logger.warning(f"Topologie niet beschikbaar ({e}), burengraaf alleen uit de geometrieën.")
+    adjacency = build_adjacency(merged_data.geometry.values, topology)
+    if path:
+        try:
+            os.makedirs(snapshot_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+            sparse.save_npz(tmp_path, adjacency)
+            os.replace(tmp_path, path)
+            logger.info(f"Snapshot geschreven: {path}")
+        except Exception as e:
+            logger.warning(f"Burengraaf kon niet worden opgeslagen: {e}")
+    return adjacency
+
+
+def load_topology(merged_data, key, snapshot_dir=SNAPSHOT_DIR):
+    """PC4-topologie (TopoJSON) uit de snapshotmap, of eenmalig opgebouwd en opgeslagen."""
+    pc4_ids = merged_data['PC4'].astype(str).tolist()
+    path = topology_path(key, snapshot_dir)
+    if os.path.exists(path):
+        try:
+            with gzip.open(path, 'rt') as f:
+                topology = Topology.from_topojson(json.load(f))
+            if topology.ids == pc4_ids:
+                return topology
+            logger.warning(f"Topologie {path} hoort niet bij deze dataset, opnieuw opbouwen.")
+        except Exception as e:
+            logger.warning(f"Topologie {path} kon niet worden gelezen ({e}), opnieuw opbouwen.")
+
+    topology = Topology.build(merged_data.geometry.values, ids=pc4_ids)
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, 'wt') as f:
+            f.write(topology.dumps())
+        os.replace(tmp_path, path)
+        logger.info(f"Snapshot geschreven: {path}")
+    except Exception as e:
+        logger.warning(f"Topologie kon niet worden opgeslagen: {e}")
+    return topology
+
+
+def load_gemeente_geometry(merged_data, key, topology=None, snapshot_dir=SNAPSHOT_DIR):
+    """Gemeentegrenzen uit de snapshot, of eenmalig berekend en daarna opgeslagen."""
+    path = gemeente_geometry_path(key, snapshot_dir)
+    if os.path.exists(path):
+        try:
+            return read_snapshot(path).set_index('gemeente')
+        except Exception as e:
+            logger.warning(f"Gemeentegrenzen {path} konden niet worden gelezen ({e}), opnieuw berekenen.")
+
+    gemeente_geometry = build_gemeente_geometry(merged_data, topology)
+    try:
+        _write_parquet_atomic(gemeente_geometry.reset_index(), path)
+    except Exception as e:
+        logger.warning(f"Gemeentegrenzen konden niet worden opgeslagen: {e}")
+    return gemeente_geometry
+
+
+def load_geometry_pyramid(layer, ids, geometries, key, topology=None, groups=None, snapshot_dir=SNAPSHOT_DIR):
+    """
+    Detailniveaus van een kaartlaag uit de snapshotmap, of eenmalig berekend en opgeslagen.
+    Met een topologie komen alle lagen uit dezelfde vereenvoudigde arcs; groups geeft per
+    PC4 de groep (gemeente) voor samengevoegde lagen.
+    """
+    path = lod_path(layer, key, snapshot_dir)
+    # De statische GeoJSON bestanden krijgen de naam van de parquet (met versie en toleranties),
+    # zodat nieuwe detailniveaus nooit een oud bestand uit de browser- of servercache gebruiken
+    name = os.path.splitext(os.path.basename(path))[0]
+    if os.path.exists(path):
+        try:
+            table = pd.read_parquet(path, memory_map=True)
+            levels = [shapely.from_wkb(table[f'lod{i}'].values) for i in range(len(LOD_TOLERANCES))]
+            return GeometryPyramid(name, table['id'], levels)
+        except Exception as e:
+            logger.warning(f"Detailniveaus {path} konden niet worden gelezen ({e}), opnieuw berekenen.")
+
+    levels = None
+    if topology is not None:
+        try:
+            ids, levels = build_topology_levels(topology, groups)
+        except Exception as e:
+            logger.warning(f"Detailniveaus uit de topologie mislukt ({type(e).__name__}: {e}), per laag vereenvoudigen.")
+    if levels is None:
+        levels = build_lod_levels(geometries)
+    pyramid = GeometryPyramid(name, ids, levels)
+    table = pd.DataFrame({'id': pyramid.ids})
+    for i, level in enumerate(levels):
+        table[f'lod{i}'] = shapely.to_wkb(level)
+    try:
+        _write_parquet_atomic(table, path)
+    except Exception as e:
+        logger.warning(f"Detailniveaus konden niet worden opgeslagen: {e}")
+    return pyramid
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bouw de PC4 snapshot vooraf (bijv. tijdens de deploy).")
+    parser.add_argument('--excel', required=True, help="Pad naar PC4_verrijkt.xlsx")
+    parser.add_argument('--shapefile', default='data/PC4.shp', help="Pad naar PC4.shp")
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR, help="Map voor de snapshots")
+    parser.add_argument('--force', action='store_true', help="Bouw opnieuw, ook als er al een geldige snapshot is")
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    key = source_key(args.excel, args.shapefile)
+    path = snapshot_path(key, args.snapshot_dir)
+    if os.path.exists(path) and not args.force:
+        logger.info(f"Snapshot is actueel: {path}")
+        merged_data = read_snapshot(path)
+    else:
+        merged_data = read_sources(args.excel, args.shapefile)
+        write_snapshot(merged_data, key, args.snapshot_dir)
+        # Afgeleide tabellen horen bij de oude snapshot en moeten opnieuw
+        for derived_path in (gemeente_geometry_path(key, args.snapshot_dir), topology_path(key, args.snapshot_dir),
+                             adjacency_path(key, args.snapshot_dir), lod_path('pc4', key, args.snapshot_dir), lod_path('gemeente', key, args.snapshot_dir)):
+            if os.path.exists(derived_path):
+                os.remove(derived_path)
+
+    topology = load_topology(merged_data, key, args.snapshot_dir)
+    load_adjacency(merged_data, key, topology, args.snapshot_dir)
+    load_geometry_pyramid('pc4', merged_data['PC4'], merged_data.geometry.values, key, topology, snapshot_dir=args.snapshot_dir)
+    if 'gemeente' in merged_data.columns:
+        gemeente_geometry = load_gemeente_geometry(merged_data, key, topology, args.snapshot_dir)
+        load_geometry_pyramid(
+            'gemeente', gemeente_geometry.index, gemeente_geometry.geometry.values, key, topology,
+            groups=merged_data['gemeente'], snapshot_dir=args.snapshot_dir
+        )
+    _remember_sources(args.snapshot_dir, args.excel, args.shapefile, key)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,270 @@
+"""
+Lichte tijd- en geheugenmetingen per rerun van app.py.
+
+Een rerun bestaat uit opeenvolgende fases (checkpoint) met daarbinnen eventueel geneste
+spans. Per span wordt de duur en de verandering van het werkgeheugen (RSS) vastgelegd.
+Daarnaast worden per st.cache_* functie aanroepen en echte berekeningen (misses) geteld,
+en de grootte van de frames die een sessie gebruikt (tegen een budget per sessie).
+
+Per rerun wordt ook de tijd tot de eerste weergave (first_paint) vastgelegd, en of het de
+eerste rerun in het proces was (koude start: imports en caches nog leeg).
+
+Buiten een rerun (bijv. in de CLI of in een achtergrondthread) doen span() en de tellers
+niets, dus de modules met data-logica kunnen ze altijd aanroepen.
+
+Meldingen van die modules gaan via logging (logging.getLogger(__name__)). Na
+configure_logging() komen ze in de console en, tijdens een rerun, ook bij de meting (voor
+het debugpaneel en het JSONL-log).
+"""
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Als deze omgevingsvariabele een pad bevat, wordt elke rerun als JSON-regel toegevoegd
+PROFILE_LOG = os.environ.get('PC4_PROFILE_LOG')
+
+# Geheugenbudget per sessie in MB voor frames die niet gedeeld worden; 0 = geen budget
+SESSION_BUDGET_MB = float(os.environ.get('PC4_SESSION_BUDGET_MB', '64'))
+
+# Loggers van de modules waarvan meldingen worden getoond (op LOG_LEVEL); andere
+# bibliotheken houden hun eigen niveau
+LOGGERS = ('__main__', 'profiling', 'pc4_data', 'aggregation', 'map_layers', 'upload_cache', 'warmup')
+LOG_LEVEL = os.environ.get('PC4_LOG_LEVEL', 'INFO')
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_log_lock = threading.Lock()
+_runs_started = 0
+
+
+def _rss_bytes():
+    """Huidig werkgeheugen van het proces, of None als dat niet te bepalen is."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        # Geen actuele waarde beschikbaar: piekgebruik (Linux in KB, macOS in bytes)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024
+    except (ImportError, AttributeError):
+        return None
+
+
+class RunProfile:
+    """Spans en cachetellers van één rerun."""
+
+    def __init__(self, label=None):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.label = label
+        self.started = time.time()
+        self._t0 = time.perf_counter()
+        self.spans = []
+        self.calls = {}
+        self.misses = {}
+        self.memory = {}
+        self.messages = []
+        self.first_paint = None
+        self.cold = False
+        self._stack = []
+        self._stage = None
+
+    def open_span(self, name):
+        path = '/'.join([span['name'] for span in self._stack] + [name])
+        span = {'name': name, 'path': path, 'depth': len(self._stack),
+                '_start': time.perf_counter(), '_rss': _rss_bytes()}
+        self._stack.append(span)
+        return span
+
+    def close_span(self, span):
+        # Spans die niet netjes zijn gesloten (bijv. door een exception) eerst afsluiten
+        while self._stack:
+            current = self._stack.pop()
+            rss = _rss_bytes()
+            self.spans.append({
+                'name': current['path'],
+                'depth': current['depth'],
+                'offset': current['_start'] - self._t0,
+                'seconds': time.perf_counter() - current['_start'],
+                'rss_mb': rss / 2 ** 20 if rss is not None else None,
+                'rss_delta_mb': (rss - current['_rss']) / 2 ** 20 if rss is not None and current['_rss'] is not None else None,
+            })
+            if current is span:
+                break
+
+    def checkpoint(self, name):
+        """Sluit de vorige fase af en begin een nieuwe."""
+        if self._stage is not None:
+            self.close_span(self._stage)
+        self._stage = self.open_span(name) if name is not None else None
+
+    def count(self, name, miss=False):
+        counter = self.misses if miss else self.calls
+        counter[name] = counter.get(name, 0) + 1
+
+    def log(self, level, logger, message):
+        self.messages.append({
+            'level': level, 'logger': logger, 'offset': time.perf_counter() - self._t0, 'message': message,
+        })
+
+    def record_memory(self, name, nbytes, shared=False):
+        self.memory[name] = {'mb': nbytes / 2 ** 20, 'shared': shared}
+
+    def session_mb(self):
+        """Geheugen van de frames die alleen voor deze sessie zijn gemaakt."""
+        return sum(entry['mb'] for entry in self.memory.values() if not entry['shared'])
+
+    def cache_stats(self):
+        """Per cachefunctie (aanroepen, hits, misses)."""
+        stats = {}
+        for name in sorted(set(self.calls) | set(self.misses)):
+            calls = self.calls.get(name, 0)
+            misses = self.misses.get(name, 0)
+            stats[name] = {'calls': calls, 'hits': max(calls - misses, 0), 'misses': misses}
+        return stats
+
+    def to_dict(self):
+        return {
+            'run_id': self.run_id,
+            'label': self.label,
+            'started': self.started,
+            'total_seconds': sum(span['seconds'] for span in self.spans if span['depth'] == 0),
+            'spans': sorted(self.spans, key=lambda span: span['offset']),
+            'caches': self.cache_stats(),
+            'memory': self.memory,
+            'messages': self.messages,
+            'session_mb': self.session_mb(),
+            'budget_mb': SESSION_BUDGET_MB,
+            'first_paint_seconds': self.first_paint,
+            'cold_start': self.cold,
+        }
+
+
+def current():
+    return getattr(_local, 'run', None)
+
+
+def start_run(label=None):
+    """Begin een nieuwe meting voor deze thread (een eventueel onafgemaakte vervalt)."""
+    global _runs_started
+    _local.run = RunProfile(label)
+    with _log_lock:
+        _local.run.cold = _runs_started == 0
+        _runs_started += 1
+    return _local.run
+
+
+def finish_run(log_path=PROFILE_LOG):
+    """Sluit de meting af; geeft de rerun als dict (en schrijft hem eventueel naar het log)."""
+    run = current()
+    if run is None:
+        return None
+    run.checkpoint(None)
+    _local.run = None
+    record = run.to_dict()
+    if run.cold:
+        first_paint = f"{run.first_paint * 1000:.0f} ms" if run.first_paint is not None else "-"
+        logger.info(f"Eerste rerun in dit proces: eerste weergave na {first_paint}, klaar na {record['total_seconds'] * 1000:.0f} ms")
+    if SESSION_BUDGET_MB and record['session_mb'] > SESSION_BUDGET_MB:
+        logger.warning(f"Sessie gebruikt {record['session_mb']:.1f} MB, meer dan het budget van {SESSION_BUDGET_MB:.0f} MB")
+    if log_path:
+        try:
+            with _log_lock, open(log_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        except OSError as e:
+            logger.warning(f"Profiel kon niet worden weggeschreven naar {log_path}: {e}")
+    return record
+
+
+def checkpoint(name):
+    run = current()
+    if run is not None:
+        run.checkpoint(name)
+
+
+def first_paint():
+    """Markeer dat de eerste elementen (titel, sidebar) naar de browser zijn gestuurd."""
+    run = current()
+    if run is not None and run.first_paint is None:
+        run.first_paint = time.perf_counter() - run._t0
+
+
+def record_frame(name, frame, shared=False):
+    """Leg de grootte van een (Geo)DataFrame vast; shared=True voor data die alle sessies delen."""
+    run = current()
+    if run is not None and frame is not None:
+        run.record_memory(name, int(frame.memory_usage(deep=True).sum()), shared)
+
+
+@contextmanager
+def span(name):
+    run = current()
+    if run is None:
+        yield
+        return
+    opened = run.open_span(name)
+    try:
+        yield
+    finally:
+        run.close_span(opened)
+
+
+def count_calls(name):
+    """Decorator boven st.cache_*: telt elke aanroep van de gecachte functie."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            run = current()
+            if run is not None:
+                run.count(name)
+            return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_misses(name):
+    """Decorator onder st.cache_*: telt alleen als de functie echt wordt uitgevoerd."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            run = current()
+            if run is not None:
+                run.count(name, miss=True)
+            return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class RunLogHandler(logging.Handler):
+    """Logregels bij de meting van de lopende rerun in deze thread."""
+
+    def emit(self, record):
+        run = current()
+        if run is not None:
+            run.log(record.levelname, record.name, record.getMessage())
+
+
+def configure_logging(level=LOG_LEVEL, loggers=LOGGERS):
+    """Eén keer per proces: meldingen van de modules naar de console en naar de meting."""
+    root = logging.getLogger()
+    if any(isinstance(handler, RunLogHandler) for handler in root.handlers):
+        return
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter('%(message)s'))
+    root.addHandler(console)
+    root.addHandler(RunLogHandler())
+    for name in loggers:
+        logging.getLogger(name).setLevel(level)
+
+
+def to_jsonl(records):
+    return ''.join(json.dumps(record) + '\n' for record in records)
@@ -0,0 +1,265 @@
+"""
+Rapporten per regio, zonder de Streamlit interface (bijv. 's nachts of tijdens de deploy).
+
+Per provincie, gemeente en cluster worden dezelfde statistieken, top/laagste 5 en kaart als
+in het dashboard gemaakt, als CSV en PNG in een eigen map. De dataset wordt één keer
+ingelezen (via de snapshot, zie pc4_data.py) en gedeeld door een pool van processen.
+
+In manifest.json staat per rapport een vingerafdruk van de rijen waarop het is gebaseerd.
+Het manifest wordt na elk rapport bijgewerkt, dus een afgebroken run gaat verder waar hij
+was. Een volgende run maakt alleen rapporten opnieuw waarvan de rijen zijn veranderd:
+
+    python reports.py --excel PC4_verrijkt.xlsx --shapefile data/PC4.shp --output reports
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from aggregation import AggregationViews, LEVEL_GEMEENTE, LEVEL_PC4, summary_table
+from filters import MISSING_LABEL, FilterEngine
+from map_raster import add_legend, render_map, to_png
+from pc4_data import SNAPSHOT_DIR, load_dataset, source_key
+from profiling import configure_logging
+
+# Verhogen bij een wijziging in inhoud of opmaak van de rapporten; alles wordt dan opnieuw gemaakt
+REPORT_VERSION = 1
+
+# Kolom -> label; per waarde van de kolom één rapport
+REPORT_COLUMNS = {'provincie': "Provincie", 'gemeente': "Gemeente", 'cluster': "Cluster"}
+
+REPORT_DIR = 'reports'
+MANIFEST_NAME = 'manifest.json'
+
+# Kenmerk op de kaart
+MAP_COLUMN = 'berekend_marktaandeel_2023'
+
+# Kolommen van de top/laagste 5 per niveau (zoals in het dashboard)
+RANKING_COLUMNS = {
+    LEVEL_PC4: ['PC4', 'gemeente', 'woonplaats', 'berekend_marktaandeel_2023', 'percentage_verzekerden', 'sterfte_2023', 'uitvaarten_2023'],
+    LEVEL_GEMEENTE: ['gemeente', 'berekend_marktaandeel_2023', 'percentage_verzekerden', 'sterfte_2023', 'uitvaarten_2023'],
+}
+
+# Dataset en filter engine van dit proces; workers erven ze bij fork van het hoofdproces
+_dataset = None
+_engine = None
+
+
+def _load(excel_path, shapefile_path, key, snapshot_dir):
+    global _dataset, _engine
+    if _dataset is None:
+        _dataset = load_dataset(excel_path, shapefile_path, cache_key=key, snapshot_dir=snapshot_dir)
+        _engine = FilterEngine(_dataset)
+    return _dataset, _engine
+
+
+def slugify(value):
+    slug = re.sub(r'[^a-z0-9]+', '-', str(value).lower()).strip('-')
+    return slug or 'leeg'
+
+
+def _row_hashes(data):
+    """Per rij een hash van alle kolommen en de geometrie (als WKB)."""
+    columns = [col for col in data.columns if col != 'geometry']
+    hashes = [pd.util.hash_pandas_object(data[columns], index=False).to_numpy()]
+    if 'geometry' in data.columns:
+        wkb = pd.Series(shapely.to_wkb(data.geometry.values), dtype=object)
+        hashes.append(pd.util.hash_pandas_object(wkb, index=False).to_numpy())
+    return np.column_stack(hashes)
+
+
+def report_jobs(data, engine):
+    """Alle rapporten voor de dataset, met per rapport de vingerafdruk van zijn rijen."""
+    hashes = _row_hashes(data)
+    jobs = []
+    for column in REPORT_COLUMNS:
+        if column not in engine:
+            continue
+        slugs = set()
+        for value in engine.options(column):
+            if value == MISSING_LABEL:
+                continue
+            slug = slugify(value)
+            while slug in slugs:
+                slug += '-'
+            slugs.add(slug)
+
+            rows = np.flatnonzero(engine.to_bool(engine.select(column, [value])))
+            fingerprint = hashlib.sha256(f"{REPORT_VERSION}|{column}|{value}|".encode())
+            fingerprint.update(np.ascontiguousarray(hashes[rows]).tobytes())
+            jobs.append({
+                'id': f"{column}/{slug}",
+                'column': column,
+                'value': value,
+                'fingerprint': fingerprint.hexdigest(),
+            })
+    return jobs
+
+
+def _write_atomic(path, content):
+    """Schrijf via een tijdelijk bestand, zodat een afgebroken run geen half bestand achterlaat."""
+    temporary = f"{path}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(content)
+    os.replace(temporary, path)
+
+
+def _ranking_csv(ranking, level):
+    columns = [col for col in RANKING_COLUMNS[level] if col in ranking.columns]
+    ranking = ranking[columns].round(2)
+    ranking = ranking.rename(columns={'berekend_marktaandeel_2023': 'Marktaandeel', 'percentage_verzekerden': 'Perc. verzekerden'})
+    return ranking.to_csv(index=False).encode('utf-8')
+
+
+def build_report(job, output_dir):
+    """Maak de bestanden van één rapport; geeft de lijst met bestandsnamen."""
+    data, engine = _dataset, _engine
+    directory = os.path.join(output_dir, job['id'])
+    os.makedirs(directory, exist_ok=True)
+
+    filtered = engine.take(data, engine.select(job['column'], [job['value']]))
+    views = AggregationViews(filtered)
+    files = {}
+
+    area_name = f"{REPORT_COLUMNS[job['column']]}: {job['value']}"
+    files['statistieken.csv'] = summary_table(views.summary(LEVEL_PC4), area_name).to_csv(index=False).encode('utf-8')
+
+    levels = [LEVEL_PC4] if job['column'] == 'gemeente' else [LEVEL_PC4, LEVEL_GEMEENTE]
+    for level in levels:
+        suffix = 'pc4' if level == LEVEL_PC4 else 'gemeenten'
+        top, bottom = views.ranking(level, 5)
+        files[f'top5_{suffix}.csv'] = _ranking_csv(top, level)
+        files[f'laagste5_{suffix}.csv'] = _ranking_csv(bottom, level)
+
+    if 'geometry' in filtered.columns and MAP_COLUMN in filtered.columns:
+        values = filtered[MAP_COLUMN].to_numpy(dtype=float)
+        finite = values[np.isfinite(values)]
+        value_range = (float(finite.min()), float(finite.max())) if len(finite) else (0.0, 1.0)
+        image = render_map(filtered.geometry.values, values, value_range=value_range)
+        files['kaart.png'] = to_png(add_legend(image, value_range, "Marktaandeel 2023 (%)"))
+
+    for name, content in files.items():
+        _write_atomic(os.path.join(directory, name), content)
+    return sorted(files)
+
+
+def _run_job(job, output_dir):
+    return job, build_report(job, output_dir)
+
+
+def read_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Manifest {path} kon niet worden gelezen ({e}), alle rapporten worden opnieuw gemaakt.")
+        return {}
+
+
+def write_manifest(output_dir, manifest):
+    content = json.dumps(manifest, indent=2, sort_keys=True, ensure_ascii=False) + '\n'
+    _write_atomic(os.path.join(output_dir, MANIFEST_NAME), content.encode('utf-8'))
+
+
+def _is_current(job, entry, output_dir):
+    if entry is None or entry.get('fingerprint') != job['fingerprint']:
+        return False
+    return all(os.path.exists(os.path.join(output_dir, job['id'], name)) for name in entry.get('files', []))
+
+
+def _pool_context():
+    # Met fork erven de workers de ingelezen dataset; anders leest elke worker de snapshot
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+def build_reports(excel_path, shapefile_path, output_dir=REPORT_DIR, workers=None,
+                  snapshot_dir=SNAPSHOT_DIR, force=False):
+    """Maak alle verouderde rapporten; geeft het aantal mislukte rapporten."""
+    started = time.perf_counter()
+    key = source_key(excel_path, shapefile_path)
+    data, engine = _load(excel_path, shapefile_path, key, snapshot_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    jobs = report_jobs(data, engine)
+    manifest = {} if force else read_manifest(output_dir)
+
+    # Rapporten van regio's die niet meer in de data voorkomen
+    current_ids = {job['id'] for job in jobs}
+    removed = [report_id for report_id in manifest if report_id not in current_ids]
+    for report_id in removed:
+        shutil.rmtree(os.path.join(output_dir, report_id), ignore_errors=True)
+        del manifest[report_id]
+    if removed:
+        write_manifest(output_dir, manifest)
+
+    stale = [job for job in jobs if not _is_current(job, manifest.get(job['id']), output_dir)]
+    print(f"{len(jobs)} rapporten, {len(jobs) - len(stale)} actueel, {len(stale)} te maken, {len(removed)} verwijderd")
+
+    failed = 0
+
+    def done(job, files, i):
+        manifest[job['id']] = {
+            'column': job['column'], 'value': job['value'], 'fingerprint': job['fingerprint'],
+            'files': files, 'built': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        write_manifest(output_dir, manifest)
+        print(f"[{i}/{len(stale)}] {job['id']}")
+
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(stale) <= 1:
+        for i, job in enumerate(stale, 1):
+            try:
+                done(job, build_report(job, output_dir), i)
+            except Exception as e:
+                failed += 1
+                print(f"Rapport {job['id']} mislukt: {e}")
+    else:
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(stale)), mp_context=_pool_context(),
+            initializer=_load, initargs=(excel_path, shapefile_path, key, snapshot_dir)
+        ) as pool:
+            futures = {pool.submit(_run_job, job, output_dir): job for job in stale}
+            for i, future in enumerate(as_completed(futures), 1):
+                try:
+                    job, files = future.result()
+                    done(job, files, i)
+                except Exception as e:
+                    failed += 1
+                    print(f"Rapport {futures[future]['id']} mislukt: {e}")
+
+    print(f"Klaar in {time.perf_counter() - started:.1f} s ({failed} mislukt)")
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maak per provincie, gemeente en cluster een rapport (CSV en kaart).")
+    parser.add_argument('--excel', required=True, help="Pad naar PC4_verrijkt.xlsx")
+    parser.add_argument('--shapefile', default='data/PC4.shp', help="Pad naar PC4.shp")
+    parser.add_argument('--output', default=REPORT_DIR, help="Map voor de rapporten")
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR, help="Map voor de snapshots")
+    parser.add_argument('--workers', type=int, default=None, help="Aantal processen (standaard: aantal CPU's)")
+    parser.add_argument('--force', action='store_true', help="Maak alle rapporten opnieuw")
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    failed = build_reports(args.excel, args.shapefile, args.output, args.workers, args.snapshot_dir, args.force)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""
+Ruimtelijke index (STRtree) over de PC4-geometrieën.
+
+Eén keer per dataset opgebouwd. Beantwoordt "in welk PC4-gebied ligt dit punt?" voor
+veel punten tegelijk (bijv. een lijst met geocodeerde adressen of de punten van een
+selectie op de kaart). De uitkomst zijn PC4-codes, zodat die direct als selectie in het
+PC4-filter kunnen. Coördinaten zijn lengte- en breedtegraad (WGS84), net als op de kaart.
+
+Rechthoek- en lassoselecties op de kaart lopen via de geselecteerde punten: Streamlit
+geeft voor een mapbox-kaart geen coördinaten van de rechthoek of lasso door.
+"""
+import numpy as np
+import pandas as pd
+import shapely
+
+# Kolomnamen die als breedte- en lengtegraad worden herkend bij het inlezen van locaties
+LAT_COLUMNS = ('lat', 'latitude', 'breedtegraad', 'y')
+LON_COLUMNS = ('lon', 'lng', 'longitude', 'lengtegraad', 'x')
+
+
+class SpatialIndex:
+    """STRtree over de geometrieën van één laag, met de id (PC4) per geometrie."""
+
+    def __init__(self, geometries, ids):
+        self.geometries = np.asarray(geometries, dtype=object)
+        self.ids = np.asarray([str(value) for value in ids], dtype=object)
+        self.tree = shapely.STRtree(self.geometries)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def locate(self, lon, lat):
+        """
+        Id van het gebied waar elk punt in ligt (None als het punt buiten alle gebieden
+        valt). Een punt op een grens komt bij het eerste gebied in de dataset.
+        """
+        points = shapely.points(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+        point_index, tree_index = self.tree.query(points, predicate='intersects')
+        result = np.full(len(points), None, dtype=object)
+        # query geeft de paren gesorteerd op punt; per punt de laagste boom-index
+        order = np.lexsort((tree_index, point_index))
+        point_index, tree_index = point_index[order], tree_index[order]
+        first = np.ones(len(point_index), dtype=bool)
+        first[1:] = point_index[1:] != point_index[:-1]
+        result[point_index[first]] = self.ids[tree_index[first]]
+        return result
+
+
+def parse_locations(text):
+    """
+    Locaties uit tekst: één per regel als 'breedtegraad, lengtegraad' (ook met ; of spatie).
+    Geeft een DataFrame met lat en lon; regels die niet te lezen zijn worden overgeslagen.
+    """
+    rows = []
+    for line in text.splitlines():
+        parts = line.replace(';', ',').replace(',', ' ').split()
+        if len(parts) < 2:
+            continue
+        try:
+            rows.append((float(parts[0]), float(parts[1])))
+        except ValueError:
+            continue
+    return pd.DataFrame(rows, columns=['lat', 'lon'])
+
+
+def location_columns(data):
+    """Namen van de breedte- en lengtegraadkolom in een tabel, of None als ze er niet zijn."""
+    columns = {str(col).lower(): col for col in data.columns}
+    lat = next((columns[name] for name in LAT_COLUMNS if name in columns), None)
+    lon = next((columns[name] for name in LON_COLUMNS if name in columns), None)
+    return (lat, lon) if lat is not None and lon is not None else None
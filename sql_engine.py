@@ -0,0 +1,348 @@
+"""
+Filters en aggregaties als queries in DuckDB (optioneel, naast pandas).
+
+De dataset zonder geometrie wordt één keer per dataset als kolomtabel in een DuckDB
+database in het geheugen gezet (via Arrow). Een filterstand is dan één WHERE-clausule;
+de gemeente-aggregatie, de samenvatting en de hoogste/laagste k zijn elk één query
+daarover. De geometrie wordt pas gekoppeld voor rijen die getoond worden: de gefilterde
+PC4-rijen via hun rijnummer in de dataset, gemeenten via de vooraf berekende grenzen.
+
+Filters gebruiken de tekstlabels van de FilterEngine (ontbrekend als 'Onbekend'), dus een
+selectie betekent hier hetzelfde als in de pandas-route (filters.py, aggregation.py). Die
+blijft de standaard; compare_views() zet de uitkomsten van beide naast elkaar.
+
+Kies de route met PC4_QUERY_BACKEND=duckdb (of ?backend=duckdb in de app). Zonder de
+duckdb module valt de app terug op pandas.
+"""
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from aggregation import (
+    CUBE_SUM_COLUMNS, GEMEENTE_NUMERIC_COLUMNS, LEVEL_GEMEENTE, LEVEL_PC4,
+    attach_gemeente_geometry, build_summary
+)
+from filters import MISSING_LABEL
+from profiling import span
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+BACKENDS = ('pandas', 'duckdb')
+
+# Rekenroute voor filters en aggregaties
+QUERY_BACKEND = os.environ.get('PC4_QUERY_BACKEND', 'pandas')
+
+TABLE = 'pc4'
+
+# Rijnummer in de dataset (positie voor iloc) en de kolommen met filterlabels en -waarden
+ROW_COLUMN = '_rij'
+LABEL_PREFIX = '_filter_'
+VALUE_PREFIX = '_bereik_'
+
+# Afgeleide metrieken (zoals calculate_derived_metrics): kolom -> (teller, noemer)
+DERIVED_METRICS = {
+    'berekend_marktaandeel_2023': ('uitvaarten_2023', 'sterfte_2023'),
+    'percentage_verzekerden': ('aantal_verzekerden', 'inwoners'),
+}
+
+
+def available():
+    return duckdb is not None
+
+
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+class SqlEngine:
+    """DuckDB database met de kolommen van één dataset (zonder geometrie)."""
+
+    def __init__(self, data, filter_engine):
+        if duckdb is None:
+            raise ImportError("DuckDB is niet geïnstalleerd (pip install duckdb)")
+        self.size = len(data)
+        self.columns = [col for col in data.columns if col != 'geometry']
+        self.integer_columns = {col for col in self.columns if pd.api.types.is_integer_dtype(data[col])}
+        self.filter_columns = set(filter_engine.categoricals)
+        self.range_columns = set(filter_engine.values)
+
+        # Arrow: categoricals worden dictionary-kolommen, NaN wordt NULL
+        table = pa.Table.from_pandas(pd.DataFrame(data[self.columns]), preserve_index=False)
+        table = table.append_column(ROW_COLUMN, pa.array(np.arange(self.size, dtype=np.int64)))
+        for column, categorical in filter_engine.categoricals.items():
+            table = table.append_column(LABEL_PREFIX + column, pa.array(categorical))
+        for column, values in filter_engine.values.items():
+            table = table.append_column(VALUE_PREFIX + column, pa.array(values, from_pandas=True))
+
+        self._connection = duckdb.connect()
+        self._connection.register('_bron', table)
+        self._connection.execute(f"CREATE TABLE {TABLE} AS SELECT * FROM _bron")
+        self._connection.unregister('_bron')
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def query(self, sql, params=None):
+        """Resultaat als DataFrame; elke query via een eigen cursor (veilig vanuit threads)."""
+        cursor = self._connection.cursor()
+        try:
+            return cursor.execute(sql, params or []).df()
+        finally:
+            cursor.close()
+
+    def where(self, selections, ranges=None):
+        """
+        WHERE-clausule en parameters voor een filterstand, zoals FilterEngine.apply:
+        selections is een dict kolom -> waarden, ranges een dict kolom -> (low, high).
+        """
+        clauses, params = [], []
+        for column, selected in selections.items():
+            if not selected or column not in self.filter_columns:
+                continue
+            clauses.append(f"list_contains(?, CAST({_quote(LABEL_PREFIX + column)} AS VARCHAR))")
+            params.append([str(value) for value in selected])
+        for column, value_range in (ranges or {}).items():
+            if value_range is None or column not in self.range_columns:
+                continue
+            clauses.append(f"{_quote(VALUE_PREFIX + column)} BETWEEN ? AND ?")
+            params.extend(float(value) for value in value_range)
+        return ' AND '.join(clauses) or 'TRUE', params
+
+    def rows(self, where, params):
+        """Rijnummers (oplopend) van de gebieden binnen de filterstand."""
+        cursor = self._connection.cursor()
+        try:
+            result = cursor.execute(
+                f"SELECT {ROW_COLUMN} FROM {TABLE} WHERE {where} ORDER BY {ROW_COLUMN}", params
+            ).fetchnumpy()
+        finally:
+            cursor.close()
+        return np.asarray(result[ROW_COLUMN], dtype=np.intp)
+
+    def gemeente_query(self, where, params, gemeenten=None):
+        """
+        Query voor de totalen per gemeente (zoals aggregate_to_gemeente), met de afgeleide
+        metrieken. gemeenten beperkt de uitkomst tot gemeenten met een grens.
+        """
+        numeric = [col for col in GEMEENTE_NUMERIC_COLUMNS if col in self.columns]
+        aggregates = []
+        for col in numeric:
+            if col == 'reistijd_min':
+                # Gemiddelde reistijd
+                aggregates.append(f"AVG({_quote(col)}) AS {_quote(col)}")
+            elif col in self.integer_columns:
+                aggregates.append(f"CAST(COALESCE(SUM({_quote(col)}), 0) AS BIGINT) AS {_quote(col)}")
+            else:
+                aggregates.append(f"COALESCE(SUM({_quote(col)}), 0) AS {_quote(col)}")
+        derived = [
+            f"CASE WHEN {_quote(den)} > 0 THEN {_quote(num)} / {_quote(den)} * 100 ELSE 0 END AS {_quote(col)}"
+            for col, (num, den) in DERIVED_METRICS.items() if num in numeric and den in numeric
+        ]
+
+        where = f"({where}) AND gemeente IS NOT NULL"
+        params = list(params)
+        if gemeenten is not None:
+            where += " AND list_contains(?, CAST(gemeente AS VARCHAR))"
+            params.append([str(value) for value in gemeenten])
+        sql = (
+            f"SELECT CAST(gemeente AS VARCHAR) AS gemeente, {', '.join(aggregates)} "
+            f"FROM {TABLE} WHERE {where} GROUP BY 1"
+        )
+        if derived:
+            sql = f"SELECT *, {', '.join(derived)} FROM ({sql})"
+        return sql, params
+
+
+class SqlViews:
+    """
+    Dezelfde views als AggregationViews (pc4, gemeente, summary, ranking), maar elke
+    aggregatie is één query in DuckDB met de filterstand als WHERE-clausule. Frames en
+    ranglijsten worden per view bewaard en mogen niet worden aangepast.
+    """
+
+    def __init__(self, engine, data, selections, ranges=None, gemeente_geometry=None):
+        self._engine = engine
+        self._data = data
+        self._where, self._params = engine.where(selections, ranges)
+        self._gemeente_geometry = gemeente_geometry
+        self._pc4 = None
+        self._gemeente = None
+        self._summaries = {}
+        self._rankings = {}
+        self._lock = threading.Lock()
+
+    @property
+    def pc4(self):
+        with self._lock:
+            if self._pc4 is None:
+                with span("sql: gefilterde rijen"):
+                    rows = self._engine.rows(self._where, self._params)
+                # De geometrie komt mee via het rijnummer; zonder filter de dataset zelf
+                self._pc4 = self._data if len(rows) == self._engine.size else self._data.iloc[rows]
+            return self._pc4
+
+    def _gemeente_query(self):
+        gemeenten = self._gemeente_geometry.index if self._gemeente_geometry is not None else None
+        return self._engine.gemeente_query(self._where, self._params, gemeenten)
+
+    @property
+    def gemeente(self):
+        if 'gemeente' not in self._engine:
+            # Zoals aggregate_to_gemeente: zonder gemeentekolom de PC4-rijen zelf
+            return self.pc4
+        with self._lock:
+            if self._gemeente is None:
+                sql, params = self._gemeente_query()
+                with span("sql: aggregate_to_gemeente"):
+                    frame = self._engine.query(f"{sql} ORDER BY gemeente", params)
+                self._gemeente = attach_gemeente_geometry(frame.set_index('gemeente'), self._gemeente_geometry)
+            return self._gemeente
+
+    def frame(self, level):
+        return self.gemeente if level == LEVEL_GEMEENTE else self.pc4
+
+    def _source(self, level):
+        """Subquery en parameters voor het niveau, met de sleutel waarop rijen worden opgehaald."""
+        if level == LEVEL_GEMEENTE:
+            sql, params = self._gemeente_query()
+            return f"({sql})", params, 'gemeente'
+        return f"(SELECT * FROM {TABLE} WHERE {self._where})", list(self._params), ROW_COLUMN
+
+    def summary(self, level=LEVEL_PC4):
+        """Totalen en afgeleide percentages voor het gekozen niveau, in één query."""
+        with self._lock:
+            if level in self._summaries:
+                return self._summaries[level]
+        source, params, _ = self._source(level)
+        columns = [col for col in CUBE_SUM_COLUMNS if col in self._engine]
+        selects = ["COUNT(*) AS aantal"] + [f"COALESCE(SUM({_quote(col)}), 0) AS {_quote(col)}" for col in columns]
+        has_reistijd = 'reistijd_min' in self._engine
+        if has_reistijd:
+            selects.append("AVG(reistijd_min) AS reistijd_min")
+        with span("sql: samenvatting"):
+            row = self._engine.query(f"SELECT {', '.join(selects)} FROM {source} AS bron", params).iloc[0]
+        reistijd_mean = 0
+        if has_reistijd:
+            reistijd_mean = np.nan if pd.isna(row['reistijd_min']) else float(row['reistijd_min'])
+        summary = build_summary(int(row['aantal']), {col: row[col] for col in columns}, reistijd_mean)
+        with self._lock:
+            self._summaries[level] = summary
+        return summary
+
+    def _ranked(self, level, n, metric, group_column=None):
+        """
+        Hoogste en laagste n (per groep) in één query: row_number in beide richtingen, bij
+        gelijke waarden op volgorde van het frame. Geeft (sleutels hoogste, sleutels laagste).
+        """
+        source, params, key = self._source(level)
+        group = f"COALESCE(CAST({_quote(group_column)} AS VARCHAR), '{MISSING_LABEL}')" if group_column else "''"
+        partition = f"PARTITION BY {group} " if group_column else ""
+        sql = (
+            f"SELECT {key} AS sleutel, {group} AS groep, "
+            f"row_number() OVER ({partition}ORDER BY {_quote(metric)} DESC, {key}) AS hoogste, "
+            f"row_number() OVER ({partition}ORDER BY {_quote(metric)} ASC, {key}) AS laagste "
+            f"FROM {source} AS bron "
+            f"WHERE sterfte_2023 > 0 AND {_quote(metric)} IS NOT NULL "
+            f"QUALIFY hoogste <= ? OR laagste <= ?"
+        )
+        with span("sql: ranglijst"):
+            ranked = self._engine.query(sql, params + [n, n])
+        top = ranked[ranked['hoogste'] <= n].sort_values(['groep', 'hoogste'])
+        bottom = ranked[ranked['laagste'] <= n].sort_values(['groep', 'laagste'])
+        return top['sleutel'].to_numpy(), bottom['sleutel'].to_numpy()
+
+    def _rows(self, level, keys):
+        """Alleen de gevraagde rijen, zonder geometrie."""
+        if level == LEVEL_GEMEENTE:
+            data = self.gemeente
+            positions = pd.Index(data['gemeente'].astype(str)).get_indexer(keys)
+        else:
+            data = self._data
+            positions = np.asarray(keys, dtype=np.intp)
+        columns = [col for col in data.columns if col != 'geometry']
+        return pd.DataFrame(data.iloc[positions][columns])
+
+    def ranking(self, level, n=5, metric='berekend_marktaandeel_2023'):
+        """Hoogste en laagste n gebieden op de metriek (alleen gebieden met sterfte)."""
+        key = (level, n, metric)
+        with self._lock:
+            if key in self._rankings:
+                return self._rankings[key]
+        top, bottom = self._ranked(level, n, metric)
+        result = (self._rows(level, top), self._rows(level, bottom))
+        with self._lock:
+            self._rankings[key] = result
+        return result
+
+    def ranking_by_group(self, level, group_column, n=3, metric='berekend_marktaandeel_2023'):
+        """Hoogste en laagste n gebieden per groep, de groepen op alfabetische volgorde."""
+        key = (level, n, metric, group_column)
+        with self._lock:
+            if key in self._rankings:
+                return self._rankings[key]
+        top, bottom = self._ranked(level, n, metric, group_column)
+        result = (self._rows(level, top), self._rows(level, bottom))
+        with self._lock:
+            self._rankings[key] = result
+        return result
+
+
+def _frame_difference(name, expected, actual, rtol):
+    expected = pd.DataFrame(expected.drop(columns=['geometry'], errors='ignore')).reset_index(drop=True)
+    actual = pd.DataFrame(actual.drop(columns=['geometry'], errors='ignore')).reset_index(drop=True)
+    # Alleen de waarden vergelijken: types (bijv. categorical of int32) mogen verschillen
+    for frame in (expected, actual):
+        for col in frame.columns:
+            if not pd.api.types.is_numeric_dtype(frame[col]) or pd.api.types.is_bool_dtype(frame[col]):
+                frame[col] = frame[col].astype(object).where(frame[col].notna(), None).astype(str)
+    try:
+        pd.testing.assert_frame_equal(expected, actual, check_dtype=False, check_like=True, rtol=rtol)
+    except AssertionError as e:
+        return f"{name}: {' '.join(str(e).split())}"
+    return None
+
+
+def compare_views(expected, actual, levels=(LEVEL_PC4, LEVEL_GEMEENTE), metric='berekend_marktaandeel_2023',
+                  group_column=None, n=5, rtol=1e-5):
+    """
+    Vergelijk twee views voor dezelfde filterstand (bijv. pandas en DuckDB): frames,
+    samenvattingen en ranglijsten. Geeft een lijst met verschillen, leeg als ze gelijk zijn.
+    """
+    differences = []
+    if not expected.pc4.index.equals(actual.pc4.index):
+        differences.append(f"pc4: {len(expected.pc4)} tegen {len(actual.pc4)} rijen")
+    for level in levels:
+        difference = _frame_difference(f"{level}: frame", expected.frame(level), actual.frame(level), rtol)
+        if difference:
+            differences.append(difference)
+
+        expected_summary, actual_summary = expected.summary(level), actual.summary(level)
+        for name, value in expected_summary.items():
+            if not np.isclose(float(value), float(actual_summary[name]), rtol=rtol, equal_nan=True):
+                differences.append(f"{level}: samenvatting {name} {value} tegen {actual_summary[name]}")
+
+        if metric not in expected.frame(level).columns:
+            continue
+        rankings = [('ranglijst', [metric], expected.ranking(level, n, metric), actual.ranking(level, n, metric))]
+        if group_column is not None and group_column in expected.frame(level).columns:
+            rankings.append((
+                f"ranglijst per {group_column}", [group_column, metric],
+                expected.ranking_by_group(level, group_column, n, metric),
+                actual.ranking_by_group(level, group_column, n, metric),
+            ))
+        # Bij gelijke waarden mag de keuze van de gebieden verschillen (argpartition kiest
+        # willekeurig tussen gelijke kandidaten), dus alleen de waarden (en groepen) vergelijken
+        for name, columns, expected_rows, actual_rows in rankings:
+            for side, expected_frame, actual_frame in zip(('hoogste', 'laagste'), expected_rows, actual_rows):
+                difference = _frame_difference(
+                    f"{level}: {name} ({side})", expected_frame[columns], actual_frame[columns], rtol
+                )
+                if difference:
+                    differences.append(difference)
+    return differences
@@ -0,0 +1,302 @@
+"""
+Topologie van de PC4-laag: gedeelde grenzen als arcs met gekwantiseerde coördinaten.
+
+Naburige PC4-gebieden slaan hun gemeenschappelijke grens elk apart op. Hier wordt elke
+grens één keer als arc opgeslagen (zoals in TopoJSON), in gehele coördinaten op een raster.
+Vereenvoudigen gebeurt per arc, zodat buren na vereenvoudiging nog steeds precies op elkaar
+aansluiten (geen kieren of overlap). Gemeentegrenzen ontstaan door de arcs te nemen die
+binnen een gemeente maar één keer voorkomen, zonder buffer(0) of dissolve.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+import shapely
+
+# Aantal rasterstappen over de breedte en hoogte van de kaart (ca. 3 meter voor Nederland)
+DEFAULT_QUANTIZATION = 100_000
+
+
+class Topology:
+    """
+    arcs:    lijst met (k, 2) int arrays (absolute gekwantiseerde coördinaten)
+    objects: per object een lijst polygonen, per polygoon een lijst ringen (eerste is de
+             buitenring), per ring een lijst arc-verwijzingen; ~i betekent arc i omgekeerd.
+    """
+
+    def __init__(self, arcs, objects, scale, translate, ids=None):
+        self.arcs = arcs
+        self.objects = objects
+        self.scale = np.asarray(scale, dtype=float)
+        self.translate = np.asarray(translate, dtype=float)
+        self.ids = list(ids) if ids is not None else list(range(len(objects)))
+        # Genoeg decimalen om één rasterstap weer te geven
+        self.decimals = int(np.ceil(-np.log10(self.scale.min()))) + 1
+
+    # Opbouw
+
+    @classmethod
+    def build(cls, geometries, ids=None, quantization=DEFAULT_QUANTIZATION):
+        geometries = np.asarray(geometries)
+        minx, miny, maxx, maxy = shapely.total_bounds(geometries)
+        scale = np.array([
+            (maxx - minx) / (quantization - 1) or 1.0,
+            (maxy - miny) / (quantization - 1) or 1.0,
+        ])
+        translate = np.array([minx, miny])
+
+        # Polygonen, ringen en coördinaten met hun herkomst
+        parts, part_object = shapely.get_parts(geometries, return_index=True)
+        rings, ring_part = shapely.get_rings(parts, return_index=True)
+        coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+        quantized = np.round((coords - translate) / scale).astype(np.int64)
+
+        ring_quantized = _open_rings(quantized, coord_ring, len(rings))
+        junction_flags = _find_junctions(ring_quantized, quantization)
+
+        arcs = []
+        arc_lookup = {}
+        objects = [[] for _ in range(len(geometries))]
+        part_rings = {}
+        for ring_index, ring in enumerate(ring_quantized):
+            if ring is None:
+                continue
+            keys = ring[:, 0] * quantization + ring[:, 1]
+            refs = [_arc_ref(arc, arcs, arc_lookup, quantization) for arc in _cut_ring(ring, keys, junction_flags[ring_index])]
+            part_rings.setdefault(ring_part[ring_index], []).append(refs)
+
+        # get_rings geeft per polygoon eerst de buitenring; een polygoon zonder geldige
+        # buitenring (ingestort na kwantisatie) valt weg
+        exteriors = _first_ring_per_part(ring_part)
+        for part_index, part_ring_refs in part_rings.items():
+            if ring_quantized[exteriors[part_index]] is None:
+                continue
+            objects[part_object[part_index]].append(part_ring_refs)
+
+        return cls(arcs, objects, scale, translate, ids=ids)
+
+    # Vereenvoudigen en decoderen
+
+    def _dequantize(self, arc):
+        return np.round(arc * self.scale + self.translate, self.decimals)
+
+    def simplified_arcs(self, tolerance):
+        """Douglas-Peucker per arc; eindpunten (knooppunten) blijven altijd staan."""
+        if tolerance <= 0:
+            return [self._dequantize(arc) for arc in self.arcs]
+        if not self.arcs:
+            return []
+        coords = np.concatenate([self._dequantize(arc) for arc in self.arcs])
+        indices = np.repeat(np.arange(len(self.arcs)), [len(arc) for arc in self.arcs])
+        simplified = shapely.simplify(shapely.linestrings(coords, indices=indices), tolerance, preserve_topology=False)
+        result = []
+        for arc, line in zip(self.arcs, simplified):
+            coords = shapely.get_coordinates(line)
+            closed = arc[0, 0] == arc[-1, 0] and arc[0, 1] == arc[-1, 1]
+            # Een gesloten arc (hele ring) mag niet tot minder dan een driehoek krimpen
+            if closed and len(coords) < 4:
+                coords = self._dequantize(arc)
+            result.append(coords)
+        return result
+
+    @staticmethod
+    def _ring_coordinates(refs, arcs):
+        # Elke arc begint waar de vorige eindigt; het laatste punt van elke arc vervalt
+        pieces = [(arcs[ref] if ref >= 0 else arcs[~ref][::-1])[:-1] for ref in refs]
+        coords = np.concatenate(pieces) if pieces else np.empty((0, 2))
+        return np.vstack([coords, coords[:1]]) if len(coords) else coords
+
+    def _polygon(self, ring_refs, arcs):
+        rings = [self._ring_coordinates(refs, arcs) for refs in ring_refs]
+        # Ringen die na vereenvoudiging geen oppervlak meer hebben vallen weg
+        if not _has_area(rings[0]):
+            return None
+        return shapely.Polygon(rings[0], [ring for ring in rings[1:] if _has_area(ring)])
+
+    def geometries(self, arcs=None):
+        """Alle objecten als (Multi)Polygon, gebouwd uit de (eventueel vereenvoudigde) arcs."""
+        arcs = arcs if arcs is not None else self.simplified_arcs(0)
+        result = []
+        for polygons in self.objects:
+            shapes = [p for p in (self._polygon(rings, arcs) for rings in polygons) if p is not None]
+            if not shapes:
+                result.append(None)
+            elif len(shapes) == 1:
+                result.append(shapes[0])
+            else:
+                result.append(shapely.MultiPolygon(shapes))
+        return np.array(result, dtype=object)
+
+    def merge(self, groups, arcs=None):
+        """
+        Voeg objecten per groep samen (bijv. PC4 naar gemeente). Arcs die binnen een groep
+        twee keer voorkomen zijn interne grenzen en vallen weg; de rest vormt de buitengrens.
+        Geeft een pandas Series met de groep als index.
+        """
+        arcs = arcs if arcs is not None else self.simplified_arcs(0)
+        groups = pd.Series(np.asarray(groups))
+        merged = {}
+        for group, positions in groups.groupby(groups, sort=True).groups.items():
+            counts = {}
+            for position in positions:
+                for rings in self.objects[position]:
+                    for refs in rings:
+                        for ref in refs:
+                            index = ref if ref >= 0 else ~ref
+                            counts[index] = counts.get(index, 0) + 1
+            boundary = [arcs[index] for index, count in counts.items() if count == 1 and len(arcs[index]) >= 2]
+            if not boundary:
+                merged[group] = None
+                continue
+            area = shapely.build_area(shapely.MultiLineString(boundary))
+            merged[group] = None if area.is_empty else area
+        return pd.Series(merged, dtype=object)
+
+    def neighbours(self):
+        """
+        Paren objecten (i, j), i < j, die een grens delen, met de lengte van die grens (in
+        eenheden van de coördinaten). Een arc die door precies twee objecten wordt gebruikt
+        is een gedeelde grens; alleen een gemeenschappelijk hoekpunt telt niet.
+        """
+        arc_objects = {}
+        for position, polygons in enumerate(self.objects):
+            for rings in polygons:
+                for refs in rings:
+                    for ref in refs:
+                        arc_objects.setdefault(ref if ref >= 0 else ~ref, set()).add(position)
+
+        lengths = {}
+        for index, owners in arc_objects.items():
+            if len(owners) != 2:
+                continue
+            pair = tuple(sorted(owners))
+            coords = self._dequantize(self.arcs[index])
+            lengths[pair] = lengths.get(pair, 0.0) + float(np.hypot(*np.diff(coords, axis=0).T).sum())
+
+        pairs = np.array(list(lengths), dtype=np.int64).reshape(-1, 2)
+        return pairs[:, 0], pairs[:, 1], np.array(list(lengths.values()), dtype=float)
+
+    # TopoJSON (de gecomprimeerde vorm op schijf)
+
+    def to_topojson(self):
+        delta_arcs = []
+        for arc in self.arcs:
+            delta = np.diff(arc, axis=0, prepend=np.zeros((1, 2), dtype=arc.dtype))
+            delta_arcs.append(delta.tolist())
+        geometries = []
+        for object_id, polygons in zip(self.ids, self.objects):
+            geometries.append({
+                'type': 'MultiPolygon',
+                'id': str(object_id),
+                'arcs': polygons,
+            })
+        return {
+            'type': 'Topology',
+            'transform': {'scale': self.scale.tolist(), 'translate': self.translate.tolist()},
+            'objects': {'pc4': {'type': 'GeometryCollection', 'geometries': geometries}},
+            'arcs': delta_arcs,
+        }
+
+    @classmethod
+    def from_topojson(cls, topojson):
+        arcs = [np.cumsum(np.asarray(arc, dtype=np.int64).reshape(-1, 2), axis=0) for arc in topojson['arcs']]
+        geometries = topojson['objects']['pc4']['geometries']
+        objects = [geometry['arcs'] for geometry in geometries]
+        ids = [geometry.get('id') for geometry in geometries]
+        transform = topojson['transform']
+        return cls(arcs, objects, transform['scale'], transform['translate'], ids=ids)
+
+    def dumps(self):
+        return json.dumps(self.to_topojson(), separators=(',', ':'))
+
+
+def _has_area(ring):
+    """Minstens drie verschillende punten (zonder te sorteren, dit wordt per ring aangeroepen)."""
+    if len(ring) < 4:
+        return False
+    other = np.any(ring != ring[0], axis=1)
+    if not other.any():
+        return False
+    return bool(np.any(other & np.any(ring != ring[np.argmax(other)], axis=1)))
+
+
+def _open_rings(quantized, coord_ring, ring_count):
+    """Per ring de punten zonder sluitpunt en zonder opeenvolgende dubbele punten."""
+    boundaries = np.searchsorted(coord_ring, np.arange(ring_count + 1))
+    rings = []
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        ring = quantized[start:end]
+        if len(ring) > 1 and np.array_equal(ring[0], ring[-1]):
+            ring = ring[:-1]
+        if len(ring):
+            ring = ring[np.any(ring != np.roll(ring, 1, axis=0), axis=1)]
+        rings.append(ring if len(ring) >= 3 else None)
+    return rings
+
+
+def _find_junctions(rings, quantization):
+    """
+    Een punt is een knooppunt als het in verschillende ringen met verschillende buren
+    voorkomt (daar begint of eindigt een gedeelde grens). Geeft per ring een boolean array.
+    """
+    present = [ring for ring in rings if ring is not None]
+    if not present:
+        return [None] * len(rings)
+    keys, lows, highs = [], [], []
+    for ring in present:
+        key = ring[:, 0] * quantization + ring[:, 1]
+        previous_key, next_key = np.roll(key, 1), np.roll(key, -1)
+        keys.append(key)
+        lows.append(np.minimum(previous_key, next_key))
+        highs.append(np.maximum(previous_key, next_key))
+    all_keys = np.concatenate(keys)
+    neighbours = pd.DataFrame({
+        'key': all_keys, 'low': np.concatenate(lows), 'high': np.concatenate(highs)
+    }).drop_duplicates()
+    counts = neighbours['key'].value_counts()
+    flags = np.isin(all_keys, counts.index[counts > 1].to_numpy(dtype=np.int64))
+
+    # Terug verdelen over de ringen
+    split = iter(np.split(flags, np.cumsum([len(key) for key in keys])[:-1]))
+    return [next(split) if ring is not None else None for ring in rings]
+
+
+def _cut_ring(ring, keys, is_junction):
+    """Knip een ring op de knooppunten in arcs (elke arc eindigt op het volgende knooppunt)."""
+    positions = np.flatnonzero(is_junction)
+    if len(positions) == 0:
+        # Geen knooppunten: de hele ring is één gesloten arc, met een vaste startpositie
+        start = int(np.argmin(keys))
+        rotated = np.roll(ring, -start, axis=0)
+        return [np.vstack([rotated, rotated[:1]])]
+
+    rotated = np.roll(ring, -positions[0], axis=0)
+    cuts = list(positions - positions[0]) + [len(ring)]
+    closed = np.vstack([rotated, rotated[:1]])
+    return [closed[a:b + 1] for a, b in zip(cuts[:-1], cuts[1:])]
+
+
+def _arc_ref(arc, arcs, arc_lookup, quantization):
+    """
+    Index van de arc; een eerder gevonden omgekeerde arc geeft ~index. Gesloten arcs
+    beginnen altijd bij hun kleinste punt, dus ook die worden zo herkend.
+    """
+    keys = arc[:, 0] * quantization + arc[:, 1]
+    forward = keys.tobytes()
+    if forward in arc_lookup:
+        return arc_lookup[forward]
+    backward = keys[::-1].tobytes()
+    if backward in arc_lookup:
+        return ~arc_lookup[backward]
+
+    index = len(arcs)
+    arcs.append(arc)
+    arc_lookup[forward] = index
+    return index
+
+
+def _first_ring_per_part(ring_part):
+    first = {}
+    for ring_index, part_index in enumerate(ring_part):
+        first.setdefault(part_index, ring_index)
+    return first
@@ -0,0 +1,192 @@
+"""
+Content-adresseerbare opslag voor geüploade bronbestanden.
+
+Streamlit voert app.py bij elke interactie opnieuw uit. Door uploads op te slaan in
+een map die naar de hash van de inhoud is vernoemd, blijven de paden en de
+cache-sleutel van load_data stabiel zolang dezelfde bestanden zijn geüpload.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Volgorde is onderdeel van de cache-sleutel, dus niet aanpassen
+SHAPEFILE_EXTENSIONS = ('.shp', '.shx', '.dbf', '.prj')
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'PC4_UPLOAD_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'pc4_dashboard_uploads')
+)
+DEFAULT_MAX_ENTRIES = int(os.environ.get('PC4_UPLOAD_CACHE_ENTRIES', '4'))
+
+# Half afgeschreven mappen (bijv. na een crash) die ouder zijn dan dit worden opgeruimd
+_STALE_TMP_SECONDS = 3600
+
+# Aantal onthouden hashes per soort (bestanden en uploads); de oudste vervallen eerst
+DIGEST_CACHE_ENTRIES = 64
+
+_digest_lock = threading.Lock()
+_file_digests = OrderedDict()    # (pad, grootte, mtime_ns) -> sha256
+_upload_digests = OrderedDict()  # (file_id, grootte) -> sha256
+
+
+def digest_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _cached_digest(digests, signature):
+    with _digest_lock:
+        if signature in digests:
+            digests.move_to_end(signature)
+            return digests[signature]
+    return None
+
+
+def _remember_digest(digests, signature, digest):
+    with _digest_lock:
+        digests[signature] = digest
+        digests.move_to_end(signature)
+        while len(digests) > DIGEST_CACHE_ENTRIES:
+            digests.popitem(last=False)
+
+
+def digest_file(path, chunk_size=1 << 20):
+    """Sha256 van een bestand, onthouden zolang grootte en mtime gelijk blijven."""
+    stat = os.stat(path)
+    signature = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    digest = _cached_digest(_file_digests, signature)
+    if digest is not None:
+        return digest
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    _remember_digest(_file_digests, signature, digest)
+    return digest
+
+
+def digest_upload(uploaded_file):
+    """Sha256 van een Streamlit UploadedFile; per upload maar één keer berekend."""
+    file_id = getattr(uploaded_file, 'file_id', None)
+    signature = (file_id, uploaded_file.size)
+    if file_id is not None:
+        digest = _cached_digest(_upload_digests, signature)
+        if digest is not None:
+            return digest
+
+    digest = digest_bytes(uploaded_file.getvalue())
+
+    if file_id is not None:
+        _remember_digest(_upload_digests, signature, digest)
+    return digest
+
+
+def shapefile_component_path(shapefile_path, ext):
+    """Zoek een bijbehorend bestand (.shx, .dbf, ...) ook in hoofdletters."""
+    base = os.path.splitext(shapefile_path)[0]
+    for candidate in (base + ext, base + ext.upper()):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def local_shapefile_digests(shapefile_path):
+    digests = {}
+    for ext in SHAPEFILE_EXTENSIONS:
+        component = shapefile_component_path(shapefile_path, ext)
+        if component is not None:
+            digests[ext] = digest_file(component)
+    return digests
+
+
+def content_key(excel_digest, shapefile_digests):
+    """Combineer de hashes van het Excel bestand en de shapefile-onderdelen tot één sleutel."""
+    h = hashlib.sha256()
+    h.update(b'excel:' + excel_digest.encode())
+    for ext in SHAPEFILE_EXTENSIONS:
+        h.update(f'{ext}:{shapefile_digests.get(ext, "")}'.encode())
+    return h.hexdigest()
+
+
+class UploadCache:
+    """
+    Begrensde opslag van uploads op schijf, één map per cache-sleutel.
+    Bij meer dan max_entries mappen wordt de minst recent gebruikte verwijderd.
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_entries=DEFAULT_MAX_ENTRIES):
+        self.root = root
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:32])
+
+    def materialise(self, key, files):
+        """
+        Zorg dat de bestanden onder de sleutel op schijf staan en geef de map terug.
+        files: dict met bestandsnaam -> UploadedFile (of bytes).
+        """
+        entry_dir = self._entry_dir(key)
+        with self._lock:
+            if os.path.isdir(entry_dir):
+                # Markeer als recent gebruikt voor de LRU-volgorde
+                os.utime(entry_dir)
+                return entry_dir
+
+            os.makedirs(self.root, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.root)
+            try:
+                for file_name, data in files.items():
+                    with open(os.path.join(tmp_dir, file_name), 'wb') as f:
+                        f.write(data.getbuffer() if hasattr(data, 'getbuffer') else data)
+                # Atomisch hernoemen zodat een half geschreven map nooit zichtbaar is
+                os.replace(tmp_dir, entry_dir)
+            except OSError:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                if not os.path.isdir(entry_dir):
+                    raise
+
+            self._evict(keep=entry_dir)
+            return entry_dir
+
+    def _evict(self, keep):
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+
+        entries = []
+        now = time.time()
+        for name in names:
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                continue
+            mtime = os.path.getmtime(path)
+            if name.startswith('.tmp-'):
+                if now - mtime > _STALE_TMP_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            entries.append((mtime, path))
+
+        entries.sort(reverse=True)
+        for _, path in entries[self.max_entries:]:
+            if path != keep:
+                logger.info(f"Upload cache: verwijder oude map {path}")
+                shutil.rmtree(path, ignore_errors=True)
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+# Eén cache per proces, gedeeld door alle sessies
+upload_cache = UploadCache()
@@ -0,0 +1,86 @@
+"""
+Het proces opwarmen voordat de eerste gebruiker verbinding maakt.
+
+Bij een koude start betaalt de eerste sessie anders voor het importeren van de zware
+modules (pandas, geopandas, plotly, scipy), het hashen en inlezen van de meegeleverde
+shapefile (data/PC4.*) en het inlezen van de snapshot. warm_up() doet dat vooraf, in
+hetzelfde proces als de Streamlit server, zodat de caches per proces (sys.modules,
+pc4_data, upload_cache) al gevuld zijn.
+
+Start het dashboard via dit script in plaats van met 'streamlit run app.py'; extra
+argumenten gaan door naar Streamlit:
+
+    python warmup.py
+    python warmup.py --server.port 8080
+"""
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Meegeleverde shapefile (zoals in app.py)
+LOCAL_SHAPEFILE = 'data/PC4.shp'
+
+# Modules die de app na het uploaden nodig heeft, in volgorde van afhankelijkheid
+HEAVY_MODULES = [
+    'numpy', 'pandas', 'shapely', 'geopandas', 'pyarrow', 'scipy.sparse', 'PIL',
+    'plotly.express',
+    'topology', 'map_layers', 'map_raster', 'map_figure', 'aggregation', 'filters', 'export', 'adjacency', 'catchment',
+    'spatial_index', 'pc4_data', 'sql_engine',
+]
+
+
+def import_modules(names=HEAVY_MODULES):
+    started = time.perf_counter()
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.warning(f"Opwarmen: {name} kon niet worden geïmporteerd ({e})")
+    logger.info(f"Opwarmen: modules geïmporteerd in {time.perf_counter() - started:.1f} s")
+
+
+def load_data(shapefile_path=LOCAL_SHAPEFILE, snapshot_dir=None):
+    """Lees de meegeleverde shapefile en de nieuwste snapshot in de caches van dit proces."""
+    started = time.perf_counter()
+    import pc4_data
+    from upload_cache import local_shapefile_digests
+
+    if os.path.exists(shapefile_path):
+        try:
+            # Hashes voor de cache-sleutel en de vormen zelf; beide worden per proces bewaard
+            local_shapefile_digests(shapefile_path)
+            pc4_data.read_geometry(shapefile_path)
+        except Exception as e:
+            logger.warning(f"Opwarmen: shapefile {shapefile_path} kon niet worden ingelezen ({e})")
+    snapshots = pc4_data.preload_snapshots(snapshot_dir or pc4_data.SNAPSHOT_DIR)
+
+    logger.info(f"Opwarmen: data ingelezen in {time.perf_counter() - started:.1f} s ({len(snapshots)} snapshot(s))")
+
+
+def warm_up(shapefile_path=LOCAL_SHAPEFILE, snapshot_dir=None):
+    import_modules()
+    load_data(shapefile_path, snapshot_dir)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # Importeren gebeurt vóór de server start: modules die half geïmporteerd zijn kunnen vanuit
+    # een andere thread zichtbaar zijn (plotly controleert sys.modules op pandas). Het inlezen
+    # van de data loopt daarna naast het opstarten van de server.
+    from streamlit.web import cli as streamlit_cli
+    from profiling import configure_logging
+    configure_logging()
+    import_modules()
+    threading.Thread(target=load_data, name='warmup', daemon=True).start()
+
+    sys.argv = ['streamlit', 'run', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py'), *argv]
+    return streamlit_cli.main()
+
+
+if __name__ == '__main__':
+    sys.exit(main())